@@ -0,0 +1,287 @@
+"""
+Precomputed Gene-set Activities for MASLDatlas
+Scores every cell of a dataset against every set of the bundled enrichment
+resources (CollecTRI, PROGENy, MSigDB in enrichment_sets/) with the batched
+ULM of gene_set_scoring, in row blocks straight from the .h5ad, and stores
+the activities as a compressed cells x sets matrix (float16 by default,
+chunked by set so one activity is one column read). Per-CellType and
+per-Group summaries (cell count, mean, standard deviation and fraction of
+positive scores) are stored next to it, so activity UMAPs, violins and
+summary tables are lookups instead of an interactive run_ulm.
+
+File layout (<stem>_activities.h5):
+    obs_names                      cell names of the source file
+    <resource>/sets                set names
+    <resource>/scores              cells x sets activities
+    <resource>/summary/<column>/   groups, n_cells, mean, std, frac_positive (groups x sets)
+"""
+
+import argparse
+import os
+import threading
+import time
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from gene_index import DEFAULT_INDEX_DIR
+from gene_set_scoring import DEFAULT_RESOURCE_DIR, RESOURCES, load_resource, ulm_scores, weight_matrix
+from h5ad_utils import compression_options, iter_row_blocks, matrix_shape, read_elem
+
+INDEX_VERSION = 1
+DEFAULT_DTYPE = 'float16'
+DEFAULT_CODEC = 'gzip:4'
+DEFAULT_MIN_N = 5
+SUMMARY_COLUMNS = ('CellType', 'Group')
+STATISTICS = ('n_cells', 'mean', 'std', 'frac_positive')
+
+_LOADED = {}
+_LOADED_LOCK = threading.Lock()
+
+
+def activity_path_for(h5ad_path, index_dir=None):
+    """Default location of the precomputed activities of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_activities.h5"
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def _expression(f, use_raw):
+    """(matrix element, gene names) scored by run_ulm: raw/X when present and use_raw"""
+    if use_raw and 'raw' in f and 'X' in f['raw']:
+        return f['raw']['X'], read_elem(f['raw']['var']).index.astype(str)
+    return f['X'], read_elem(f['var']).index.astype(str)
+
+
+def _nonempty_genes(elem, block_rows):
+    nonempty = np.zeros(matrix_shape(elem)[1], dtype=bool)
+    for _, _, block in iter_row_blocks(elem, block_rows):
+        if sp.issparse(block):
+            nonempty[block.indices] = True
+        else:
+            nonempty |= (np.asarray(block) != 0).any(axis=0)
+    return nonempty
+
+
+class _GroupStatistics:
+    """Streamed per-group count, sum, sum of squares and positive count of finite scores"""
+
+    def __init__(self, codes, n_groups, n_sets):
+        self.codes = codes
+        self.n_groups = n_groups
+        self.n = np.zeros((n_groups, n_sets))
+        self.sums = np.zeros((n_groups, n_sets))
+        self.sumsq = np.zeros((n_groups, n_sets))
+        self.positive = np.zeros((n_groups, n_sets))
+
+    def add(self, start, end, scores):
+        n = end - start
+        indicator = sp.csr_matrix((np.ones(n), (self.codes[start:end], np.arange(n))), shape=(self.n_groups, n))
+        scores = scores.astype(np.float64)
+        finite = np.isfinite(scores)
+        scores[~finite] = 0
+        self.n += indicator @ finite.astype(np.float64)
+        self.sums += indicator @ scores
+        self.sumsq += indicator @ (scores ** 2)
+        self.positive += indicator @ (scores > 0).astype(np.float64)
+
+    def finish(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.sums / self.n
+            var = (self.sumsq / self.n - mean ** 2) * (self.n / np.maximum(self.n - 1, 1))
+            return {'n_cells': self.n.astype(np.int64), 'mean': mean.astype(np.float32),
+                    'std': np.sqrt(np.maximum(var, 0)).astype(np.float32),
+                    'frac_positive': (self.positive / self.n).astype(np.float32)}
+
+
+def build_activities(h5ad_path, out_path=None, resources=RESOURCES, resource_dir=DEFAULT_RESOURCE_DIR,
+                     dtype=DEFAULT_DTYPE, codec=DEFAULT_CODEC, block_rows=50000, min_n=DEFAULT_MIN_N,
+                     use_raw=True, summary_columns=SUMMARY_COLUMNS):
+    """Write the activities of every set of ``resources`` in every cell of an .h5ad file"""
+    h5ad_path = Path(h5ad_path)
+    out_path = Path(out_path) if out_path else activity_path_for(h5ad_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    print(f"🧪 Scoring {h5ad_path.name} against {', '.join(map(str, resources))} ({dtype})...")
+    start_time = time.time()
+
+    try:
+        with h5py.File(h5ad_path, 'r') as f, h5py.File(tmp_path, 'w') as out:
+            obs = read_elem(f['obs'])
+            n_obs = len(obs)
+            elem, genes = _expression(f, use_raw)
+            nonempty = _nonempty_genes(elem, block_rows)
+            genes = genes[nonempty]
+            columns = np.flatnonzero(nonempty)
+
+            out.attrs.update({'version': INDEX_VERSION, 'source': str(h5ad_path), 'n_obs': n_obs,
+                              'dtype': str(dtype), 'min_n': min_n, 'use_raw': bool(use_raw),
+                              **_source_signature(h5ad_path)})
+            out.create_dataset('obs_names', data=obs.index.astype(str).to_numpy(dtype=object),
+                               dtype=h5py.string_dtype())
+
+            networks = {}
+            for resource in resources:
+                W, sets = weight_matrix(load_resource(resource, resource_dir), genes, min_n)
+                if not sets:
+                    print(f"⚠️  No set of {resource} has {min_n} targets in the data, skipped")
+                    continue
+                name = Path(str(resource)).stem
+                group = out.create_group(name)
+                group.create_dataset('sets', data=np.array(sets, dtype=object), dtype=h5py.string_dtype())
+                chunk_rows = min(block_rows, n_obs)
+                scores = group.create_dataset('scores', shape=(n_obs, len(sets)), dtype=dtype,
+                                              chunks=(chunk_rows, 1), **compression_options(codec))
+                summaries = {}
+                for column in summary_columns:
+                    if column in obs.columns:
+                        codes, groups = pd.factorize(obs[column].astype(str), sort=True)
+                        summaries[column] = (groups, _GroupStatistics(codes, len(groups), len(sets)))
+                networks[name] = (W, scores, summaries)
+            if not networks:
+                print(f"⚠️  No resource has a set with {min_n} targets in the data, no activities written")
+                return None
+
+            # One read of each row block of X feeds every resource
+            for start, end, block in iter_row_blocks(elem, block_rows):
+                block = block[:, columns] if len(columns) < block.shape[1] else block
+                for name, (W, scores, summaries) in networks.items():
+                    estimates, _ = ulm_scores(block, W)
+                    scores[start:end] = estimates.astype(dtype)
+                    for _, stats in summaries.values():
+                        stats.add(start, end, estimates)
+                print(f"🧪 Scored {end:,}/{n_obs:,} cells")
+
+            for name, (_, scores, summaries) in networks.items():
+                for column, (groups, stats) in summaries.items():
+                    summary = out.create_group(f"{name}/summary/{column}")
+                    summary.create_dataset('groups', data=np.array(groups, dtype=object), dtype=h5py.string_dtype())
+                    for stat, values in stats.finish().items():
+                        summary.create_dataset(stat, data=values)
+                print(f"✅ {name}: {scores.shape[1]} sets")
+
+        os.replace(tmp_path, out_path)
+    finally:
+        # The partial file of a failed or skipped run
+        tmp_path.unlink(missing_ok=True)
+    print(f"✅ Activities saved in {time.time() - start_time:.1f} seconds "
+          f"({out_path.stat().st_size / (1024**2):.1f} MB): {out_path}")
+    return out_path
+
+
+class ActivityIndex:
+    """Read access to a precomputed activities file"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = h5py.File(self.path, 'r')
+        self.meta = dict(self.file.attrs)
+        self._obs_names = None
+        self._sets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def obs_names(self):
+        if self._obs_names is None:
+            self._obs_names = pd.Index(self.file['obs_names'].asstr()[:])
+        return self._obs_names
+
+    def resources(self):
+        return [name for name in self.file.keys() if name != 'obs_names']
+
+    def sets(self, resource):
+        """Set names of a resource, as a pandas Index"""
+        if resource not in self._sets:
+            self._sets[resource] = pd.Index(self.file[resource]['sets'].asstr()[:])
+        return self._sets[resource]
+
+    def scores(self, resource, sets, obs_names=None):
+        """float32 cells x sets activities, in the order of ``obs_names`` (NaN for unknown cells)"""
+        sets = [sets] if isinstance(sets, str) else list(sets)
+        columns = self.sets(resource).get_indexer(sets)
+        if (columns < 0).any():
+            missing = [s for s, c in zip(sets, columns) if c < 0]
+            raise KeyError(f"Unknown {resource} sets: {', '.join(missing)}")
+        # h5py reads increasing, unique column indices
+        unique, inverse = np.unique(columns, return_inverse=True)
+        with self._lock:
+            values = self.file[resource]['scores'][:, unique].astype(np.float32)[:, inverse]
+        if obs_names is None:
+            return values
+        rows = self.obs_names.get_indexer(pd.Index(obs_names).astype(str))
+        result = np.full((len(rows), len(sets)), np.nan, dtype=np.float32)
+        result[rows >= 0] = values[rows[rows >= 0]]
+        return result
+
+    def summary(self, resource, column, sets=None):
+        """Long DataFrame (set, group, n_cells, mean, std, frac_positive) of a summary column"""
+        group = self.file[resource]['summary'][column]
+        all_sets = self.sets(resource)
+        columns = np.arange(len(all_sets)) if sets is None else all_sets.get_indexer(
+            [sets] if isinstance(sets, str) else list(sets))
+        columns = columns[columns >= 0]
+        groups = group['groups'].asstr()[:]
+        frame = pd.DataFrame({
+            'set': np.repeat(all_sets[columns].to_numpy(), len(groups)),
+            column: np.tile(groups, len(columns)),
+        })
+        for stat in STATISTICS:
+            frame[stat] = group[stat][:][:, columns].T.ravel()
+        return frame
+
+    def activity_adata(self, adata, resource, sets):
+        """AnnData of the activities of ``sets`` in the cells of ``adata``, with its obs and obsm
+
+        The same shape of object as dc.get_acts, ready for sc.pl.umap/violin.
+        """
+        sets = [sets] if isinstance(sets, str) else list(sets)
+        values = self.scores(resource, sets, adata.obs_names)
+        return ad.AnnData(X=values, obs=adata.obs, var=pd.DataFrame(index=pd.Index(sets)), obsm=adata.obsm)
+
+    def close(self):
+        self.file.close()
+
+
+def load_activities(h5ad_path, index_dir=None):
+    """Return the shared ActivityIndex of an .h5ad, or None if missing or stale"""
+    path = activity_path_for(h5ad_path, index_dir)
+    if not path.exists():
+        return None
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    with _LOADED_LOCK:
+        index = _LOADED.get(key)
+        if index is None:
+            index = ActivityIndex(path)
+            _LOADED[key] = index
+    if os.path.exists(h5ad_path):
+        source = _source_signature(h5ad_path)
+        if (index.meta['source_size'], index.meta['source_mtime_ns']) != (source['source_size'],
+                                                                          source['source_mtime_ns']):
+            return None
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute per-cell activities of the bundled gene-set resources")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--output-dir", default=None,
+                        help="Directory for the activities (default: DATASETS_OPTIMIZED_DIR)")
+    parser.add_argument("--resources", nargs="+", default=list(RESOURCES),
+                        help="Resource names in enrichment_sets/ or .rds paths")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default=DEFAULT_DTYPE,
+                        help="Stored precision of the activities")
+    parser.add_argument("--codec", default=DEFAULT_CODEC, help="Compression codec")
+    args = parser.parse_args()
+    build_activities(args.input_file, activity_path_for(args.input_file, args.output_dir), args.resources,
+                     dtype=args.dtype, codec=args.codec)
+
+
+if __name__ == "__main__":
+    main()
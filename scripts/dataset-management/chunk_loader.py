@@ -0,0 +1,232 @@
+"""
+Progressive Chunk Loader for MASLDatlas
+Reads the manifest.json written with the progressive-loading chunks
+(chunking.py) and yields the chunks one by one while a background thread
+prefetches the next ones. CellType/Group predicates skip chunks whose
+recorded counts show none of the wanted cells and filter the rows of the others.
+
+ProgressiveEmbedding runs such a loader in the background and keeps the
+obs and embeddings loaded so far, so the app can draw a first UMAP from the
+first chunk and refine it as the remaining chunks arrive.
+"""
+
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+
+from chunking import chunk_dir_for
+from h5ad_utils import read_elem
+
+DEFAULT_PREFETCH = 2
+
+# One ProgressiveEmbedding per chunk directory and filter, shared by every session
+_PROGRESSIVE = {}
+_PROGRESSIVE_LOCK = threading.Lock()
+
+
+def read_manifest(chunk_dir):
+    """Return the manifest of a chunk directory, with chunk entries for old manifests too"""
+    chunk_dir = Path(chunk_dir)
+    with open(chunk_dir / "manifest.json") as f:
+        manifest = json.load(f)
+    if 'chunks' not in manifest:
+        # Version 1 manifests only list the files
+        chunk_size = manifest['chunk_size']
+        manifest['chunks'] = [
+            {'file': path, 'row_start': i * chunk_size,
+             'row_end': min((i + 1) * chunk_size, manifest['total_cells']), 'counts': {}}
+            for i, path in enumerate(manifest['chunk_files'])
+        ]
+    for entry in manifest['chunks']:
+        # Paths are resolved next to the manifest when the folder was moved
+        path = Path(entry['file'])
+        if not path.exists() and (chunk_dir / path.name).exists():
+            entry['file'] = str(chunk_dir / path.name)
+    return manifest
+
+
+def _normalize_where(where):
+    """{column: set of str values} from {column: value or list of values}"""
+    if not where:
+        return {}
+    return {column: {str(v) for v in ([values] if isinstance(values, str) else values)}
+            for column, values in dict(where).items()}
+
+
+def chunk_may_match(entry, where):
+    """False when the chunk's recorded counts show no cell satisfying every predicate"""
+    counts = entry.get('counts', {})
+    for column, values in where.items():
+        if column in counts and not values.intersection(counts[column]):
+            return False
+    return True
+
+
+def expected_cells(entry, where):
+    """Cells of a chunk expected to satisfy ``where`` (exact for one predicate, an upper bound otherwise)"""
+    n = entry['row_end'] - entry['row_start']
+    counts = entry.get('counts', {})
+    for column, values in where.items():
+        if column in counts:
+            n = min(n, sum(counts[column].get(value, 0) for value in values))
+    return n
+
+
+def _row_mask(obs, where):
+    mask = np.ones(len(obs), dtype=bool)
+    for column, values in where.items():
+        if column in obs.columns:
+            mask &= obs[column].astype(str).isin(values).to_numpy()
+    return mask
+
+
+def read_chunk(entry, where=None, matrices=True):
+    """Read one chunk as AnnData, keeping only the rows that satisfy ``where``
+
+    With matrices=False only obs and obsm are read (enough for embeddings).
+    """
+    where = _normalize_where(where)
+    if matrices:
+        adata = ad.read_h5ad(entry['file'])
+    else:
+        with h5py.File(entry['file'], 'r') as f:
+            obsm = {key: read_elem(f['obsm'][key]) for key in f['obsm'].keys()} if 'obsm' in f else {}
+            adata = ad.AnnData(obs=read_elem(f['obs']), obsm=obsm)
+    if where:
+        mask = _row_mask(adata.obs, where)
+        if not mask.all():
+            adata = adata[mask].copy()
+    return adata
+
+
+def iter_chunks(chunk_dir, where=None, matrices=True, prefetch=DEFAULT_PREFETCH):
+    """Yield (entry, AnnData) for every chunk that may hold matching cells
+
+    A background thread reads up to ``prefetch`` chunks ahead of the consumer.
+    Closing the generator early stops the thread after its current chunk.
+    """
+    manifest = read_manifest(chunk_dir)
+    where = _normalize_where(where)
+    entries = [entry for entry in manifest['chunks'] if chunk_may_match(entry, where)]
+
+    buffer = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for entry in entries:
+                if stop.is_set() or not put((entry, read_chunk(entry, where, matrices))):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    thread = threading.Thread(target=producer, name="chunk-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+class ProgressiveEmbedding:
+    """obs and embeddings of a chunked dataset, filled in by a background loader"""
+
+    def __init__(self, chunk_dir, where=None, prefetch=DEFAULT_PREFETCH):
+        self.chunk_dir = Path(chunk_dir)
+        self.manifest = read_manifest(self.chunk_dir)
+        self.where = _normalize_where(where)
+        self.total_cells = sum(expected_cells(entry, self.where) for entry in self.manifest['chunks'])
+        self.loaded_cells = 0
+        self.n_chunks_loaded = 0
+        self.done = False
+        self.error = None
+        self.started = time.time()
+        self._pieces = []
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._load, args=(prefetch,), name="progressive-embedding",
+                                        daemon=True)
+        self._thread.start()
+
+    def _load(self, prefetch):
+        try:
+            for _, chunk in iter_chunks(self.chunk_dir, self.where, matrices=False, prefetch=prefetch):
+                with self._lock:
+                    self._pieces.append(chunk)
+                    self._snapshot = None
+                    self.loaded_cells += chunk.n_obs
+                    self.n_chunks_loaded += 1
+        except Exception as e:
+            self.error = str(e)
+            print(f"❌ Progressive loading of {self.chunk_dir} failed: {e}")
+        finally:
+            self.done = True
+
+    @property
+    def progress(self):
+        """Fraction of the (matching) cells loaded so far"""
+        if self.done or self.total_cells == 0:
+            return 1.0
+        return min(self.loaded_cells / self.total_cells, 1.0)
+
+    def snapshot(self):
+        """AnnData (obs + obsm, no X) of every cell loaded so far, or None before the first chunk"""
+        with self._lock:
+            if not self._pieces:
+                return None
+            if self._snapshot is None:
+                obs = pd.concat([piece.obs for piece in self._pieces])
+                obsm = {key: np.concatenate([np.asarray(piece.obsm[key]) for piece in self._pieces])
+                        for key in self._pieces[0].obsm.keys()}
+                self._snapshot = ad.AnnData(obs=obs, obsm=obsm)
+            return self._snapshot
+
+    def wait(self, timeout=None):
+        """Block until every chunk is loaded (or the timeout expires); returns self.done"""
+        self._thread.join(timeout)
+        return self.done
+
+
+def progressive_embedding(chunk_dir, where=None, prefetch=DEFAULT_PREFETCH):
+    """Return the shared ProgressiveEmbedding of a chunk directory, starting it on first use"""
+    where = _normalize_where(where)
+    key = (str(Path(chunk_dir).resolve()), tuple(sorted((k, tuple(sorted(v))) for k, v in where.items())))
+    with _PROGRESSIVE_LOCK:
+        loader = _PROGRESSIVE.get(key)
+        if loader is None or loader.error is not None:
+            loader = ProgressiveEmbedding(chunk_dir, where, prefetch)
+            _PROGRESSIVE[key] = loader
+        return loader
+
+
+def open_progressive(h5ad_path, index_dir=None, where=None, prefetch=DEFAULT_PREFETCH):
+    """ProgressiveEmbedding of the chunks of an .h5ad, or None when none were written"""
+    chunk_dir = chunk_dir_for(h5ad_path, index_dir)
+    if not (chunk_dir / "manifest.json").exists():
+        return None
+    return progressive_embedding(chunk_dir, where, prefetch)
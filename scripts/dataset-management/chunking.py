@@ -0,0 +1,200 @@
+"""
+Progressive-loading Chunks for MASLDatlas
+Splits an .h5ad into row chunks written by a process pool straight from the
+HDF5 file, with a choice of compression codec (see h5ad_utils.compression_options).
+Each worker reads obs/var/obsm/uns once and then only the rows of its chunks.
+
+The manifest (<stem>_chunks/manifest.json) records the codec and, for every
+chunk, its row range, file size and CellType/Group counts, so a loader can
+skip chunks that hold none of the cells it needs. ``benchmark_codecs`` writes
+and reads back one chunk per codec to pick the one with the lowest load time.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import anndata as ad
+import h5py
+
+from gene_index import DEFAULT_INDEX_DIR
+from h5ad_utils import (H5adWriter, available_codecs, matrix_elements, read_elem, read_metadata, read_rows,
+                        take_rows)
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_CODEC = 'gzip:4'
+COUNT_COLUMNS = ('CellType', 'Group')
+MANIFEST_VERSION = 2
+
+# Per-process state of pool workers: the open source file and its metadata
+_WORKER = {}
+
+
+def chunk_dir_for(h5ad_path, output_dir=None):
+    """Default location of the chunks of an .h5ad file"""
+    return Path(output_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_chunks"
+
+
+def _init_worker(h5ad_path):
+    f = h5py.File(h5ad_path, 'r')
+    _WORKER.update(file=f, meta=read_metadata(f), elements=list(matrix_elements(f)))
+
+
+def write_chunk(f, meta, elements, out_path, start, end, codec=DEFAULT_CODEC):
+    """Write rows [start, end) of an open h5ad file as a standalone .h5ad"""
+    rows = slice(start, end)
+    writer = H5adWriter(out_path, elements, meta['obs'].iloc[rows], meta['var'],
+                        {key: take_rows(value, rows) for key, value in meta['obsm'].items()},
+                        meta['uns'], meta['varm'], meta['raw_var'], compression=codec)
+    for key, elem in elements:
+        writer.append(key, read_rows(elem, start, end))
+    return writer.close()
+
+
+def _write_chunk_task(out_path, start, end, codec):
+    start_time = time.time()
+    write_chunk(_WORKER['file'], _WORKER['meta'], _WORKER['elements'], out_path, start, end, codec)
+    return time.time() - start_time
+
+
+def _value_counts(obs, start, end):
+    """{column: {value: n_cells}} of the CellType/Group columns of a row range"""
+    counts = {}
+    for column in COUNT_COLUMNS:
+        if column in obs.columns:
+            values = obs[column].iloc[start:end].astype(str).value_counts()
+            counts[column] = {str(k): int(v) for k, v in values.items()}
+    return counts
+
+
+def chunk_entry(path, start, end, obs):
+    """Manifest entry of one chunk file"""
+    return {
+        'file': str(path),
+        'row_start': int(start),
+        'row_end': int(end),
+        'n_cells': int(end - start),
+        'bytes': os.path.getsize(path),
+        'counts': _value_counts(obs, start, end),
+    }
+
+
+def write_manifest(chunk_dir, h5ad_path, n_obs, n_vars, chunk_size, codec, entries):
+    """Write manifest.json; byte ranges are offsets in the concatenation of the chunk files"""
+    offset = 0
+    for entry in entries:
+        entry['byte_range'] = [offset, offset + entry['bytes']]
+        offset += entry['bytes']
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'original_file': str(h5ad_path),
+        'total_cells': int(n_obs),
+        'total_genes': int(n_vars),
+        'chunk_size': int(chunk_size),
+        'n_chunks': len(entries),
+        'codec': str(codec),
+        'total_bytes': offset,
+        'chunk_files': [entry['file'] for entry in entries],
+        'chunks': entries,
+    }
+    manifest_file = Path(chunk_dir) / "manifest.json"
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_file
+
+
+def write_chunks(h5ad_path, chunk_dir, chunk_size=DEFAULT_CHUNK_SIZE, codec=DEFAULT_CODEC, workers=None):
+    """Write every chunk of an .h5ad on a process pool and return the chunk directory"""
+    h5ad_path = Path(h5ad_path)
+    chunk_dir = Path(chunk_dir)
+    chunk_dir.mkdir(parents=True, exist_ok=True)
+    workers = workers or min(os.cpu_count() or 1, 8)
+
+    with h5py.File(h5ad_path, 'r') as f:
+        obs = read_elem(f['obs'])
+        n_vars = len(read_elem(f['var']))
+    n_obs = len(obs)
+    ranges = [(start, min(start + chunk_size, n_obs)) for start in range(0, n_obs, chunk_size)]
+    paths = [chunk_dir / f"chunk_{i:03d}.h5ad" for i in range(len(ranges))]
+
+    print(f"📦 Writing {len(ranges)} chunks of {chunk_size:,} cells with codec '{codec}' on {workers} workers...")
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(str(h5ad_path),)) as pool:
+        futures = [pool.submit(_write_chunk_task, path, start, end, codec)
+                   for path, (start, end) in zip(paths, ranges)]
+        for i, future in enumerate(futures):
+            seconds = future.result()
+            print(f"📦 Chunk {i+1}/{len(ranges)}: {ranges[i][1] - ranges[i][0]} cells saved to {paths[i]} "
+                  f"({seconds:.1f}s)")
+
+    entries = [chunk_entry(path, start, end, obs) for path, (start, end) in zip(paths, ranges)]
+    write_manifest(chunk_dir, h5ad_path, n_obs, n_vars, chunk_size, codec, entries)
+    print(f"✅ {len(ranges)} chunks written in {time.time() - start_time:.1f} seconds "
+          f"({sum(e['bytes'] for e in entries) / (1024**2):.1f} MB)")
+    return chunk_dir
+
+
+def benchmark_codecs(h5ad_path, output_dir, codecs=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write and read back the first chunk of a dataset with each codec
+
+    Returns one dict per codec with write and read times (seconds) and file
+    size (bytes), sorted by read time: the app's load latency.
+    """
+    h5ad_path = Path(h5ad_path)
+    codecs = list(codecs or available_codecs())
+    work_dir = Path(output_dir) / f"{h5ad_path.stem}_codec_benchmark"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    try:
+        with h5py.File(h5ad_path, 'r') as f:
+            meta = read_metadata(f)
+            elements = list(matrix_elements(f))
+            end = min(chunk_size, len(meta['obs']))
+            for codec in codecs:
+                out_path = work_dir / f"chunk_{codec.replace(':', '')}.h5ad"
+                start_time = time.time()
+                write_chunk(f, meta, elements, out_path, 0, end, codec)
+                write_time = time.time() - start_time
+                start_time = time.time()
+                ad.read_h5ad(out_path)
+                read_time = time.time() - start_time
+                results.append({'codec': codec, 'write_seconds': write_time, 'read_seconds': read_time,
+                                'bytes': out_path.stat().st_size})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results.sort(key=lambda r: r['read_seconds'])
+    print(f"⏱️  Codec benchmark on {end:,} cells of {h5ad_path.name}:")
+    print(f"   {'codec':<8} {'write (s)':>10} {'read (s)':>10} {'size (MB)':>10}")
+    for r in results:
+        print(f"   {r['codec']:<8} {r['write_seconds']:>10.2f} {r['read_seconds']:>10.2f} "
+              f"{r['bytes'] / (1024**2):>10.1f}")
+    print(f"✅ Fastest to load: {results[0]['codec']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write progressive-loading chunks of an .h5ad")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--output-dir", default=DEFAULT_INDEX_DIR, help="Directory for the chunk folder")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="Cells per chunk")
+    parser.add_argument("--codec", default=DEFAULT_CODEC,
+                        help=f"Compression codec ({', '.join(available_codecs())})")
+    parser.add_argument("--workers", type=int, default=None, help="Writer processes")
+    parser.add_argument("--benchmark", action="store_true", help="Compare codecs instead of writing chunks")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_codecs(args.input_file, args.output_dir, chunk_size=args.chunk_size)
+    else:
+        write_chunks(args.input_file, chunk_dir_for(args.input_file, args.output_dir), args.chunk_size,
+                     args.codec, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Co-expression Neighbor Index for MASLDatlas
+Precomputes, for every gene, its top-k correlated genes over the whole dataset
+and within each CellType, so "Find Correlated Genes" on a known gene is a
+lookup instead of a live correlation over all genes.
+
+Correlations come from the gene x gene Gram matrix X^T X, computed one block of
+genes at a time (sparse x sparse products), so memory stays bounded by
+n_genes x block_genes. Spearman uses the sparsity-preserving ranks of
+correlation_engine. BH q-values are computed over all genes at build time.
+
+Index layout (<stem>_coexpression/):
+    index.json                              k, methods, scopes and source signature
+    var_names.npy
+    <method>/<scope id>_neighbors.npy       (n_genes, k) int32 gene positions
+    <method>/<scope id>_corr.npy            (n_genes, k) float32 correlations
+    <method>/<scope id>_bh.npy              (n_genes, k) float32 BH q-values
+"""
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from correlation_engine import column_moments, correlation_pvalues, sparse_column_ranks
+from gene_index import DEFAULT_INDEX_DIR
+from lazy_loader import expression_matrix
+
+INDEX_VERSION = 1
+DEFAULT_K = 100
+DEFAULT_METHODS = ('pearson', 'spearman')
+ALL_CELLS_SCOPE = 'all'
+
+_OPEN_INDEXES = {}
+_OPEN_LOCK = threading.Lock()
+
+
+def coexpression_index_path_for(h5ad_path, index_dir=None):
+    """Default location of the co-expression index of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_coexpression"
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def _valid_genes(moments, n):
+    """Genes with non-zero variance"""
+    sums, sumsq = moments
+    return (sumsq - sums * (sums / n)) > 0
+
+
+def top_k_block(X, k, block_genes=512, moments=None):
+    """Yield (start, neighbors, corr, bh) for blocks of query genes
+
+    ``X`` is a cells x genes matrix. For each query gene in the block the k
+    genes with the largest absolute correlation are returned, best first.
+    """
+    # float64 products: the mean correction below cancels most of the Gram entries
+    if sp.issparse(X):
+        X = X.tocsc().astype(np.float64)
+        Xt = X.T.tocsr()
+    else:
+        X = np.asarray(X, dtype=np.float64)
+        Xt = X.T
+    n, n_genes = X.shape
+    k = min(k, n_genes)
+    sums, sumsq = moments if moments is not None else column_moments(X)
+    means = sums / n
+    ss = np.maximum(sumsq - sums * means, 0.0)
+    valid = _valid_genes((sums, sumsq), n)
+    n_valid = int(valid.sum())
+    norms = np.sqrt(np.where(valid, ss, np.nan))
+
+    for start in range(0, n_genes, block_genes):
+        end = min(start + block_genes, n_genes)
+        gram = Xt @ X[:, start:end]
+        gram = gram.toarray() if sp.issparse(gram) else np.asarray(gram)
+        cov = gram - n * np.outer(means, means[start:end])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = (cov / np.outer(norms, norms[start:end])).astype(np.float32)
+        np.clip(r, -1.0, 1.0, out=r)
+
+        # |r| with invalid genes last; sorting the whole column gives BH over all tests
+        strength = np.where(np.isnan(r), -1.0, np.abs(r)).astype(np.float32)
+        order = np.argsort(-strength, axis=0, kind='stable')
+        top = order[:k]
+
+        bh = np.full((k, end - start), np.nan, dtype=np.float32)
+        if n_valid > 0:
+            ranked = np.take_along_axis(strength, order[:n_valid], axis=0)
+            p = correlation_pvalues(ranked, n)
+            q = p * n_valid / np.arange(1, n_valid + 1)[:, None]
+            q = np.minimum.accumulate(q[::-1], axis=0)[::-1]
+            bh[:min(k, n_valid)] = np.minimum(1.0, q[:k])
+
+        corr = np.take_along_axis(r, top, axis=0)
+        # Query genes with no variance have no neighbors
+        corr[:, ~valid[start:end]] = np.nan
+        bh[:, ~valid[start:end]] = np.nan
+        yield start, top.T.astype(np.int32), corr.T, bh.T
+
+
+def _scope_id(position):
+    return f"s{position:03d}"
+
+
+def build_coexpression_index(adata, out_dir, source_path=None, k=DEFAULT_K, methods=DEFAULT_METHODS,
+                             group_key='CellType', min_cells=50, layer=None, block_genes=512):
+    """Build the top-k co-expression index of an AnnData (whole dataset + each group)"""
+    out_dir = Path(out_dir)
+    tmp_dir = out_dir.with_name(out_dir.name + '.building')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    print(f"🔗 Building co-expression index (top {k}, {', '.join(methods)})...")
+    start_time = time.time()
+    X = expression_matrix(adata, layer)
+    X = X.tocsr() if sp.issparse(X) else np.asarray(X)
+
+    scopes = [(ALL_CELLS_SCOPE, None)]
+    if group_key in adata.obs.columns:
+        groups = adata.obs[group_key].astype(str).to_numpy()
+        for group in sorted(set(groups)):
+            rows = np.flatnonzero(groups == group)
+            if len(rows) >= min_cells:
+                scopes.append((group, rows))
+            else:
+                print(f"   ⏭️  {group}: only {len(rows)} cells")
+
+    meta = {'version': INDEX_VERSION, 'k': int(min(k, adata.n_vars)), 'methods': list(methods),
+            'group_key': group_key, 'layer': layer, 'n_vars': int(adata.n_vars), 'scopes': {}}
+    if source_path is not None:
+        meta.update({'source': str(source_path), **_source_signature(source_path)})
+    np.save(tmp_dir / 'var_names.npy', np.asarray(adata.var_names.astype(str), dtype=str))
+
+    for position, (scope, rows) in enumerate(scopes):
+        scope_start = time.time()
+        X_scope = X if rows is None else X[rows]
+        scope_info = {'id': _scope_id(position), 'n_cells': int(X_scope.shape[0])}
+        for method in methods:
+            matrix = X_scope if method == 'pearson' else sparse_column_ranks(X_scope)
+            moments = column_moments(matrix)
+            scope_info[f'n_valid_{method}'] = int(_valid_genes(moments, matrix.shape[0]).sum())
+
+            method_dir = tmp_dir / method
+            method_dir.mkdir(exist_ok=True)
+            shape = (adata.n_vars, meta['k'])
+            outputs = {
+                name: np.lib.format.open_memmap(method_dir / f"{scope_info['id']}_{name}.npy",
+                                                mode='w+', dtype=dtype, shape=shape)
+                for name, dtype in (('neighbors', np.int32), ('corr', np.float32), ('bh', np.float32))
+            }
+            for start, neighbors, corr, bh in top_k_block(matrix, meta['k'], block_genes, moments):
+                end = start + len(neighbors)
+                outputs['neighbors'][start:end] = neighbors
+                outputs['corr'][start:end] = corr
+                outputs['bh'][start:end] = bh
+            for array in outputs.values():
+                array.flush()
+            del outputs
+        meta['scopes'][scope] = scope_info
+        print(f"   ✅ {scope}: {scope_info['n_cells']:,} cells in {time.time() - scope_start:.1f} seconds")
+
+    with open(tmp_dir / 'index.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+    print(f"✅ Co-expression index saved in {time.time() - start_time:.1f} seconds: {out_dir}")
+    return out_dir
+
+
+class CoexpressionIndex:
+    """Read-only, memory-mapped top-k co-expression index"""
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / 'index.json', 'r') as f:
+            self.meta = json.load(f)
+        self.var_names = pd.Index(np.load(self.index_dir / 'var_names.npy').astype(object))
+        self._arrays = {}
+        self._lock = threading.Lock()
+
+    @property
+    def scopes(self):
+        return list(self.meta['scopes'].keys())
+
+    def _scope_arrays(self, method, scope):
+        key = (method, scope)
+        with self._lock:
+            if key not in self._arrays:
+                scope_id = self.meta['scopes'][scope]['id']
+                method_dir = self.index_dir / method
+                self._arrays[key] = tuple(np.load(method_dir / f"{scope_id}_{name}.npy", mmap_mode='r')
+                                          for name in ('neighbors', 'corr', 'bh'))
+            return self._arrays[key]
+
+    def has(self, method, scope):
+        return method in self.meta['methods'] and scope in self.meta['scopes']
+
+    def top_correlated(self, gene, method='pearson', scope=ALL_CELLS_SCOPE, k=None):
+        """Top correlated genes of a gene, in the column layout of correlation_engine.correlate_gene"""
+        method = method.lower()
+        if not self.has(method, scope):
+            raise KeyError(f"No {method} neighbors for scope '{scope}'")
+        position = self.var_names.get_loc(gene)
+        neighbors, corr, bh = self._scope_arrays(method, scope)
+        k = self.meta['k'] if k is None else min(k, self.meta['k'])
+        r = np.asarray(corr[position, :k], dtype=np.float64)
+        keep = ~np.isnan(r)
+        info = self.meta['scopes'][scope]
+        p = correlation_pvalues(r[keep], info['n_cells'])
+        return pd.DataFrame({
+            'Gene': np.asarray(self.var_names[np.asarray(neighbors[position, :k])[keep]], dtype=str),
+            'Correlation': r[keep],
+            'p-val': p,
+            'Bonferroni_p_value': np.minimum(1.0, p * info[f'n_valid_{method}']),
+            'BH_p_value': np.asarray(bh[position, :k], dtype=np.float64)[keep],
+        })
+
+
+def open_coexpression_index(h5ad_path, index_dir=None):
+    """Return the shared index of an .h5ad if it exists and matches the file, else None"""
+    path = coexpression_index_path_for(h5ad_path, index_dir)
+    if not (path / 'index.json').exists():
+        return None
+    key = str(path.resolve())
+    with _OPEN_LOCK:
+        index = _OPEN_INDEXES.get(key)
+        if index is None:
+            index = CoexpressionIndex(path)
+            _OPEN_INDEXES[key] = index
+    if index.meta.get('version') != INDEX_VERSION:
+        return None
+    if os.path.exists(h5ad_path):
+        signature = _source_signature(h5ad_path)
+        if any(index.meta.get(k) != v for k, v in signature.items()):
+            return None
+    return index
+
+
+def lookup(h5ad_path, gene, method='pearson', scope=ALL_CELLS_SCOPE, n_cells=None):
+    """Precomputed neighbors of a gene, or None when the index cannot answer
+
+    ``n_cells`` guards against answering for a different cell set (e.g. a
+    subsampled version of the dataset) than the one the index was built on.
+    """
+    index = open_coexpression_index(h5ad_path)
+    method = method.lower()
+    if index is None or not index.has(method, scope) or gene not in index.var_names:
+        return None
+    if n_cells is not None and int(n_cells) != index.meta['scopes'][scope]['n_cells']:
+        return None
+    return index.top_correlated(gene, method, scope)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the co-expression neighbor index of a dataset")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--output-dir", default=DEFAULT_INDEX_DIR, help="Directory for the index")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_K, help="Neighbors kept per gene")
+    parser.add_argument("--methods", nargs="+", choices=list(DEFAULT_METHODS), default=list(DEFAULT_METHODS))
+    parser.add_argument("--min-cells", type=int, default=50, help="Smallest CellType given its own neighbors")
+
+    args = parser.parse_args()
+
+    import scanpy as sc
+    adata = sc.read_h5ad(args.input_file)
+    build_coexpression_index(adata, coexpression_index_path_for(args.input_file, args.output_dir),
+                             source_path=args.input_file, k=args.top_k, methods=args.methods,
+                             min_cells=args.min_cells)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""
+Local Compute Service for MASLDatlas
+Runs DESeq2 and rank_genes_groups jobs on a process pool outside the Shiny R
+process, so a fit no longer blocks the R session of every user on that
+worker. The app submits a job over a Unix socket, gets a job ID back and polls
+its status from an invalidateLater loop; queued jobs can be cancelled.
+
+The pool is sized to the host: ``workers`` jobs run at once and each one gets
+``cores // workers`` threads, which is what pydeseq2 is told to use
+(``n_cpus`` or ``DefaultInference(n_cpus=...)`` depending on its version) and
+what the BLAS thread pools of the workers are limited to. At most
+``max_pending`` jobs are queued or running; further submissions are refused
+with QueueFull until some finish.
+
+rank_genes_groups jobs are handed the source .h5ad and the row positions of
+the contrast's cells (source_rows) rather than the cells themselves, so the
+session never writes them out; the worker reads those rows from the file.
+
+Results of jobs submitted with a ``cache_key`` are also stored in the shared
+result cache (result_cache.py), so they outlive the session that asked for them.
+
+Usage:
+    python compute_service.py serve [--socket PATH] [--workers N] [--max-pending N]
+    python compute_service.py status [--socket PATH]
+"""
+
+import argparse
+import inspect
+import os
+import signal
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+DEFAULT_SOCKET = os.environ.get('COMPUTE_SERVICE_SOCKET', '/tmp/masldatlas-compute.sock')
+# Shared secret of the service and its clients, generated per deployment by startup.sh
+DEFAULT_AUTHKEY = os.environ.get('COMPUTE_SERVICE_AUTHKEY', '').encode() or None
+DEFAULT_THREADS_PER_JOB = 4
+DEFAULT_MAX_PENDING = int(os.environ.get('COMPUTE_SERVICE_MAX_PENDING', 16))
+# Finished jobs whose result was never fetched are dropped after this many seconds
+RESULT_TTL = 3600
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+_SOURCE_INDEXES = {}
+_SOURCE_INDEXES_LOCK = threading.Lock()
+
+
+class QueueFull(RuntimeError):
+    """The service already holds max_pending queued or running jobs"""
+
+
+class JobNotFound(KeyError):
+    """Unknown job ID, or a result that was already fetched or expired"""
+
+
+def pool_layout(workers=None, cores=None):
+    """(concurrent jobs, threads per job) for a host with ``cores`` CPUs"""
+    cores = cores or os.cpu_count() or 1
+    if not workers:
+        workers = max(1, cores // DEFAULT_THREADS_PER_JOB)
+    workers = max(1, min(int(workers), cores))
+    return workers, max(1, cores // workers)
+
+
+def _init_worker(threads):
+    # Workers are spawned, so numpy/BLAS are imported after these are set
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+
+
+def _parallelism(cls, n_cpus):
+    """Keyword arguments giving a pydeseq2 class ``n_cpus`` threads, whatever its version"""
+    parameters = inspect.signature(cls).parameters
+    if 'inference' in parameters:
+        try:
+            from pydeseq2.default_inference import DefaultInference
+            return {'inference': DefaultInference(n_cpus=n_cpus)}
+        except ImportError:
+            pass
+    if 'n_cpus' in parameters:
+        return {'n_cpus': n_cpus}
+    return {}
+
+
+def run_deseq2(pdata, n_cpus=1, design_factor='ident', ref_level='Reference', test_level='Selection'):
+    """DESeq2 results table of pseudobulk profiles, Selection vs Reference"""
+    from pydeseq2.dds import DeseqDataSet
+    from pydeseq2.ds import DeseqStats
+
+    n_cpus = int(n_cpus)
+    dds = DeseqDataSet(adata=pdata, design_factors=design_factor, ref_level=[design_factor, ref_level],
+                       refit_cooks=True, **_parallelism(DeseqDataSet, n_cpus))
+    dds.deseq2()
+    stat_res = DeseqStats(dds, contrast=[design_factor, test_level, ref_level], **_parallelism(DeseqStats, n_cpus))
+    stat_res.summary()
+    return stat_res.results_df
+
+
+def _source_index(h5ad_path):
+    """(obs_names, var_names, raw var_names or None) of an .h5ad, cached per file version"""
+    import h5py
+    import pandas as pd
+
+    from h5ad_utils import read_elem
+
+    stat = os.stat(h5ad_path)
+    key, version = str(Path(h5ad_path).resolve()), (stat.st_size, stat.st_mtime_ns)
+    with _SOURCE_INDEXES_LOCK:
+        cached = _SOURCE_INDEXES.get(key)
+        if cached is None or cached[0] != version:
+            def index_of(group):
+                return pd.Index(read_elem(group[group.attrs.get('_index', '_index')])).astype(str)
+
+            with h5py.File(h5ad_path, 'r') as f:
+                raw_var = index_of(f['raw/var']) if 'raw' in f and 'var' in f['raw'] else None
+                cached = (version, (index_of(f['obs']), index_of(f['var']), raw_var))
+            _SOURCE_INDEXES[key] = cached
+        return cached[1]
+
+
+def source_rows(adata, h5ad_path):
+    """(source .h5ad, row positions) of the cells of ``adata``, or None
+
+    The source is the file ``adata`` was opened from (lazy datasets and
+    dataset stores record it) or else ``h5ad_path``. None when the cells are
+    not rows of that file with the same genes, e.g. for a separately
+    written optimized file, and the analysis has to run in the session.
+    """
+    from h5ad_utils import SOURCE_KEY
+    from lazy_loader import LAZY_SOURCE_KEY
+
+    h5ad_path = adata.uns.get(LAZY_SOURCE_KEY) or adata.uns.get(SOURCE_KEY) or h5ad_path
+    if not h5ad_path or not os.path.exists(h5ad_path):
+        return None
+    obs_names, var_names, raw_var_names = _source_index(h5ad_path)
+    if not adata.var_names.equals(var_names):
+        return None
+    if adata.raw is not None and (raw_var_names is None or not adata.raw.var_names.equals(raw_var_names)):
+        return None
+    if not obs_names.is_unique:
+        return None
+    rows = obs_names.get_indexer(adata.obs_names)
+    if (rows < 0).any():
+        return None
+    return str(h5ad_path), rows
+
+
+def run_rank_genes_groups(h5ad_path, rows, labels, groupby, groups, reference, method, use_raw=False,
+                          key_added='rank_genes_groups', n_cpus=1, **kwargs):
+    """uns[key_added] of sc.tl.rank_genes_groups on rows of an .h5ad
+
+    ``rows`` are sorted row positions and ``labels`` the ``groupby`` value of
+    each; with ``use_raw`` the rows are read from raw/X, as scanpy would test.
+    """
+    import anndata as ad
+    import h5py
+    import pandas as pd
+    import scanpy as sc
+
+    from group_stats import rank_genes_groups
+    from h5ad_utils import read_elem, read_row_subset
+
+    sc.settings.n_jobs = int(n_cpus)
+    prefix = 'raw/' if use_raw else ''
+    with h5py.File(h5ad_path, 'r') as f:
+        X = read_row_subset(f[prefix + 'X'], rows)
+        var = read_elem(f[prefix + 'var'])
+    obs = pd.DataFrame({groupby: labels}, index=pd.RangeIndex(len(rows)).astype(str))
+    adata = ad.AnnData(X=X, obs=obs, var=var)
+    rank_genes_groups(adata, groupby, groups=groups, reference=reference, method=method, use_raw=False,
+                      key_added=key_added, n_jobs=int(n_cpus), **kwargs)
+    result = adata.uns[key_added]
+    result['params']['use_raw'] = use_raw
+    return result
+
+
+JOBS = {
+    'deseq2': run_deseq2,
+    'rank_genes_groups': run_rank_genes_groups,
+}
+
+
+def _run_job(kind, payload, n_cpus):
+    return JOBS[kind](n_cpus=n_cpus, **payload)
+
+
+class ComputeService:
+    def __init__(self, workers=None, max_pending=DEFAULT_MAX_PENDING, result_ttl=RESULT_TTL):
+        self.workers, self.threads_per_job = pool_layout(workers)
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'),
+                                        initializer=_init_worker, initargs=(self.threads_per_job,))
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job['finished'] and now - job['finished'] > self.result_ttl]:
+            del self.jobs[job_id]
+
+    def _active(self):
+        return [job for job in self.jobs.values() if not job['finished']]
+
+    def submit(self, kind, payload, cache_key=None):
+        """Queue a job and return its ID"""
+        if kind not in JOBS:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        with self.lock:
+            self._purge()
+            if len(self._active()) >= self.max_pending:
+                raise QueueFull(f"{self.max_pending} jobs already queued or running")
+            job = {'id': uuid.uuid4().hex, 'kind': kind, 'status': 'queued', 'submitted': time.time(),
+                   'finished': None, 'error': None, 'result': None, 'cache_key': cache_key}
+            job['future'] = self.pool.submit(_run_job, kind, payload, self.threads_per_job)
+            self.jobs[job['id']] = job
+        job['future'].add_done_callback(lambda future: self._finish(job, future))
+        return job['id']
+
+    def _finish(self, job, future):
+        try:
+            result = future.result()
+        except CancelledError:
+            status, result, error = 'cancelled', None, None
+        except Exception as e:
+            status, result, error = 'error', None, f"{type(e).__name__}: {e}"
+        else:
+            status, error = 'done', None
+            if job['cache_key']:
+                try:
+                    from result_cache import default_cache
+                    default_cache().put(job['cache_key'], result)
+                except Exception as e:
+                    print(f"⚠️  Failed to cache the result of job {job['id']}: {e}")
+        with self.lock:
+            if job['finished']:
+                return
+            if job['status'] == 'cancelled':
+                # Cancelled while running: the result is discarded
+                result, status = None, 'cancelled'
+            job.update(status=status, result=result, error=error, finished=time.time())
+
+    def _job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise JobNotFound(job_id)
+        return job
+
+    def status(self, job_id):
+        """{'id', 'kind', 'status', 'position', 'elapsed', 'error'} of a job
+
+        status is queued, running, done, error or cancelled; position is the
+        number of queued jobs ahead of a queued one.
+        """
+        with self.lock:
+            job = self._job(job_id)
+            status, position = job['status'], None
+            if status == 'queued':
+                if job['future'].running():
+                    status = 'running'
+                else:
+                    position = sum(1 for other in self._active()
+                                   if other['submitted'] < job['submitted'] and not other['future'].running())
+            end = job['finished'] or time.time()
+            return {'id': job_id, 'kind': job['kind'], 'status': status, 'position': position,
+                    'elapsed': end - job['submitted'], 'error': job['error']}
+
+    def result(self, job_id):
+        """Return the result of a finished job and forget the job"""
+        with self.lock:
+            job = self._job(job_id)
+            if job['status'] == 'error':
+                del self.jobs[job_id]
+                raise RuntimeError(job['error'])
+            if job['status'] != 'done':
+                raise JobNotFound(f"Job {job_id} is {job['status']}")
+            del self.jobs[job_id]
+            return job['result']
+
+    def cancel(self, job_id):
+        """Cancel a job; True when it was still queued and will never run
+
+        A running job cannot be interrupted: it runs to the end and its
+        result is dropped.
+        """
+        with self.lock:
+            job = self._job(job_id)
+            if job['finished']:
+                return False
+            job['status'] = 'cancelled'
+        # Cancelling a queued future runs _finish on this thread, which takes the lock
+        return job['future'].cancel()
+
+    def stats(self):
+        with self.lock:
+            active = self._active()
+            running = sum(1 for job in active if job['future'].running())
+            return {'workers': self.workers, 'threads_per_job': self.threads_per_job,
+                    'max_pending': self.max_pending, 'running': running, 'queued': len(active) - running,
+                    'finished': len(self.jobs) - len(active)}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+ERRORS = {'QueueFull': QueueFull, 'JobNotFound': JobNotFound, 'ValueError': ValueError}
+
+
+def _handle(service, conn):
+    with conn:
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                return
+            op = request.pop('op', None)
+            try:
+                if op not in ('submit', 'status', 'result', 'cancel', 'stats'):
+                    raise ValueError(f"Unknown operation '{op}'")
+                reply = {'ok': True, 'value': getattr(service, op)(**request)}
+            except Exception as e:
+                reply = {'ok': False, 'error': type(e).__name__, 'message': str(e)}
+            conn.send(reply)
+
+
+def serve(socket_path=DEFAULT_SOCKET, workers=None, max_pending=DEFAULT_MAX_PENDING, authkey=DEFAULT_AUTHKEY):
+    """Run a ComputeService behind a Unix socket until interrupted"""
+    if not authkey:
+        raise ValueError("No authentication key: set COMPUTE_SERVICE_AUTHKEY")
+    service = ComputeService(workers, max_pending)
+    Path(socket_path).unlink(missing_ok=True)
+    listener = Listener(socket_path, family='AF_UNIX', authkey=authkey)
+    os.chmod(socket_path, 0o600)
+    print(f"🧵 Compute service on {socket_path}: {service.workers} workers × {service.threads_per_job} threads, "
+          f"up to {max_pending} pending jobs")
+    signal.signal(signal.SIGTERM, lambda *_: listener.close())
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError:
+                # Listener closed by SIGTERM
+                break
+            except Exception as e:
+                # Failed authentication or a client that went away
+                print(f"⚠️  Rejected connection: {e}")
+                continue
+            threading.Thread(target=_handle, args=(service, conn), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        Path(socket_path).unlink(missing_ok=True)
+        service.shutdown()
+        print("🛑 Compute service stopped")
+
+
+class ComputeClient:
+    """Client of a compute service listening on a Unix socket"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, authkey=DEFAULT_AUTHKEY):
+        self.socket_path = str(socket_path)
+        self.authkey = authkey
+
+    def _call(self, op, **kwargs):
+        with Client(self.socket_path, family='AF_UNIX', authkey=self.authkey) as conn:
+            conn.send({'op': op, **kwargs})
+            reply = conn.recv()
+        if not reply['ok']:
+            raise ERRORS.get(reply['error'], RuntimeError)(reply['message'])
+        return reply['value']
+
+    def submit(self, kind, payload, cache_key=None):
+        return self._call('submit', kind=kind, payload=payload, cache_key=cache_key)
+
+    def status(self, job_id):
+        return self._call('status', job_id=job_id)
+
+    def result(self, job_id):
+        return self._call('result', job_id=job_id)
+
+    def cancel(self, job_id):
+        return self._call('cancel', job_id=job_id)
+
+    def stats(self):
+        return self._call('stats')
+
+    def submit_deseq2(self, pdata, cache_key=None, **kwargs):
+        """Queue DESeq2 on filtered pseudobulk profiles (sent over the socket; they are small)"""
+        return self.submit('deseq2', {'pdata': pdata, **kwargs}, cache_key)
+
+    def submit_rank_genes_groups(self, adata, source, groupby, groups, reference, method, cache_key=None,
+                                 key_added='rank_genes_groups', **kwargs):
+        """Queue rank_genes_groups on the cells of ``adata``
+
+        ``source`` is the (h5ad_path, rows) of those cells from source_rows;
+        only the row positions and ``groupby`` labels are sent, the worker
+        reads the matrix from the file.
+        """
+        import numpy as np
+        import pandas as pd
+
+        from h5ad_utils import index_dtype_for
+
+        h5ad_path, rows = source
+        rows = np.asarray(rows)
+        order = np.argsort(rows, kind='stable')
+        labels = pd.Categorical(adata.obs[groupby].astype(str).to_numpy()[order])
+        payload = {'h5ad_path': h5ad_path, 'rows': rows[order].astype(index_dtype_for(rows.max(initial=0) + 1)),
+                   'labels': labels, 'groupby': groupby, 'groups': list(groups), 'reference': reference,
+                   'method': method, 'use_raw': adata.raw is not None, 'key_added': key_added, **kwargs}
+        return self.submit('rank_genes_groups', payload, cache_key)
+
+    def rank_genes_groups_result(self, job_id, adata, key_added='rank_genes_groups'):
+        """Store the result of a rank_genes_groups job in adata.uns and return adata (a new view for subset views)"""
+        from subset_index import with_uns
+
+        return with_uns(adata, key_added, self.result(job_id))
+
+
+def connect(socket_path=DEFAULT_SOCKET, authkey=DEFAULT_AUTHKEY):
+    """ComputeClient of a running service, or None when no service answers on the socket"""
+    if not authkey or not os.path.exists(socket_path):
+        return None
+    client = ComputeClient(socket_path, authkey)
+    try:
+        client.stats()
+    except Exception:
+        return None
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local compute service for DESeq2 and rank_genes_groups jobs")
+    parser.add_argument("action", choices=["serve", "status"], help="Run the service or show its load")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('COMPUTE_SERVICE_WORKERS', 0)) or None,
+                        help=f"Concurrent jobs (default: cores // {DEFAULT_THREADS_PER_JOB})")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING,
+                        help="Maximum queued + running jobs")
+    args = parser.parse_args()
+
+    if args.action == "serve":
+        if not DEFAULT_AUTHKEY:
+            print("❌ COMPUTE_SERVICE_AUTHKEY is not set; refusing to serve without an authentication key")
+            return 1
+        serve(args.socket, args.workers, args.max_pending)
+    else:
+        client = connect(args.socket)
+        if client is None:
+            print(f"❌ No compute service on {args.socket}")
+            return 1
+        for key, value in client.stats().items():
+            print(f"   {key}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
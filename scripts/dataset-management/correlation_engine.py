@@ -0,0 +1,303 @@
+"""
+Gene Correlation Engine for MASLDatlas
+Correlates one gene against every gene of a (sparse) expression matrix in a
+single matrix-vector pass, without densifying the matrix.
+
+Pearson uses X^T (y - mean(y)) together with per-gene sums and sums of
+squares. Spearman replaces each gene column by its average ranks shifted so
+that zeros map to 0, which keeps the sparsity pattern, and then runs the same
+Pearson pass. p-values use the t approximation (as cor.test does for large or
+tied samples) and multiple-testing corrections are vectorized.
+
+Per-gene moments and Spearman ranks of a dataset are kept for the last few
+AnnData objects, so repeated queries on the same selection only pay for the
+matrix-vector product.
+"""
+
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.special import stdtr
+from scipy.stats import rankdata
+
+from lazy_loader import expression_matrix
+
+DEFAULT_BLOCK_ITEMS = 16 * 1024 * 1024
+PREPARED_CACHE_SIZE = 4
+
+_PREPARED = OrderedDict()
+_PREPARED_LOCK = threading.Lock()
+
+
+def _as_supported(X):
+    """Return X as a CSR/CSC matrix or a 2-D float ndarray"""
+    if sp.issparse(X):
+        return X if X.format in ('csr', 'csc') else X.tocsr()
+    return np.asarray(X)
+
+
+def _column_ids(X, lo, hi):
+    """Column of each stored value in [lo, hi) of a CSR or CSC matrix"""
+    if X.format == 'csr':
+        return X.indices[lo:hi]
+    return np.searchsorted(X.indptr, np.arange(lo, hi), side='right') - 1
+
+
+def column_moments(X, block_items=DEFAULT_BLOCK_ITEMS):
+    """Per-column sums and sums of squares (float64), in bounded-memory blocks"""
+    X = _as_supported(X)
+    n_cols = X.shape[1]
+    if not sp.issparse(X):
+        sums = np.zeros(n_cols)
+        sumsq = np.zeros(n_cols)
+        step = max(1, block_items // max(n_cols, 1))
+        for start in range(0, X.shape[0], step):
+            block = X[start:start + step].astype(np.float64)
+            sums += block.sum(axis=0)
+            sumsq += (block * block).sum(axis=0)
+        return sums, sumsq
+
+    sums = np.zeros(n_cols)
+    sumsq = np.zeros(n_cols)
+    nnz = X.nnz
+    for lo in range(0, nnz, block_items):
+        hi = min(lo + block_items, nnz)
+        cols = _column_ids(X, lo, hi)
+        values = X.data[lo:hi].astype(np.float64)
+        sums += np.bincount(cols, weights=values, minlength=n_cols)
+        sumsq += np.bincount(cols, weights=values * values, minlength=n_cols)
+    return sums, sumsq
+
+
+def pearson_against(X, y, block_items=DEFAULT_BLOCK_ITEMS, moments=None):
+    """Pearson correlation of every column of X with the vector y
+
+    Columns (or y) with zero variance get NaN, like cor() in R. ``moments``
+    may pass precomputed column_moments(X).
+    """
+    X = _as_supported(X)
+    y = np.asarray(y, dtype=np.float64).ravel()
+    n = X.shape[0]
+    if len(y) != n:
+        raise ValueError(f"Vector has {len(y)} values for {n} cells")
+
+    centered = y - y.mean()
+    # sum_i x_ij (y_i - mean(y)) is already the centered cross product
+    cross = np.asarray(X.T @ centered, dtype=np.float64).ravel()
+    sums, sumsq = moments if moments is not None else column_moments(X, block_items)
+    ss_x = np.maximum(sumsq - sums * sums / n, 0.0)
+    ss_y = float(centered @ centered)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = cross / np.sqrt(ss_x * ss_y)
+    r[(ss_x <= 0) | (ss_y <= 0)] = np.nan
+    return np.clip(r, -1.0, 1.0)
+
+
+def _value_codes(values):
+    """Order-preserving 32-bit integer codes of values (equal codes for equal values)"""
+    if values.dtype != np.float32:
+        if np.issubdtype(values.dtype, np.integer) and (len(values) == 0 or
+                                                        np.abs(values).max() < 2 ** 24):
+            values = values.astype(np.float32)
+        else:
+            # Dense ranks of the distinct values
+            return np.unique(values, return_inverse=True)[1].ravel().astype(np.uint64)
+    bits = values.view(np.uint32).astype(np.uint64)
+    # Flip negative floats entirely and set the sign bit of positive ones
+    return np.where(bits >> np.uint64(31), bits ^ np.uint64(0xFFFFFFFF), bits | np.uint64(0x80000000))
+
+
+def sparse_column_ranks(X, block_items=DEFAULT_BLOCK_ITEMS):
+    """Average ranks of each column, shifted so that zeros have rank 0
+
+    Shifting a column does not change its correlations, and with zeros mapped
+    to 0 the result has the same sparsity pattern as X. Returns a CSC matrix
+    (float32 while ranks stay exact in it) or an ndarray for dense input.
+    """
+    X = _as_supported(X)
+    n = X.shape[0]
+    if not sp.issparse(X):
+        return rankdata(X, axis=0)
+
+    X = X.tocsc()
+    X.sort_indices()
+    n_cols = X.shape[1]
+    # Half-integer ranks up to 2^23 are exact in float32
+    out = np.zeros(X.nnz, dtype=np.float32 if n < 2 ** 23 else np.float64)
+    indptr = X.indptr
+
+    col_start = 0
+    while col_start < n_cols:
+        # Take as many whole columns as fit in the block
+        col_end = int(np.searchsorted(indptr, indptr[col_start] + block_items, side='right')) - 1
+        col_end = min(max(col_end, col_start + 1), n_cols)
+        lo, hi = int(indptr[col_start]), int(indptr[col_end])
+        if hi > lo:
+            counts = np.diff(indptr[col_start:col_end + 1])
+            cols = np.repeat(np.arange(col_end - col_start, dtype=np.uint64), counts)
+            # One argsort of an exact (column, value) integer key; much faster
+            # than np.lexsort on tens of millions of entries
+            key = (cols << np.uint64(32)) | _value_codes(X.data[lo:hi])
+            order = np.argsort(key)
+            key = key[order]
+            v = X.data[lo:hi][order].astype(np.float64)
+            c = cols[order].astype(np.int64)
+
+            # Average rank among the stored values of the column (1-based)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            new_group = np.ones(len(v), dtype=bool)
+            new_group[1:] = key[1:] != key[:-1]
+            group_id = np.cumsum(new_group) - 1
+            group_first = np.flatnonzero(new_group)
+            group_last = np.append(group_first[1:], len(v)) - 1
+            stored_rank = (group_first[group_id] + group_last[group_id]) / 2.0 - starts[c] + 1
+
+            # Place the implicit zeros between negative and positive values
+            negatives = np.bincount(c, weights=(v < 0), minlength=len(counts))
+            stored_zeros = np.bincount(c, weights=(v == 0), minlength=len(counts))
+            implicit = n - counts
+            zeros = implicit + stored_zeros
+            rank = stored_rank + np.where(v > 0, implicit[c], 0)
+            shifted = rank - (negatives[c] + (zeros[c] + 1) / 2.0)
+            shifted[v == 0] = 0.0
+
+            block = np.empty_like(shifted)
+            block[order] = shifted
+            out[lo:hi] = block
+        col_start = col_end
+
+    return sp.csc_matrix((out, X.indices, X.indptr), shape=X.shape)
+
+
+def spearman_against(X, y, block_items=DEFAULT_BLOCK_ITEMS, ranks=None, moments=None):
+    """Spearman correlation of every column of X with the vector y
+
+    ``ranks`` and ``moments`` may pass precomputed sparse_column_ranks(X) and
+    its column_moments.
+    """
+    if ranks is None:
+        ranks = sparse_column_ranks(X, block_items)
+    y_ranks = rankdata(np.asarray(y, dtype=np.float64).ravel())
+    return pearson_against(ranks, y_ranks, block_items, moments)
+
+
+def correlation_pvalues(r, n):
+    """Two-sided p-values of correlation coefficients from the t distribution (df = n - 2)"""
+    r = np.asarray(r, dtype=np.float64)
+    df = n - 2
+    if df <= 0:
+        return np.full(r.shape, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(df / (1.0 - r * r))
+    p = 2.0 * stdtr(df, -np.abs(t))
+    p[np.abs(r) >= 1.0] = 0.0
+    p[np.isnan(r)] = np.nan
+    return p
+
+
+def adjust_bonferroni(p):
+    """Bonferroni correction; NaN p-values are kept and not counted as tests"""
+    p = np.asarray(p, dtype=np.float64)
+    m = np.count_nonzero(~np.isnan(p))
+    return np.minimum(1.0, p * m)
+
+
+def adjust_bh(p):
+    """Benjamini-Hochberg FDR correction (same as p.adjust(method = "BH") in R)"""
+    p = np.asarray(p, dtype=np.float64)
+    adjusted = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    m = len(valid)
+    if m == 0:
+        return adjusted
+    order = valid[np.argsort(p[valid])[::-1]]
+    ranks = np.arange(m, 0, -1)
+    adjusted[order] = np.minimum(1.0, np.minimum.accumulate(p[order] * m / ranks))
+    return adjusted
+
+
+def correlate_vector(X, y, method='pearson', block_items=DEFAULT_BLOCK_ITEMS):
+    """Return (r, p) of every column of X against y"""
+    method = method.lower()
+    if method == 'pearson':
+        r = pearson_against(X, y, block_items)
+    elif method == 'spearman':
+        r = spearman_against(X, y, block_items)
+    else:
+        raise ValueError(f"Unknown correlation method '{method}'")
+    return r, correlation_pvalues(r, X.shape[0])
+
+
+class _PreparedMatrix:
+    """Expression matrix of an AnnData with its moments and (on demand) Spearman ranks"""
+
+    def __init__(self, adata, layer, block_items):
+        self.ref = weakref.ref(adata)
+        self.block_items = block_items
+        self.lock = threading.Lock()
+        self.X = _as_supported(expression_matrix(adata, layer))
+        self.moments = column_moments(self.X, block_items)
+        self._ranks = None
+
+    def ranks(self):
+        with self.lock:
+            if self._ranks is None:
+                ranks = sparse_column_ranks(self.X, self.block_items)
+                self._ranks = (ranks, column_moments(ranks, self.block_items))
+            return self._ranks
+
+
+def _prepared(adata, layer, block_items):
+    """Return the cached _PreparedMatrix of an AnnData, building it on first use"""
+    key = (id(adata), layer)
+    with _PREPARED_LOCK:
+        entry = _PREPARED.get(key)
+        # id() values are reused after garbage collection, so check the object itself
+        if entry is not None and entry.ref() is adata:
+            _PREPARED.move_to_end(key)
+            return entry
+    entry = _PreparedMatrix(adata, layer, block_items)
+    with _PREPARED_LOCK:
+        _PREPARED[key] = entry
+        while len(_PREPARED) > PREPARED_CACHE_SIZE:
+            _PREPARED.popitem(last=False)
+    return entry
+
+
+def correlate_gene(adata, gene, method='pearson', layer=None, block_items=DEFAULT_BLOCK_ITEMS):
+    """Correlate one gene with every gene of an AnnData (X by default)
+
+    Returns a DataFrame with Gene, Correlation, p-val, Bonferroni_p_value and
+    BH_p_value, sorted by decreasing absolute correlation.
+    """
+    method = method.lower()
+    if method not in ('pearson', 'spearman'):
+        raise ValueError(f"Unknown correlation method '{method}'")
+    prepared = _prepared(adata, layer, block_items)
+    X = prepared.X
+    positions = np.flatnonzero(np.asarray(adata.var_names) == gene)
+    if len(positions) == 0:
+        raise KeyError(f"Gene '{gene}' not found")
+    y = X[:, positions[0]]
+    y = y.toarray().ravel() if sp.issparse(y) else np.asarray(y).ravel()
+
+    if method == 'pearson':
+        r = pearson_against(X, y, block_items, prepared.moments)
+    else:
+        ranks, rank_moments = prepared.ranks()
+        r = spearman_against(X, y, block_items, ranks, rank_moments)
+    p = correlation_pvalues(r, X.shape[0])
+    result = pd.DataFrame({
+        'Gene': np.asarray(adata.var_names, dtype=str),
+        'Correlation': r,
+        'p-val': p,
+        'Bonferroni_p_value': adjust_bonferroni(p),
+        'BH_p_value': adjust_bh(p),
+    })
+    order = np.argsort(-np.nan_to_num(np.abs(r), nan=-1.0), kind='stable')
+    return result.iloc[order].reset_index(drop=True)
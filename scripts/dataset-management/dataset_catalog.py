@@ -0,0 +1,265 @@
+"""
+Dataset Catalog for MASLDatlas
+Collects the metadata the app needs before a dataset is loaded (cell and
+gene counts, gene names, levels and cell counts of the categorical obs
+columns such as CellType and Group, available layers and embeddings, and
+checksums) into one compact JSON index, datasets/catalog.json. Only obs, var
+and the shapes of the matrices are read from each .h5ad.
+
+The catalog is refreshed incrementally: entries whose file size and
+modification time are unchanged are kept as they are.
+
+Catalog layout:
+    {"version": 1, "datasets": {<species>: {<dataset>: entry}}}
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from h5ad_utils import matrix_shape, read_elem
+
+CATALOG_VERSION = 1
+DEFAULT_CATALOG = os.path.join(os.environ.get('DATASETS_DIR', 'datasets'), 'catalog.json')
+# Categorical obs columns with more levels (cell barcodes, ...) are not listed
+MAX_LEVELS = 1000
+
+_LOADED = {}
+_LOADED_LOCK = threading.Lock()
+
+
+def _file_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'size_bytes': stat.st_size, 'mtime': stat.st_mtime, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _categories(obs, max_levels=MAX_LEVELS):
+    """{column: {'levels': [...], 'counts': [...]}} of the categorical and string obs columns"""
+    categories = {}
+    for column in obs.columns:
+        values = obs[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+                continue
+            values = values.astype('category')
+        if len(values.cat.categories) > max_levels:
+            continue
+        codes = values.cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+        categories[str(column)] = {'levels': [str(level) for level in values.cat.categories],
+                                   'counts': counts.tolist()}
+    return categories
+
+
+def describe_h5ad(h5ad_path, max_levels=MAX_LEVELS):
+    """Catalog entry of an .h5ad file, read from obs, var and the matrix shapes only"""
+    with h5py.File(h5ad_path, 'r') as f:
+        obs = read_elem(f['obs'])
+        var = read_elem(f['var'])
+        entry = {
+            'n_obs': len(obs),
+            'n_vars': len(var),
+            'var_names': var.index.astype(str).tolist(),
+            'obs_columns': [str(column) for column in obs.columns],
+            'categories': _categories(obs, max_levels),
+            'layers': sorted(f['layers'].keys()) if 'layers' in f else [],
+            'obsm': {name: list(f['obsm'][name].shape) for name in f['obsm'].keys()
+                     if isinstance(f['obsm'][name], h5py.Dataset)} if 'obsm' in f else {},
+            'raw_n_vars': matrix_shape(f['raw']['X'])[1] if 'raw' in f and 'X' in f['raw'] else None,
+        }
+    entry.update(_file_signature(h5ad_path))
+    return entry
+
+
+def is_entry_current(entry, h5ad_path):
+    """True when a catalog entry describes the current content of its file"""
+    try:
+        signature = _file_signature(h5ad_path)
+    except OSError:
+        return False
+    return bool(entry) and all(entry.get(field) == signature[field] for field in ('size_bytes', 'mtime_ns'))
+
+
+def _checksums(h5ad_path, expected, compute=False):
+    """Known digests of a file: the downloader's cached MD5/SHA256 and the expected MD5 of the sources"""
+    checksums = {'expected_md5': (expected or {}).get('md5')}
+    try:
+        from download_datasets import ChecksumCache, hash_file_range, new_hash
+    except ImportError:
+        return checksums
+    cache = ChecksumCache(Path(h5ad_path).parent.parent / '.checksum_cache.json')
+    for hash_type in ('md5', 'sha256'):
+        checksums[hash_type] = cache.lookup(h5ad_path, hash_type)
+    if compute and checksums['md5'] is None:
+        checksums['md5'] = hash_file_range(new_hash('md5'), h5ad_path).hexdigest()
+    return checksums
+
+
+def _describe_task(task):
+    species, dataset_id, h5ad_path, expected, compute_checksums = task
+    try:
+        entry = describe_h5ad(h5ad_path)
+    except (OSError, KeyError, ValueError) as e:
+        return species, dataset_id, None, str(e)
+    entry['path'] = str(h5ad_path)
+    entry['checksums'] = _checksums(h5ad_path, expected, compute_checksums)
+    return species, dataset_id, entry, None
+
+
+def read_catalog(catalog_path=DEFAULT_CATALOG):
+    """The catalog as a dict, or an empty catalog when it is missing or unreadable"""
+    try:
+        with open(catalog_path, 'r') as f:
+            catalog = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {'version': CATALOG_VERSION, 'datasets': {}}
+    if catalog.get('version') != CATALOG_VERSION:
+        return {'version': CATALOG_VERSION, 'datasets': {}}
+    return catalog
+
+
+def write_catalog(catalog, catalog_path=DEFAULT_CATALOG):
+    """Atomically write a catalog (compact JSON)"""
+    catalog_path = Path(catalog_path)
+    catalog_path.parent.mkdir(parents=True, exist_ok=True)
+    catalog['version'] = CATALOG_VERSION
+    catalog['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+    tmp_path = catalog_path.with_name(catalog_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(catalog, f, separators=(',', ':'))
+    os.replace(tmp_path, catalog_path)
+    return catalog_path
+
+
+def _load_config(name, config_file=None):
+    if config_file is None:
+        config_file = f"config/{name}"
+        # If running from scripts/dataset-management/, adjust the path
+        if not os.path.exists(config_file):
+            config_file = f"../../config/{name}"
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+
+def configured_datasets(datasets_dir='datasets', config_file=None, sources_file=None):
+    """(species, dataset, .h5ad path, sources entry) of every configured dataset"""
+    config = _load_config('datasets_config.json', config_file)
+    try:
+        sources = _load_config('datasets_sources.json', sources_file).get('datasets', {})
+    except (OSError, json.JSONDecodeError):
+        sources = {}
+    entries = []
+    for species, info in config.items():
+        for dataset_id in info.get('Datasets', []):
+            expected = sources.get(species, {}).get(dataset_id)
+            entries.append((species, dataset_id, Path(datasets_dir) / species / f"{dataset_id}.h5ad", expected))
+    return entries
+
+
+def update_catalog(entries, catalog_path=DEFAULT_CATALOG, force=False, checksums=False, workers=None):
+    """Describe new or changed datasets and write the catalog; returns it
+
+    ``entries`` are (species, dataset, .h5ad path, sources entry) tuples;
+    other datasets of the catalog are kept. Datasets whose file is missing
+    are dropped from the catalog.
+    """
+    catalog = read_catalog(catalog_path)
+    datasets = {species: dict(items) for species, items in catalog['datasets'].items()}
+    tasks = []
+    for species, dataset_id, h5ad_path, expected in entries:
+        if not Path(h5ad_path).exists():
+            datasets.get(species, {}).pop(dataset_id, None)
+            print(f"⏭️  {species}/{dataset_id}: not downloaded")
+            continue
+        current = datasets.get(species, {}).get(dataset_id)
+        if not force and is_entry_current(current, h5ad_path):
+            continue
+        tasks.append((species, dataset_id, str(h5ad_path), expected, checksums))
+
+    start_time = time.time()
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks) or 1))
+    if workers == 1:
+        results = [_describe_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_describe_task, tasks))
+    for species, dataset_id, entry, error in results:
+        if entry is None:
+            print(f"❌ {species}/{dataset_id}: {error}")
+            continue
+        datasets.setdefault(species, {})[dataset_id] = entry
+        print(f"✅ {species}/{dataset_id}: {entry['n_obs']:,} cells × {entry['n_vars']:,} genes")
+
+    catalog['datasets'] = {species: items for species, items in datasets.items() if items}
+    write_catalog(catalog, catalog_path)
+    n_entries = sum(len(species) for species in catalog['datasets'].values())
+    print(f"📇 Catalog of {n_entries} datasets ({len(tasks)} described in {time.time() - start_time:.1f} seconds): "
+          f"{catalog_path}")
+    return catalog
+
+
+def load_catalog(catalog_path=DEFAULT_CATALOG):
+    """The shared, parsed catalog; reread when the file changes"""
+    try:
+        key = (str(Path(catalog_path).resolve()), os.stat(catalog_path).st_mtime_ns)
+    except OSError:
+        return read_catalog(catalog_path)
+    with _LOADED_LOCK:
+        catalog = _LOADED.get(key)
+        if catalog is None:
+            _LOADED.clear()
+            catalog = _LOADED[key] = read_catalog(catalog_path)
+        return catalog
+
+
+def catalog_entry(species, dataset_id, datasets_dir='datasets', catalog_path=DEFAULT_CATALOG):
+    """Catalog entry of a dataset, or None when it is missing or its file changed since"""
+    entry = load_catalog(catalog_path)['datasets'].get(species, {}).get(dataset_id)
+    if entry is None or not is_entry_current(entry, Path(datasets_dir) / species / f"{dataset_id}.h5ad"):
+        return None
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Catalog of dataset metadata for MASLDatlas")
+    parser.add_argument("action", choices=["build", "show"], help="Action to perform")
+    parser.add_argument("--datasets-dir", default=os.environ.get('DATASETS_DIR', 'datasets'),
+                        help="Datasets directory path")
+    parser.add_argument("--catalog", default=None, help="Catalog file (default: <datasets dir>/catalog.json)")
+    parser.add_argument("--config", default=None, help="datasets_config.json path")
+    parser.add_argument("--checksums", action="store_true", help="Compute MD5 checksums that are not cached yet")
+    parser.add_argument("--workers", type=int, default=None, help="Files described in parallel (default: CPUs)")
+    parser.add_argument("--force", action="store_true", help="Describe datasets that are up to date")
+    args = parser.parse_args()
+    catalog_path = args.catalog or os.path.join(args.datasets_dir, 'catalog.json')
+
+    if args.action == "build":
+        update_catalog(configured_datasets(args.datasets_dir, args.config), catalog_path, args.force,
+                       args.checksums, args.workers)
+    elif args.action == "show":
+        catalog = read_catalog(catalog_path)
+        if not catalog['datasets']:
+            print(f"❌ No catalog at {catalog_path}")
+            sys.exit(1)
+        for species, datasets in catalog['datasets'].items():
+            print(f"\n🧬 {species}:")
+            for dataset_id, entry in datasets.items():
+                print(f"   • {dataset_id}: {entry['n_obs']:,} cells × {entry['n_vars']:,} genes, "
+                      f"layers: {', '.join(entry['layers']) or 'none'}")
+                for column in ('CellType', 'Group'):
+                    levels = entry['categories'].get(column, {}).get('levels', [])
+                    if levels:
+                        print(f"     {column}: {len(levels)} levels")
+
+
+if __name__ == "__main__":
+    main()
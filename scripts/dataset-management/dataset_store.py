@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped Dataset Store for MASLDatlas
+Converts each .h5ad once into a directory of .npy files (CSR/dense matrices,
+columnar obs/var, obsm embeddings) that every Shiny session and worker opens
+with np.load(mmap_mode='r'). All processes then share the same pages through
+the OS page cache instead of each holding a private copy of the AnnData.
+
+Store layout (<DATASET_STORE_DIR>/<Species>/<dataset>/):
+    store.json              shapes, formats, column descriptions, source signature
+    X/, layers/<n>/, raw/X/ data.npy + indices.npy + indptr.npy (sparse) or dense.npy
+    obs/, var/, raw/var/    _index.npy + one .npy (or codes + categories) per column
+    obsm/<key>.npy          embeddings
+    uns.h5                  unstructured annotations
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from h5ad_utils import (SOURCE_KEY, copy_dataset_to_npy, index_dtype_for, matrix_format, matrix_shape,
+                        read_elem, write_elem)
+
+STORE_VERSION = 1
+DEFAULT_STORE_DIR = os.environ.get('DATASET_STORE_DIR', os.path.join('datasets', '.store'))
+
+# Memory maps opened by this process, shared by every AnnData built from a store
+_OPEN_STORES = {}
+_OPEN_LOCK = threading.Lock()
+
+
+def store_path_for(organism, dataset_id, store_dir=None):
+    """Return the store directory of a dataset"""
+    return Path(store_dir or DEFAULT_STORE_DIR) / organism / dataset_id
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def read_store_meta(store_path):
+    """Return the store.json description of a store, or None if it is missing"""
+    meta_file = Path(store_path) / 'store.json'
+    if not meta_file.exists():
+        return None
+    with open(meta_file, 'r') as f:
+        return json.load(f)
+
+
+def is_store_current(store_path, h5ad_path=None):
+    """Check that a store exists and was built from the current version of its source"""
+    meta = read_store_meta(store_path)
+    if meta is None or meta.get('version') != STORE_VERSION:
+        return False
+    if h5ad_path is None or not os.path.exists(h5ad_path):
+        return True
+    signature = _source_signature(h5ad_path)
+    return all(meta.get(key) == value for key, value in signature.items())
+
+
+# ----------------------------------------------------------------------------
+# Conversion
+# ----------------------------------------------------------------------------
+
+def _write_frame(df, out_dir):
+    """Write a dataframe column by column; returns the column descriptions"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    np.save(out_dir / '_index.npy', np.asarray(df.index.astype(str), dtype=str))
+
+    columns = []
+    for i, (name, col) in enumerate(df.items()):
+        stem = f"{i:04d}"
+        entry = {'name': str(name), 'file': stem}
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            categories = col.cat.categories
+            if pd.api.types.is_numeric_dtype(categories.dtype):
+                categories = categories.to_numpy()
+            else:
+                categories = np.asarray(categories.astype(str), dtype=str)
+            np.save(out_dir / f"{stem}.codes.npy", col.cat.codes.to_numpy())
+            np.save(out_dir / f"{stem}.categories.npy", categories)
+            entry.update(kind='categorical', ordered=bool(col.cat.ordered))
+        elif (pd.api.types.is_numeric_dtype(col.dtype) or pd.api.types.is_bool_dtype(col.dtype)) \
+                and not pd.api.types.is_extension_array_dtype(col.dtype):
+            np.save(out_dir / f"{stem}.npy", col.to_numpy())
+            entry.update(kind='numeric')
+        else:
+            # Strings and nullable columns are stored dictionary-encoded
+            as_cat = col.astype(str).astype('category')
+            np.save(out_dir / f"{stem}.codes.npy", as_cat.cat.codes.to_numpy())
+            np.save(out_dir / f"{stem}.categories.npy", np.asarray(as_cat.cat.categories, dtype=str))
+            entry.update(kind='string')
+        columns.append(entry)
+    return columns
+
+
+def _write_matrix(elem, out_dir):
+    """Copy a matrix element into .npy files; returns its description"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fmt = matrix_format(elem)
+    shape = matrix_shape(elem)
+
+    if fmt == 'dense':
+        copy_dataset_to_npy(elem, out_dir / 'dense.npy')
+        return {'format': 'dense', 'shape': list(shape), 'dtype': str(elem.dtype)}
+
+    nnz = elem['data'].shape[0]
+    # scipy uses one dtype for indices and indptr; store them that way so it never copies
+    idx_dtype = index_dtype_for(max(nnz, *shape))
+    copy_dataset_to_npy(elem['data'], out_dir / 'data.npy')
+    copy_dataset_to_npy(elem['indices'], out_dir / 'indices.npy', dtype=idx_dtype)
+    copy_dataset_to_npy(elem['indptr'], out_dir / 'indptr.npy', dtype=idx_dtype)
+    return {'format': fmt, 'shape': list(shape), 'dtype': str(elem['data'].dtype), 'nnz': int(nnz)}
+
+
+def build_store(h5ad_path, store_path, include_raw=True):
+    """Convert an .h5ad file into a memory-mapped store directory"""
+    h5ad_path = Path(h5ad_path)
+    store_path = Path(store_path)
+    tmp_path = store_path.with_name(store_path.name + '.building')
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    print(f"🏗️  Building dataset store for {h5ad_path}")
+    start_time = time.time()
+
+    meta = {'version': STORE_VERSION, 'source': str(h5ad_path), **_source_signature(h5ad_path),
+            'matrices': {}, 'obsm': [], 'frames': {}}
+
+    with h5py.File(h5ad_path, 'r') as f:
+        for key in ('obs', 'var'):
+            meta['frames'][key] = _write_frame(read_elem(f[key]), tmp_path / key)
+
+        matrix_keys = []
+        if 'X' in f:
+            matrix_keys.append('X')
+        if 'layers' in f:
+            matrix_keys += [f'layers/{name}' for name in f['layers'].keys()]
+        if include_raw and 'raw' in f and 'X' in f['raw']:
+            matrix_keys.append('raw/X')
+            meta['frames']['raw/var'] = _write_frame(read_elem(f['raw']['var']), tmp_path / 'raw' / 'var')
+
+        for key in matrix_keys:
+            print(f"   📦 {key}")
+            meta['matrices'][key] = _write_matrix(f[key], tmp_path / key)
+
+        if 'obsm' in f:
+            (tmp_path / 'obsm').mkdir()
+            for i, key in enumerate(f['obsm'].keys()):
+                elem = f['obsm'][key]
+                if not isinstance(elem, h5py.Dataset):
+                    print(f"   ⏭️  Skipping non-array obsm['{key}']")
+                    continue
+                copy_dataset_to_npy(elem, tmp_path / 'obsm' / f"{i:04d}.npy")
+                meta['obsm'].append({'name': key, 'file': f"{i:04d}"})
+
+        if 'uns' in f:
+            with h5py.File(tmp_path / 'uns.h5', 'w') as uns_file:
+                write_elem(uns_file, 'uns', read_elem(f['uns']))
+
+        meta['n_obs'] = len(np.load(tmp_path / 'obs' / '_index.npy', mmap_mode='r'))
+        meta['n_vars'] = len(np.load(tmp_path / 'var' / '_index.npy', mmap_mode='r'))
+
+    # store.json is written last: a store without it is incomplete
+    with open(tmp_path / 'store.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if store_path.exists():
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+    print(f"✅ Store built in {time.time() - start_time:.1f} seconds: {store_path}")
+    return store_path
+
+
+# ----------------------------------------------------------------------------
+# Opening
+# ----------------------------------------------------------------------------
+
+def _load(path):
+    return np.load(path, mmap_mode='r')
+
+
+def _read_frame(frame_dir, columns):
+    index = pd.Index(_load(frame_dir / '_index.npy').astype(object))
+    data = {}
+    for entry in columns:
+        stem = frame_dir / entry['file']
+        if entry['kind'] == 'numeric':
+            data[entry['name']] = np.asarray(_load(f"{stem}.npy"))
+        else:
+            codes = np.asarray(_load(f"{stem}.codes.npy"))
+            categories = np.asarray(_load(f"{stem}.categories.npy"))
+            if categories.dtype.kind == 'U':
+                categories = categories.astype(object)
+            values = pd.Categorical.from_codes(codes, categories=categories,
+                                               ordered=entry.get('ordered', False))
+            data[entry['name']] = values if entry['kind'] == 'categorical' else np.asarray(values, dtype=object)
+    return pd.DataFrame(data, index=index, columns=[entry['name'] for entry in columns])
+
+
+def _open_matrix(matrix_dir, info):
+    shape = tuple(info['shape'])
+    if info['format'] == 'dense':
+        return _load(matrix_dir / 'dense.npy')
+    arrays = (_load(matrix_dir / 'data.npy'), _load(matrix_dir / 'indices.npy'), _load(matrix_dir / 'indptr.npy'))
+    matrix_class = sp.csr_matrix if info['format'] == 'csr' else sp.csc_matrix
+    return matrix_class(arrays, shape=shape, copy=False)
+
+
+def _open_arrays(store_path):
+    """Open (once per process) the memory maps and small tables of a store"""
+    key = str(Path(store_path).resolve())
+    with _OPEN_LOCK:
+        cached = _OPEN_STORES.get(key)
+        meta = read_store_meta(store_path)
+        if meta is None:
+            raise FileNotFoundError(f"No dataset store at {store_path}")
+        if cached is not None and cached['meta'] == meta:
+            return cached
+
+        store_path = Path(store_path)
+        cached = {
+            'meta': meta,
+            'frames': {name: _read_frame(store_path / name, columns)
+                       for name, columns in meta['frames'].items()},
+            'matrices': {name: _open_matrix(store_path / name, info)
+                         for name, info in meta['matrices'].items()},
+            'obsm': {entry['name']: _load(store_path / 'obsm' / f"{entry['file']}.npy")
+                     for entry in meta['obsm']},
+        }
+        _OPEN_STORES[key] = cached
+        return cached
+
+
+def open_store(store_path, layers=None, include_raw=True):
+    """Open a store as an AnnData backed by shared, read-only memory maps
+
+    Opening only maps the files; expression values are paged in on access. Each
+    call returns a new AnnData (own obs/var/uns) so sessions can annotate their
+    object without affecting each other, while the matrices are shared.
+    ``layers`` restricts which layers are attached (default: all).
+    """
+    store_path = Path(store_path)
+    arrays = _open_arrays(store_path)
+    matrices = arrays['matrices']
+
+    layer_names = [name.split('/', 1)[1] for name in matrices if name.startswith('layers/')]
+    if layers is not None:
+        layer_names = [name for name in layer_names if name in set(layers)]
+
+    adata = ad.AnnData(
+        X=matrices.get('X'),
+        obs=arrays['frames']['obs'].copy(),
+        var=arrays['frames']['var'].copy(),
+        obsm=dict(arrays['obsm']),
+        layers={name: matrices[f'layers/{name}'] for name in layer_names},
+    )
+
+    uns_file = store_path / 'uns.h5'
+    if uns_file.exists():
+        with h5py.File(uns_file, 'r') as f:
+            adata.uns = read_elem(f['uns'])
+    # Lets gene_view find the gene-major index of the source file
+    adata.uns[SOURCE_KEY] = arrays['meta']['source']
+
+    if include_raw and 'raw/X' in matrices:
+        adata.raw = ad.AnnData(X=matrices['raw/X'], var=arrays['frames']['raw/var'].copy())
+
+    return adata
+
+
+def open_dataset(organism, dataset_id, store_dir=None, datasets_dir='datasets', **kwargs):
+    """Open the store of a dataset if it is current, else return None"""
+    store_path = store_path_for(organism, dataset_id, store_dir)
+    h5ad_path = Path(datasets_dir) / organism / f"{dataset_id}.h5ad"
+    if not is_store_current(store_path, h5ad_path):
+        return None
+    return open_store(store_path, **kwargs)
+
+
+# ----------------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------------
+
+def _load_datasets_config(config_file=None):
+    if config_file is None:
+        config_file = "config/datasets_config.json"
+        # If running from scripts/dataset-management/, adjust the path
+        if not os.path.exists(config_file):
+            config_file = "../../config/datasets_config.json"
+    with open(config_file, 'r') as f:
+        return json.load(f)
+
+
+def build_all(datasets_dir='datasets', store_dir=None, species_filter=None, force=False, config_file=None):
+    """Build (or refresh) the store of every available dataset"""
+    config = _load_datasets_config(config_file)
+    built, failed = 0, 0
+    for species, info in config.items():
+        if species_filter and species not in species_filter:
+            continue
+        for dataset_id in info.get('Datasets', []):
+            h5ad_path = Path(datasets_dir) / species / f"{dataset_id}.h5ad"
+            store_path = store_path_for(species, dataset_id, store_dir)
+            if not h5ad_path.exists():
+                print(f"⏭️  {species}/{dataset_id}: not downloaded")
+                continue
+            if not force and is_store_current(store_path, h5ad_path):
+                print(f"✅ {species}/{dataset_id}: store is up to date")
+                continue
+            try:
+                build_store(h5ad_path, store_path)
+                built += 1
+            except Exception as e:
+                print(f"❌ {species}/{dataset_id}: store build failed: {e}")
+                failed += 1
+    print(f"📊 Stores built: {built}, failed: {failed}")
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory-mapped dataset store for MASLDatlas")
+    parser.add_argument("action", choices=["build", "build-file", "info"], help="Action to perform")
+    parser.add_argument("path", nargs="?", help="Input .h5ad (build-file) or store directory (info)")
+    parser.add_argument("--store", default=None, help="Output store directory (build-file)")
+    parser.add_argument("--species", nargs="+", help="Filter by species (build)")
+    parser.add_argument("--datasets-dir", default=os.environ.get('DATASETS_DIR', 'datasets'),
+                        help="Datasets directory path")
+    parser.add_argument("--store-dir", default=None, help=f"Store root (default: {DEFAULT_STORE_DIR})")
+    parser.add_argument("--config", default=None, help="datasets_config.json path")
+    parser.add_argument("--force", action="store_true", help="Rebuild stores that are up to date")
+
+    args = parser.parse_args()
+
+    if args.action == "build":
+        sys.exit(0 if build_all(args.datasets_dir, args.store_dir, args.species, args.force, args.config) else 1)
+    elif args.action == "build-file":
+        if not args.path:
+            parser.error("build-file needs an input .h5ad path")
+        store = args.store or Path(args.path).with_suffix('.store')
+        build_store(args.path, store)
+    elif args.action == "info":
+        if not args.path:
+            parser.error("info needs a store directory")
+        meta = read_store_meta(args.path)
+        if meta is None:
+            print(f"❌ No store at {args.path}")
+            sys.exit(1)
+        print(f"📁 {args.path}: {meta['n_obs']:,} cells × {meta['n_vars']:,} genes")
+        for name, info in meta['matrices'].items():
+            print(f"   • {name}: {info['format']} {info['dtype']}")
+        print(f"   • obsm: {', '.join(entry['name'] for entry in meta['obsm'])}")
+
+
+if __name__ == "__main__":
+    main()
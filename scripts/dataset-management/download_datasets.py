@@ -9,13 +9,278 @@ import os
 import sys
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import argparse
 
+HASH_BUFFER_SIZE = 4 * 1024 * 1024  # 4 MB reads when hashing files on disk
+
+
+class RangeNotHonoured(IOError):
+    """The server answered a byte-range request with something other than the range"""
+
+
+def new_hash(hash_type='md5'):
+    """Create a hashlib object for a supported checksum type (MD5 or SHA256)"""
+    if hash_type.lower() == 'md5':
+        return hashlib.md5()
+    elif hash_type.lower() == 'sha256':
+        return hashlib.sha256()
+    raise ValueError(f"Unsupported hash type: {hash_type}")
+
+
+def hash_file_range(hash_obj, file_path, start=0, end=None):
+    """Feed bytes [start, end) of a file into hash_obj using large buffers"""
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    remaining = None if end is None else end - start
+    with open(file_path, 'rb', buffering=0) as f:
+        f.seek(start)
+        while remaining is None or remaining > 0:
+            to_read = HASH_BUFFER_SIZE if remaining is None else min(HASH_BUFFER_SIZE, remaining)
+            n_read = f.readinto(view[:to_read])
+            if not n_read:
+                break
+            hash_obj.update(view[:n_read])
+            if remaining is not None:
+                remaining -= n_read
+    return hash_obj
+
+
+class StreamingHasher:
+    """Hash a file while it is being written, in file order
+
+    Bytes written at the current hash offset are hashed as they arrive. Bytes
+    written further ahead (parallel byte ranges) are hashed from disk by
+    ``finish`` once the download is complete, while they are still in the
+    page cache.
+    """
+
+    def __init__(self, hash_type='md5'):
+        self.hash_obj = new_hash(hash_type)
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def update_at(self, offset, data):
+        """Hash data written at offset if it directly follows what was already hashed"""
+        with self.lock:
+            if offset != self.offset:
+                return False
+            self.hash_obj.update(data)
+            self.offset += len(data)
+            return True
+
+    def catch_up(self, file_path, end):
+        """Hash bytes [offset, end) from disk"""
+        with self.lock:
+            if end is not None and end <= self.offset:
+                return
+            start = self.offset
+            hash_file_range(self.hash_obj, file_path, start, end)
+            self.offset = Path(file_path).stat().st_size if end is None else end
+
+    def finish(self, file_path, end=None):
+        """Hash whatever was not seen in order and return the hex digest"""
+        self.catch_up(file_path, end)
+        return self.hash_obj.hexdigest()
+
+
+class ChecksumCache:
+    """Persistent cache of verified digests keyed by (path, size, mtime, inode)
+
+    A file whose size, modification time and inode are unchanged since it was
+    last hashed is not read again on later runs.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = Path(cache_file)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if self.cache_file.exists():
+            try:
+                with open(self.cache_file, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                print(f"⚠️  Ignoring unreadable checksum cache {self.cache_file}")
+                self.entries = {}
+
+    @staticmethod
+    def _signature(file_path):
+        stat = os.stat(file_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+    def lookup(self, file_path, hash_type='md5'):
+        """Return the cached digest if the file is unchanged since it was hashed"""
+        key = str(Path(file_path).resolve())
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry or hash_type.lower() not in entry:
+            return None
+        try:
+            signature = self._signature(file_path)
+        except OSError:
+            return None
+        if any(entry.get(field) != value for field, value in signature.items()):
+            return None
+        return entry[hash_type.lower()]
+
+    def store(self, file_path, hash_type, digest):
+        """Record the digest of a file and persist the cache"""
+        key = str(Path(file_path).resolve())
+        signature = self._signature(file_path)
+        with self.lock:
+            entry = self.entries.get(key, {})
+            if any(entry.get(field) != value for field, value in signature.items()):
+                entry = {}
+            entry.update(signature)
+            entry[hash_type.lower()] = digest
+            self.entries[key] = entry
+            self._save()
+
+    def forget(self, file_path):
+        """Drop the cache entry of a removed or invalid file"""
+        key = str(Path(file_path).resolve())
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_file, self.cache_file)
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every download thread to cap the total transfer rate"""
+
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second or 0)
+        self.capacity = self.rate  # Allow bursts of up to one second of traffic
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n_bytes):
+        """Block until n_bytes may be transferred without exceeding the rate"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n_bytes
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class HostConnectionLimiter:
+    """Cap the number of simultaneous requests to each host"""
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max(1, int(max_per_host))
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, threading.BoundedSemaphore(self.max_per_host))
+        with semaphore:
+            yield
+
+
+class ProgressReporter:
+    """Aggregate progress of all running downloads into one periodic status line"""
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.users = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.started_at = None
+
+    def register(self, name, total_bytes, done_bytes=0):
+        with self.lock:
+            self.jobs[name] = {'total': total_bytes or 0, 'done': done_bytes, 'finished': False}
+
+    def add(self, name, n_bytes):
+        with self.lock:
+            self.jobs[name]['done'] += n_bytes
+
+    def finish(self, name):
+        with self.lock:
+            if name in self.jobs:
+                self.jobs[name]['finished'] = True
+
+    def start(self):
+        """Start the reporter thread (reference counted so nested callers can share it)"""
+        with self.lock:
+            self.users += 1
+            if self.thread is not None:
+                return
+            self.started_at = time.monotonic()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.users -= 1
+            if self.users > 0 or self.thread is None:
+                return
+            thread, self.thread = self.thread, None
+        self.stop_event.set()
+        thread.join()
+        self.report()
+
+    def _run(self):
+        last_done = self._snapshot()[1]
+        last_time = time.monotonic()
+        while not self.stop_event.wait(self.interval):
+            now = time.monotonic()
+            done = self._snapshot()[1]
+            self.report(rate=(done - last_done) / max(now - last_time, 1e-6))
+            last_done, last_time = done, now
+
+    def _snapshot(self):
+        with self.lock:
+            jobs = {name: dict(job) for name, job in self.jobs.items()}
+        total = sum(job['total'] for job in jobs.values())
+        done = sum(job['done'] for job in jobs.values())
+        return jobs, done, total
+
+    def report(self, rate=None):
+        """Print one line summarising every registered download"""
+        jobs, done, total = self._snapshot()
+        if not jobs:
+            return
+        if rate is None:
+            rate = done / max(time.monotonic() - (self.started_at or time.monotonic()), 1e-6)
+        finished = sum(1 for job in jobs.values() if job['finished'])
+        percent = f" ({done / total * 100:.1f}%)" if total else ""
+        active = ", ".join(
+            f"{name} {job['done'] / job['total'] * 100:.0f}%" if job['total'] else name
+            for name, job in jobs.items() if not job['finished']
+        )
+        print(f"📊 {finished}/{len(jobs)} files | {done / 1024**3:.2f}/{total / 1024**3:.2f} GB{percent} | "
+              f"{rate / 1024**2:.1f} MB/s" + (f" | active: {active}" if active else ""), flush=True)
+
+
 class DatasetDownloader:
+    CHUNK_SIZE = 1024 * 1024  # Bytes read from the socket per iteration
+    CHECKPOINT_BYTES = 16 * 1024 * 1024  # Flush and record progress every 16 MB
+
     def __init__(self, config_file=None, datasets_dir=None):
         # Default config file path
         if config_file is None:
@@ -30,6 +295,18 @@ class DatasetDownloader:
             datasets_dir = os.environ.get('DATASETS_DIR', 'datasets')
         self.datasets_dir = Path(datasets_dir)
         self.config = self.load_config()
+        self.checksum_cache = ChecksumCache(self.datasets_dir / '.checksum_cache.json')
+
+        # One pooled session so byte ranges and files reuse keep-alive connections
+        config = self.config.get('config', {})
+        max_per_host = config.get('max_connections_per_host', 4)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.host_limiter = HostConnectionLimiter(max_per_host)
+        self.bandwidth = BandwidthLimiter(config.get('bandwidth_limit_mbps', 0) * 1024 * 1024 / 8)
+        self.progress = ProgressReporter(config.get('progress_interval_seconds', 5))
         
     def load_config(self):
         """Load dataset configuration from JSON file"""
@@ -45,30 +322,30 @@ class DatasetDownloader:
     
     def calculate_checksum(self, file_path, hash_type='md5'):
         """Calculate checksum of a file (MD5 or SHA256)"""
-        if hash_type.lower() == 'md5':
-            hash_obj = hashlib.md5()
-        elif hash_type.lower() == 'sha256':
-            hash_obj = hashlib.sha256()
-        else:
-            raise ValueError(f"Unsupported hash type: {hash_type}")
-        
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_obj.update(chunk)
-        return hash_obj.hexdigest()
+        return hash_file_range(new_hash(hash_type), file_path).hexdigest()
 
     def calculate_sha256(self, file_path):
         """Calculate SHA256 checksum of a file (for backward compatibility)"""
         return self.calculate_checksum(file_path, 'sha256')
 
-    def verify_checksum(self, file_path, expected_checksum, hash_type='md5'):
-        """Verify file checksum (MD5 or SHA256)"""
+    def verify_checksum(self, file_path, expected_checksum, hash_type='md5', actual_checksum=None):
+        """Verify file checksum (MD5 or SHA256)
+
+        ``actual_checksum`` is a digest already computed while downloading; otherwise
+        the persistent checksum cache is consulted before re-hashing the file.
+        """
         if not expected_checksum:
             print(f"⚠️  No checksum provided for {file_path}, skipping verification")
             return True
         
-        print(f"🔍 Verifying {hash_type.upper()} checksum for {file_path}...")
-        actual_checksum = self.calculate_checksum(file_path, hash_type)
+        if actual_checksum is None:
+            actual_checksum = self.checksum_cache.lookup(file_path, hash_type)
+            if actual_checksum is not None:
+                print(f"⚡ Using cached {hash_type.upper()} checksum for {file_path}")
+            else:
+                print(f"🔍 Verifying {hash_type.upper()} checksum for {file_path}...")
+                actual_checksum = self.calculate_checksum(file_path, hash_type)
+                self.checksum_cache.store(file_path, hash_type, actual_checksum)
         
         if actual_checksum == expected_checksum:
             print(f"✅ {hash_type.upper()} checksum verified for {file_path}")
@@ -77,10 +354,175 @@ class DatasetDownloader:
             print(f"❌ {hash_type.upper()} checksum mismatch for {file_path}")
             print(f"   Expected: {expected_checksum}")
             print(f"   Actual:   {actual_checksum}")
+            self.checksum_cache.forget(file_path)
             return False
 
-    def download_file(self, url, file_path, expected_checksum=None, checksum_type='md5', timeout=3600):
-        """Download a file with progress indicator and retry logic"""
+    def _part_paths(self, file_path):
+        """Return the partial download path and its progress sidecar"""
+        part_path = file_path.with_name(file_path.name + '.part')
+        state_path = file_path.with_name(file_path.name + '.part.json')
+        return part_path, state_path
+
+    def _load_part_state(self, state_path, url, total_size):
+        """Load the sidecar of a previous partial download if it matches this download"""
+        if not state_path.exists():
+            return None
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if state.get('url') != url or state.get('total_size') != total_size:
+            return None
+        return state
+
+    def _save_part_state(self, state_path, state):
+        """Atomically write the sidecar recording how far each byte range got"""
+        tmp_path = state_path.with_name(state_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+
+    def _discard_partial(self, file_path):
+        """Remove a partial download and its sidecar"""
+        for path in self._part_paths(file_path):
+            if path.exists():
+                path.unlink()
+
+    def probe_url(self, url, timeout=60):
+        """Return (total_size, accepts_ranges) for a URL, following redirects"""
+        try:
+            with self.host_limiter.slot(url):
+                response = self.session.head(url, allow_redirects=True, timeout=timeout)
+            response.raise_for_status()
+        except requests.RequestException:
+            return None, False
+        total_size = int(response.headers.get('content-length', 0)) or None
+        accepts_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+        return total_size, accepts_ranges
+
+    def plan_segments(self, total_size, accepts_ranges, segments=None):
+        """Split a download into contiguous byte ranges [start, end] (inclusive)"""
+        config = self.config.get('config', {})
+        if segments is None:
+            segments = config.get('segments_per_file', 1)
+        min_segment_bytes = int(config.get('segment_min_size_mb', 256) * 1024 * 1024)
+
+        if not total_size or not accepts_ranges:
+            return [{'start': 0, 'end': None, 'done': 0}]
+
+        segments = max(1, min(segments, total_size // max(min_segment_bytes, 1)))
+        bounds = [total_size * i // segments for i in range(segments + 1)]
+        return [{'start': bounds[i], 'end': bounds[i + 1] - 1, 'done': 0} for i in range(segments)]
+
+    def _download_segment(self, url, part_path, segment, state, state_path, lock, job_name, timeout,
+                          hasher=None):
+        """Fetch one byte range into its place in the .part file, checkpointing to the sidecar
+
+        Resumable ranges are requested in windows of ``range_window_mb`` so that a
+        connection slot for the host is released regularly and other files get a
+        turn; the pooled session keeps the underlying connection alive between
+        windows.
+        """
+        end = segment['end']
+        window_bytes = int(self.config.get('config', {}).get('range_window_mb', 64) * 1024 * 1024)
+
+        while True:
+            start = segment['start'] + segment['done']
+            if end is not None and start > end:
+                break
+
+            headers = {}
+            window_end = end
+            if state['resumable']:
+                window_end = min(end, start + window_bytes - 1)
+                headers['Range'] = f"bytes={start}-{window_end}"
+
+            with self.host_limiter.slot(url):
+                with self.session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    response.raise_for_status()
+                    if headers and response.status_code != 206:
+                        raise RangeNotHonoured(f"Server ignored range request (HTTP {response.status_code})")
+                    self._write_response(response, part_path, start, segment, state, state_path, lock,
+                                         job_name, hasher)
+
+            if window_end is None:
+                break
+            if segment['start'] + segment['done'] != window_end + 1:
+                raise IOError(f"Incomplete byte range {start}-{window_end}")
+
+    def _write_response(self, response, part_path, start, segment, state, state_path, lock, job_name, hasher):
+        """Stream a response body into the .part file at its offset"""
+        pending = 0
+        position = start
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                if not chunk:
+                    continue
+                self.bandwidth.consume(len(chunk))
+                f.write(chunk)
+                # Hash on the fly when this range is next in file order
+                if hasher is not None:
+                    hasher.update_at(position, chunk)
+                position += len(chunk)
+                pending += len(chunk)
+                self.progress.add(job_name, len(chunk))
+
+                # Only record bytes in the sidecar once they have been flushed
+                if pending >= self.CHECKPOINT_BYTES:
+                    f.flush()
+                    with lock:
+                        segment['done'] += pending
+                        self._save_part_state(state_path, state)
+                    pending = 0
+
+            f.flush()
+            with lock:
+                segment['done'] += pending
+                self._save_part_state(state_path, state)
+
+    def _new_part(self, part_path, state_path, url, total_size, accepts_ranges, segments):
+        """Start an empty .part file and its sidecar; returns the new state"""
+        state = {
+            'url': url,
+            'total_size': total_size,
+            'resumable': bool(total_size and accepts_ranges),
+            'segments': self.plan_segments(total_size, accepts_ranges, segments)
+        }
+        with open(part_path, 'wb') as f:
+            if total_size:
+                f.truncate(total_size)
+        self._save_part_state(state_path, state)
+        return state
+
+    def _fetch_segments(self, url, part_path, pending_segments, state, state_path, job_name, timeout, hasher):
+        """Fetch the pending byte ranges, in parallel when there are several"""
+        lock = threading.Lock()
+        if len(pending_segments) > 1:
+            print(f"🔀 Fetching {len(pending_segments)} byte ranges in parallel")
+            with ThreadPoolExecutor(max_workers=len(pending_segments)) as executor:
+                futures = [
+                    executor.submit(self._download_segment, url, part_path, segment, state,
+                                    state_path, lock, job_name, timeout, hasher)
+                    for segment in pending_segments
+                ]
+                for future in as_completed(futures):
+                    future.result()
+        else:
+            for segment in pending_segments:
+                self._download_segment(url, part_path, segment, state, state_path, lock,
+                                       job_name, timeout, hasher)
+
+    def download_file(self, url, file_path, expected_checksum=None, checksum_type='md5', timeout=3600,
+                      segments=None):
+        """Download a file with progress indicator, retry logic and resumable byte ranges
+
+        Data is written to ``<file>.part`` and the progress of every byte range is
+        recorded in ``<file>.part.json``, so an interrupted download continues where
+        it stopped with HTTP ``Range`` requests. When the server supports ranges a
+        large file can be split into ``segments`` ranges fetched in parallel.
+        """
         file_path = Path(file_path)
         file_path.parent.mkdir(parents=True, exist_ok=True)
         
@@ -92,55 +534,94 @@ class DatasetDownloader:
             else:
                 print(f"🗑️  Removing invalid file {file_path}")
                 file_path.unlink()
+                self.checksum_cache.forget(file_path)
         
+        self.progress.start()
+        try:
+            return self._download_with_retries(url, file_path, expected_checksum, checksum_type, timeout,
+                                               segments)
+        finally:
+            self.progress.stop()
+
+    def _download_with_retries(self, url, file_path, expected_checksum, checksum_type, timeout, segments):
+        """Download attempts with exponential backoff, resuming from the .part file"""
+        part_path, state_path = self._part_paths(file_path)
         retry_attempts = self.config.get('config', {}).get('retry_attempts', 3)
         
+        state = None
         for attempt in range(retry_attempts):
             try:
                 print(f"📥 Downloading {url} to {file_path} (attempt {attempt + 1}/{retry_attempts})")
-                
-                response = requests.get(url, stream=True, timeout=timeout)
-                response.raise_for_status()
-                
-                total_size = int(response.headers.get('content-length', 0))
-                downloaded_size = 0
-                
-                with open(file_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded_size += len(chunk)
-                            
-                            # Progress indicator
-                            if total_size > 0:
-                                progress = (downloaded_size / total_size) * 100
-                                print(f"\r📊 Progress: {progress:.1f}% ({downloaded_size / 1024 / 1024:.1f} MB)", end='')
-                
-                print()  # New line after progress
-                
+            
+                total_size, accepts_ranges = self.probe_url(url)
+                state = self._load_part_state(state_path, url, total_size)
+                if state is None or not part_path.exists() or not state['resumable']:
+                    state = self._new_part(part_path, state_path, url, total_size, accepts_ranges, segments)
+                else:
+                    resumed = sum(s['done'] for s in state['segments'])
+                    print(f"⏯️  Resuming from {resumed / 1024 / 1024:.1f} MB")
+
+                job_name = file_path.name
+                self.progress.register(job_name, total_size, sum(s['done'] for s in state['segments']))
+
+                pending_segments = [s for s in state['segments']
+                                    if s['end'] is None or s['start'] + s['done'] <= s['end']]
+
+                verify = bool(expected_checksum) and self.config.get('config', {}).get('verify_checksums', True)
+                hasher = None
+                if verify:
+                    # Re-hash only the already downloaded prefix, then hash new bytes as they arrive
+                    hasher = StreamingHasher(checksum_type)
+                    if pending_segments:
+                        hasher.catch_up(part_path, pending_segments[0]['start'] + pending_segments[0]['done'])
+                try:
+                    self._fetch_segments(url, part_path, pending_segments, state, state_path, job_name,
+                                         timeout, hasher)
+                except RangeNotHonoured as e:
+                    # The reply was the whole file, so the partial data cannot be continued
+                    print(f"⚠️  {e}, restarting from the first byte")
+                    state = self._new_part(part_path, state_path, url, total_size, False, segments)
+                    self.progress.register(job_name, total_size, 0)
+                    hasher = StreamingHasher(checksum_type) if verify else None
+                    self._fetch_segments(url, part_path, state['segments'], state, state_path, job_name,
+                                         timeout, hasher)
+
+                if total_size and part_path.stat().st_size != total_size:
+                    raise IOError(f"Size mismatch: expected {total_size} bytes, got {part_path.stat().st_size}")
+            
                 # Verify checksum if provided
-                if expected_checksum and self.config.get('config', {}).get('verify_checksums', True):
-                    if not self.verify_checksum(file_path, expected_checksum, checksum_type):
-                        file_path.unlink()  # Remove invalid file
+                digest = None
+                if verify:
+                    digest = hasher.finish(part_path, total_size)
+                    if not self.verify_checksum(part_path, expected_checksum, checksum_type, digest):
+                        self._discard_partial(file_path)  # Remove invalid file
                         raise ValueError("Checksum verification failed")
-                
+            
+                os.replace(part_path, file_path)
+                state_path.unlink()
+                if digest is not None:
+                    self.checksum_cache.store(file_path, checksum_type, digest)
+                self.progress.finish(job_name)
                 print(f"✅ Successfully downloaded {file_path}")
                 return True
-                
+            
             except Exception as e:
                 print(f"❌ Download attempt {attempt + 1} failed: {e}")
-                if file_path.exists():
-                    file_path.unlink()
-                
+                # Keep the .part file and its sidecar so the next attempt resumes
+                if state is not None and state['resumable'] and part_path.exists():
+                    kept = sum(s['done'] for s in state['segments'])
+                    print(f"💾 Keeping {kept / 1024 / 1024:.1f} MB of partial data for resume")
+            
                 if attempt < retry_attempts - 1:
                     wait_time = 2 ** attempt  # Exponential backoff
                     print(f"⏳ Waiting {wait_time} seconds before retry...")
                     time.sleep(wait_time)
-        
+    
         print(f"❌ Failed to download {url} after {retry_attempts} attempts")
+        self.progress.finish(file_path.name)
         return False
     
-    def download_dataset(self, species, dataset_id, dataset_info):
+    def download_dataset(self, species, dataset_id, dataset_info, segments=None):
         """Download a single dataset"""
         url = dataset_info['url']
         filename = f"{dataset_id}.h5ad"
@@ -161,9 +642,10 @@ class DatasetDownloader:
             checksum_type = 'md5'  # Default
         
         print(f"🧬 Processing {species}/{dataset_id}")
-        return self.download_file(url, file_path, checksum, checksum_type)
+        timeout = self.config.get('config', {}).get('download_timeout', 3600)
+        return self.download_file(url, file_path, checksum, checksum_type, timeout=timeout, segments=segments)
     
-    def download_all_datasets(self, species_filter=None, parallel=True):
+    def download_all_datasets(self, species_filter=None, parallel=True, segments=None):
         """Download all configured datasets"""
         datasets = self.config['datasets']
         download_tasks = []
@@ -182,29 +664,41 @@ class DatasetDownloader:
         
         print(f"📦 Found {len(download_tasks)} datasets to download")
         
+        config = self.config.get('config', {})
+        download_tasks = self.order_download_tasks(download_tasks, config.get('download_order', 'largest_first'))
+        if config.get('bandwidth_limit_mbps'):
+            print(f"🚦 Bandwidth capped at {config['bandwidth_limit_mbps']} Mbit/s")
+        
         success_count = 0
         
-        if parallel:
-            max_workers = self.config.get('config', {}).get('parallel_downloads', 2)
-            print(f"🚀 Using {max_workers} parallel downloads")
-            
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_task = {
-                    executor.submit(self.download_dataset, species, dataset_id, dataset_info): 
-                    (species, dataset_id) for species, dataset_id, dataset_info in download_tasks
-                }
+        # A single reporter prints aggregated progress for every worker
+        self.progress.start()
+        try:
+            if parallel:
+                max_workers = config.get('parallel_downloads', 2)
+                print(f"🚀 Using {max_workers} parallel downloads "
+                      f"(max {self.host_limiter.max_per_host} connections per host)")
                 
-                for future in as_completed(future_to_task):
-                    species, dataset_id = future_to_task[future]
-                    try:
-                        if future.result():
-                            success_count += 1
-                    except Exception as e:
-                        print(f"❌ Failed to download {species}/{dataset_id}: {e}")
-        else:
-            for species, dataset_id, dataset_info in download_tasks:
-                if self.download_dataset(species, dataset_id, dataset_info):
-                    success_count += 1
+                # Jobs are submitted in scheduling order; the pool picks them up in that order
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    future_to_task = {
+                        executor.submit(self.download_dataset, species, dataset_id, dataset_info, segments): 
+                        (species, dataset_id) for species, dataset_id, dataset_info in download_tasks
+                    }
+                    
+                    for future in as_completed(future_to_task):
+                        species, dataset_id = future_to_task[future]
+                        try:
+                            if future.result():
+                                success_count += 1
+                        except Exception as e:
+                            print(f"❌ Failed to download {species}/{dataset_id}: {e}")
+            else:
+                for species, dataset_id, dataset_info in download_tasks:
+                    if self.download_dataset(species, dataset_id, dataset_info, segments):
+                        success_count += 1
+        finally:
+            self.progress.stop()
         
         print(f"\n📊 Download Summary:")
         print(f"   ✅ Successful: {success_count}/{len(download_tasks)}")
@@ -212,12 +706,34 @@ class DatasetDownloader:
         
         return success_count == len(download_tasks)
     
+    @staticmethod
+    def order_download_tasks(download_tasks, order='largest_first'):
+        """Order (species, dataset_id, info) tasks by expected size
+
+        ``largest_first`` starts the long transfers early so they overlap with the
+        small files, ``smallest_first`` makes the small datasets usable as soon as
+        possible and ``config`` keeps the order of datasets_sources.json.
+        """
+        def size_of(task):
+            info = task[2]
+            return info.get('size_bytes') or info.get('size_mb', 0) * 1024 * 1024
+
+        if order == 'largest_first':
+            return sorted(download_tasks, key=size_of, reverse=True)
+        if order == 'smallest_first':
+            return sorted(download_tasks, key=size_of)
+        if order != 'config':
+            print(f"⚠️  Unknown download_order '{order}', keeping configuration order")
+        return list(download_tasks)
+
     def list_datasets(self):
         """List all configured datasets"""
         datasets = self.config['datasets']
         total_size = 0
         total_count = 0
         
+        catalog = self.load_catalog()
+        
         print("📋 Configured Datasets:")
         print("=" * 60)
         
@@ -231,11 +747,37 @@ class DatasetDownloader:
                 status = "✅ Downloaded" if self.is_dataset_downloaded(species, dataset_id) else "⬇️  To download"
                 print(f"   • {dataset_id}: {size_mb} MB - {status}")
                 print(f"     {dataset_info.get('description', 'No description')}")
+                entry = catalog.get(species, {}).get(dataset_id)
+                if entry is not None:
+                    levels = {column: len(entry['categories'].get(column, {}).get('levels', []))
+                              for column in ('CellType', 'Group')}
+                    print(f"     {entry['n_obs']:,} cells × {entry['n_vars']:,} genes, "
+                          f"{levels['CellType']} cell types, {levels['Group']} groups")
         
         print(f"\n📊 Summary:")
         print(f"   Total datasets: {total_count}")
         print(f"   Total size: {total_size:.1f} MB ({total_size/1024:.1f} GB)")
     
+    def load_catalog(self):
+        """Current entries of the dataset catalog by species and dataset (see dataset_catalog.py)"""
+        try:
+            from dataset_catalog import is_entry_current, read_catalog
+        except ImportError:
+            return {}
+        datasets = read_catalog(self.datasets_dir / 'catalog.json')['datasets']
+        return {species: {dataset_id: entry for dataset_id, entry in entries.items()
+                          if is_entry_current(entry, self.datasets_dir / species / f"{dataset_id}.h5ad")}
+                for species, entries in datasets.items()}
+
+    def update_catalog(self, species_filter=None, checksums=False):
+        """Refresh the dataset catalog with the metadata of the downloaded datasets"""
+        from dataset_catalog import update_catalog
+        entries = [(species, dataset_id, self.datasets_dir / species / f"{dataset_id}.h5ad", dataset_info)
+                   for species, species_datasets in self.config['datasets'].items()
+                   if not species_filter or species in species_filter
+                   for dataset_id, dataset_info in species_datasets.items()]
+        return update_catalog(entries, self.datasets_dir / 'catalog.json', checksums=checksums)
+
     def is_dataset_downloaded(self, species, dataset_id):
         """Check if a dataset is already downloaded"""
         file_path = self.datasets_dir / species / f"{dataset_id}.h5ad"
@@ -256,19 +798,27 @@ class DatasetDownloader:
                     file_path = species_dir / f"{dataset_id}.h5ad"
                     if file_path.exists():
                         file_path.unlink()
+                        self.checksum_cache.forget(file_path)
                         removed_count += 1
                         print(f"🗑️  Removed {file_path}")
+                    self._discard_partial(file_path)
         
         print(f"📊 Removed {removed_count} dataset files")
 
 def main():
     parser = argparse.ArgumentParser(description="Dataset Download Manager for MASLDatlas")
-    parser.add_argument("action", choices=["download", "list", "clean"], 
+    parser.add_argument("action", choices=["download", "list", "clean", "catalog"], 
                        help="Action to perform")
     parser.add_argument("--species", nargs="+", 
                        help="Filter by species (Human, Mouse, Zebrafish, Integrated)")
     parser.add_argument("--no-parallel", action="store_true",
                        help="Disable parallel downloads")
+    parser.add_argument("--segments", type=int, default=None,
+                       help="Split each large file into N parallel byte ranges (default: config segments_per_file)")
+    parser.add_argument("--order", choices=["largest_first", "smallest_first", "config"], default=None,
+                       help="Download scheduling order (default: config download_order)")
+    parser.add_argument("--bandwidth-limit", type=float, default=None,
+                       help="Global bandwidth cap in Mbit/s, 0 for unlimited (default: config bandwidth_limit_mbps)")
     parser.add_argument("--config", default=None,
                        help="Configuration file path (default: config/datasets_sources.json)")
     parser.add_argument("--datasets-dir", default="datasets",
@@ -277,18 +827,33 @@ def main():
     args = parser.parse_args()
     
     downloader = DatasetDownloader(args.config, args.datasets_dir)
+    if args.order is not None:
+        downloader.config.setdefault('config', {})['download_order'] = args.order
+    if args.bandwidth_limit is not None:
+        downloader.config.setdefault('config', {})['bandwidth_limit_mbps'] = args.bandwidth_limit
+        downloader.bandwidth = BandwidthLimiter(args.bandwidth_limit * 1024 * 1024 / 8)
     
     if args.action == "download":
         print("🚀 Starting dataset download...")
         success = downloader.download_all_datasets(
             species_filter=args.species,
-            parallel=not args.no_parallel
+            parallel=not args.no_parallel,
+            segments=args.segments
         )
+        try:
+            downloader.update_catalog(species_filter=args.species)
+        except Exception as e:
+            # The downloads succeeded; the app falls back to reading the files
+            print(f"⚠️  Dataset catalog not updated ({type(e).__name__}: {e})")
         sys.exit(0 if success else 1)
     
     elif args.action == "list":
         downloader.list_datasets()
     
+    elif args.action == "catalog":
+        print("📇 Updating dataset catalog...")
+        downloader.update_catalog(species_filter=args.species)
+    
     elif args.action == "clean":
         print("🧹 Cleaning datasets...")
         downloader.clean_datasets(species_filter=args.species)
@@ -0,0 +1,239 @@
+"""
+Gene-major Expression Index for MASLDatlas
+Stores a CSC (gene-major) copy of X, counts and scvi_normalized so that the
+expression of one gene is a contiguous slice: looking a gene up costs
+O(nnz of that gene) instead of a scan over the cell-major CSR matrix.
+
+Index layout (<stem>_gene_index/):
+    index.json                 shapes, layers, source signature
+    obs_names.npy, var_names.npy
+    <layer>/data.npy           values, grouped by gene
+    <layer>/rows.npy           cell (row) ids, sorted within each gene
+    <layer>/indptr.npy         gene g occupies [indptr[g], indptr[g + 1])
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from h5ad_utils import index_dtype_for, iter_row_blocks, matrix_format, matrix_shape, read_elem
+
+INDEX_VERSION = 1
+DEFAULT_LAYERS = ('X', 'counts', 'scvi_normalized')
+DEFAULT_INDEX_DIR = os.environ.get('DATASETS_OPTIMIZED_DIR', 'datasets_optimized')
+
+_OPEN_INDEXES = {}
+_OPEN_LOCK = threading.Lock()
+
+
+def gene_index_path_for(h5ad_path, index_dir=None):
+    """Default location of the gene index of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_gene_index"
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def _layer_element(f, layer):
+    if layer == 'X':
+        return f['X'] if 'X' in f else None
+    if 'layers' in f and layer in f['layers']:
+        return f['layers'][layer]
+    return None
+
+
+def _transpose_to_csc(elem, out_dir, block_rows):
+    """Write a gene-major copy of a matrix element in two bounded-memory passes"""
+    n_obs, n_vars = matrix_shape(elem)
+    fmt = matrix_format(elem)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if fmt == 'csc':
+        # Already gene-major: copy as is
+        nnz = elem['data'].shape[0]
+        np.save(out_dir / 'data.npy', elem['data'][:])
+        np.save(out_dir / 'rows.npy', elem['indices'][:].astype(index_dtype_for(n_obs)))
+        np.save(out_dir / 'indptr.npy', elem['indptr'][:].astype(np.int64))
+        return int(nnz), str(elem['data'].dtype)
+
+    def blocks():
+        for start, end, block in iter_row_blocks(elem, block_rows):
+            if not sp.issparse(block):
+                block = sp.csr_matrix(block)
+            yield start, end, block
+
+    # Pass 1: number of stored values per gene
+    counts = np.zeros(n_vars, dtype=np.int64)
+    dtype = None
+    for _, _, block in blocks():
+        counts += np.bincount(block.indices, minlength=n_vars)
+        dtype = block.dtype
+    dtype = dtype or np.float32
+    indptr = np.zeros(n_vars + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    nnz = int(indptr[-1])
+
+    data_out = np.lib.format.open_memmap(out_dir / 'data.npy', mode='w+', dtype=dtype, shape=(nnz,))
+    rows_out = np.lib.format.open_memmap(out_dir / 'rows.npy', mode='w+', dtype=index_dtype_for(n_obs),
+                                         shape=(nnz,))
+
+    # Pass 2: scatter each row block to its place; blocks arrive in row order and the
+    # sort is stable, so rows stay sorted within each gene
+    cursor = indptr[:-1].copy()
+    for start, end, block in blocks():
+        cols = block.indices
+        if len(cols) == 0:
+            continue
+        rows = np.repeat(np.arange(start, end, dtype=np.int64), np.diff(block.indptr))
+        order = np.argsort(cols, kind='stable')
+        cols_sorted = cols[order]
+        block_counts = np.bincount(cols, minlength=n_vars)
+        first = np.cumsum(block_counts) - block_counts
+        positions = cursor[cols_sorted] + (np.arange(len(cols_sorted)) - first[cols_sorted])
+        data_out[positions] = block.data[order]
+        rows_out[positions] = rows[order]
+        cursor += block_counts
+
+    data_out.flush()
+    rows_out.flush()
+    del data_out, rows_out
+    np.save(out_dir / 'indptr.npy', indptr)
+    return nnz, str(np.dtype(dtype))
+
+
+def build_gene_index(h5ad_path, out_dir=None, layers=DEFAULT_LAYERS, block_rows=50000):
+    """Build the gene-major index of an .h5ad file without loading it into memory"""
+    h5ad_path = Path(h5ad_path)
+    out_dir = Path(out_dir) if out_dir else gene_index_path_for(h5ad_path)
+    tmp_dir = out_dir.with_name(out_dir.name + '.building')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    print(f"🧬 Building gene-major index for {h5ad_path.name}...")
+    start_time = time.time()
+    meta = {'version': INDEX_VERSION, 'source': str(h5ad_path), **_source_signature(h5ad_path), 'layers': {}}
+
+    with h5py.File(h5ad_path, 'r') as f:
+        obs_names = read_elem(f['obs']).index
+        var_names = read_elem(f['var']).index
+        np.save(tmp_dir / 'obs_names.npy', np.asarray(obs_names.astype(str), dtype=str))
+        np.save(tmp_dir / 'var_names.npy', np.asarray(var_names.astype(str), dtype=str))
+        meta['n_obs'], meta['n_vars'] = len(obs_names), len(var_names)
+
+        for layer in layers:
+            elem = _layer_element(f, layer)
+            if elem is None:
+                print(f"   ⏭️  Layer '{layer}' not present")
+                continue
+            layer_start = time.time()
+            nnz, dtype = _transpose_to_csc(elem, tmp_dir / layer, block_rows)
+            meta['layers'][layer] = {'nnz': nnz, 'dtype': dtype}
+            print(f"   ✅ {layer}: {nnz:,} values in {time.time() - layer_start:.1f} seconds")
+
+    with open(tmp_dir / 'index.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+    print(f"✅ Gene index saved in {time.time() - start_time:.1f} seconds: {out_dir}")
+    return out_dir
+
+
+class GeneIndex:
+    """Read-only, memory-mapped gene-major index"""
+
+    def __init__(self, index_dir):
+        self.index_dir = Path(index_dir)
+        with open(self.index_dir / 'index.json', 'r') as f:
+            self.meta = json.load(f)
+        self.n_obs = self.meta['n_obs']
+        self.n_vars = self.meta['n_vars']
+        self.layers = {}
+        for layer in self.meta['layers']:
+            layer_dir = self.index_dir / layer
+            self.layers[layer] = tuple(np.load(layer_dir / f"{name}.npy", mmap_mode='r')
+                                       for name in ('data', 'rows', 'indptr'))
+        self.var_names = pd.Index(np.load(self.index_dir / 'var_names.npy').astype(object))
+        self._obs_names = None
+
+    @property
+    def obs_names(self):
+        """Cell names of the source file (loaded on first use)"""
+        if self._obs_names is None:
+            self._obs_names = pd.Index(np.load(self.index_dir / 'obs_names.npy').astype(object))
+        return self._obs_names
+
+    def _position(self, gene):
+        position = self.var_names.get_loc(gene) if not isinstance(gene, (int, np.integer)) else int(gene)
+        if not isinstance(position, (int, np.integer)):
+            raise KeyError(f"Gene name '{gene}' is not unique")
+        return position
+
+    def gene_entries(self, gene, layer='scvi_normalized'):
+        """Return (rows, values) of the stored (non-zero) entries of one gene"""
+        data, rows, indptr = self.layers[layer]
+        position = self._position(gene)
+        lo, hi = int(indptr[position]), int(indptr[position + 1])
+        return np.asarray(rows[lo:hi]), np.asarray(data[lo:hi])
+
+    def gene_vector(self, gene, layer='scvi_normalized', dtype=np.float32):
+        """Return the dense expression vector of one gene across all cells"""
+        rows, values = self.gene_entries(gene, layer)
+        out = np.zeros(self.n_obs, dtype=dtype)
+        out[rows] = values
+        return out
+
+    def genes_matrix(self, genes, layer='scvi_normalized', dtype=np.float32):
+        """Return a dense (n_obs, len(genes)) matrix for several genes"""
+        out = np.zeros((self.n_obs, len(genes)), dtype=dtype)
+        for k, gene in enumerate(genes):
+            rows, values = self.gene_entries(gene, layer)
+            out[rows, k] = values
+        return out
+
+    def genes_csc(self, genes, layer='scvi_normalized'):
+        """Return a sparse (n_obs, len(genes)) CSC matrix for several genes"""
+        pieces = [self.gene_entries(gene, layer) for gene in genes]
+        indptr = np.zeros(len(genes) + 1, dtype=np.int64)
+        np.cumsum([len(rows) for rows, _ in pieces], out=indptr[1:])
+        rows = np.concatenate([rows for rows, _ in pieces]) if pieces else np.empty(0, dtype=np.int64)
+        values = np.concatenate([values for _, values in pieces]) if pieces else np.empty(0, dtype=np.float32)
+        return sp.csc_matrix((values, rows, indptr), shape=(self.n_obs, len(genes)))
+
+
+def open_gene_index(h5ad_path, index_dir=None):
+    """Return the shared GeneIndex of an .h5ad if it exists and matches the file, else None"""
+    path = Path(index_dir) if index_dir and Path(index_dir).name.endswith('_gene_index') \
+        else gene_index_path_for(h5ad_path, index_dir)
+    meta_file = path / 'index.json'
+    try:
+        stat = meta_file.stat()
+    except FileNotFoundError:
+        return None
+    # A rebuild replaces the whole folder, so a new index.json means a new index
+    key, version = str(path.resolve()), (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _OPEN_LOCK:
+        cached = _OPEN_INDEXES.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, GeneIndex(path))
+            _OPEN_INDEXES[key] = cached
+        index = cached[1]
+    if index.meta.get('version') != INDEX_VERSION:
+        return None
+    if os.path.exists(h5ad_path):
+        signature = _source_signature(h5ad_path)
+        if any(index.meta.get(k) != v for k, v in signature.items()):
+            return None
+    return index
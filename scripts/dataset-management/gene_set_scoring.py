@@ -0,0 +1,178 @@
+"""
+Batched Gene-set Scoring for MASLDatlas
+Scores every cell against many gene sets at once with the univariate linear
+model of decoupler's run_ulm: for each cell and set, the t-statistic of the
+regression of the cell's expression on the set's gene weights. The sets are
+a sparse genes x sets weight matrix W, so with per-cell sums and sums of
+squares the Pearson correlation of all cells with all sets comes from a
+single sparse product X @ W. Cell blocks are scored in parallel threads.
+
+Unlike dc.run_ulm + dc.get_acts, the input AnnData is never modified: the
+activities are returned as a new AnnData (cells x sets) sharing obs and obsm.
+
+Bundled resources (enrichment_sets/*.rds) are read with pyreadr when it is
+installed, otherwise through Rscript.
+"""
+
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    import pyreadr
+except ImportError:  # Optional: Rscript is used instead
+    pyreadr = None
+
+DEFAULT_BLOCK_CELLS = 10000
+# The bundled enrichment_sets/ of the repository, wherever the scripts are run from
+DEFAULT_RESOURCE_DIR = os.environ.get('ENRICHMENT_SETS_DIR',
+                                      str(Path(__file__).resolve().parents[2] / 'enrichment_sets'))
+RESOURCES = ('collectri', 'progeny', 'msigdb')
+# MSigDB is stored with decoupler's get_resource column names
+RESOURCE_COLUMNS = {'geneset': 'source', 'genesymbol': 'target'}
+
+
+def read_rds(path):
+    """DataFrame stored in an .rds file"""
+    path = Path(path)
+    if pyreadr is not None:
+        return next(iter(pyreadr.read_r(str(path)).values()))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = Path(tmp_dir) / f"{path.stem}.tsv"
+        subprocess.run(['Rscript', '-e', 'args <- commandArgs(TRUE); '
+                        'write.table(as.data.frame(readRDS(args[1])), args[2], sep = "\\t", quote = FALSE, '
+                        'row.names = FALSE)', str(path), str(out_path)], check=True)
+        return pd.read_csv(out_path, sep='\t')
+
+
+def load_resource(name, resource_dir=DEFAULT_RESOURCE_DIR):
+    """Network (source, target, weight) of a bundled resource name or an .rds path"""
+    path = Path(name) if str(name).endswith('.rds') else Path(resource_dir) / f"{name}.rds"
+    net = read_rds(path).rename(columns=RESOURCE_COLUMNS)
+    if 'weight' not in net.columns:
+        net['weight'] = 1.0
+    return net[['source', 'target', 'weight']]
+
+
+def weight_matrix(net, genes, min_n=5, source='source', target='target', weight='weight'):
+    """Sparse genes x sets weight matrix of a network, and the names of its sets
+
+    Targets that are not in ``genes`` are ignored and sets with fewer than
+    ``min_n`` remaining targets are dropped. Without a weight column every
+    target weighs 1.
+    """
+    net = pd.DataFrame(net)
+    if weight not in net.columns or net[weight].isna().all():
+        net = net.assign(**{weight: 1.0})
+    net = net.drop_duplicates([source, target])
+    gene_codes = pd.Index(genes).get_indexer(net[target].astype(str))
+    net = net[gene_codes >= 0]
+    gene_codes = gene_codes[gene_codes >= 0]
+
+    set_codes, sets = pd.factorize(net[source].astype(str), sort=True)
+    keep = np.bincount(set_codes, minlength=len(sets)) >= min_n
+    remap = np.cumsum(keep) - 1
+    rows = keep[set_codes]
+    W = sp.csc_matrix((net[weight].to_numpy(dtype=np.float64)[rows], (gene_codes[rows], remap[set_codes[rows]])),
+                      shape=(len(genes), int(keep.sum())))
+    return W, list(sets[keep])
+
+
+def _row_moments(block):
+    """Per-row sums and sums of squares of a dense or sparse block"""
+    if sp.issparse(block):
+        return (np.asarray(block.sum(axis=1)).ravel().astype(np.float64),
+                np.asarray(block.multiply(block).sum(axis=1)).ravel().astype(np.float64))
+    block = np.asarray(block, dtype=np.float64)
+    return block.sum(axis=1), (block ** 2).sum(axis=1)
+
+
+def _ulm_block(block, W, w_mean, w_var):
+    n_genes = W.shape[0]
+    products = block @ W
+    products = products.toarray() if sp.issparse(products) else np.asarray(products)
+    sums, sumsq = _row_moments(block)
+    y_mean = sums / n_genes
+    y_var = sumsq / n_genes - y_mean ** 2
+    cov = products / n_genes - np.outer(y_mean, w_mean)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = cov / np.sqrt(np.outer(y_var, w_var))
+        r = np.clip(r, -1.0, 1.0)
+        return r * np.sqrt((n_genes - 2) / ((1.0 + r) * (1.0 - r)))
+
+
+def ulm_scores(X, W, block_cells=DEFAULT_BLOCK_CELLS, workers=None, pvals=False):
+    """ULM t-statistics (cells x sets) of every row of X against every column of W
+
+    Returns (estimates, p-values or None). Cells with constant expression get
+    NaN; a perfect correlation gives an infinite t like decoupler does.
+    """
+    n_obs, n_genes = X.shape
+    W = sp.csc_matrix(W, dtype=np.float64)
+    w_mean = np.asarray(W.sum(axis=0)).ravel() / n_genes
+    w_var = np.asarray(W.multiply(W).sum(axis=0)).ravel() / n_genes - w_mean ** 2
+    if sp.issparse(X):
+        X = sp.csr_matrix(X)
+    ranges = [(start, min(start + block_cells, n_obs)) for start in range(0, n_obs, block_cells)]
+
+    estimates = np.empty((n_obs, W.shape[1]), dtype=np.float32)
+
+    def score(bounds):
+        start, end = bounds
+        estimates[start:end] = _ulm_block(X[start:end], W, w_mean, w_var)
+
+    workers = workers or min(os.cpu_count() or 1, 8)
+    if workers > 1 and len(ranges) > 1:
+        # Sparse products and numpy reductions release the GIL
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(score, ranges))
+    else:
+        for bounds in ranges:
+            score(bounds)
+
+    if not pvals:
+        return estimates, None
+    from scipy.stats import t as t_dist
+    return estimates, (t_dist.sf(np.abs(estimates), n_genes - 2) * 2).astype(np.float32)
+
+
+def _nonempty_genes(X):
+    if sp.issparse(X):
+        return np.bincount(sp.csr_matrix(X).indices, minlength=X.shape[1]) > 0
+    return (np.asarray(X) != 0).any(axis=0)
+
+
+def score_gene_sets(adata, net, use_raw=True, min_n=5, block_cells=DEFAULT_BLOCK_CELLS, workers=None,
+                    pvals=False, source='source', target='target', weight='weight'):
+    """Activities of every gene set of ``net`` in every cell, as dc.run_ulm + dc.get_acts give them
+
+    Uses adata.raw when present and use_raw is set. Genes expressed in no
+    cell are left out, as decoupler does. Returns a new AnnData with one
+    variable per set (obs, obsm and uns shared with ``adata``; p-values in
+    layers['pvals'] when requested); ``adata`` is left unchanged.
+    """
+    matrix = adata.raw if use_raw and adata.raw is not None else adata
+    X = matrix.X
+    genes = matrix.var_names
+    nonempty = _nonempty_genes(X)
+    if not nonempty.all():
+        X = X[:, np.flatnonzero(nonempty)]
+        genes = genes[nonempty]
+
+    W, sets = weight_matrix(net, genes, min_n, source, target, weight)
+    if not sets:
+        raise ValueError(f"No gene set has at least {min_n} targets in the data")
+    estimates, pvalues = ulm_scores(X, W, block_cells, workers, pvals)
+
+    acts = ad.AnnData(X=estimates, obs=adata.obs, var=pd.DataFrame(index=pd.Index(sets)), uns=adata.uns,
+                      obsm=adata.obsm)
+    if pvalues is not None:
+        acts.layers['pvals'] = pvalues
+    return acts
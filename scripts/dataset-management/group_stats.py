@@ -0,0 +1,498 @@
+"""
+Per-Group Sufficient Statistics for MASLDatlas
+Marker and two-group DE tables built with the t-test depend only on the count,
+sum, sum of squares and non-zero count of every gene in each group of cells.
+build_group_stats computes these once per Group x CellType profile, in row
+blocks straight from the .h5ad (raw/X when present, like
+sc.tl.rank_genes_groups), and stores them as <stem>_group_stats.h5ad. Any
+union of profiles against any other union is then tested in
+O(genes x profiles) without reading a cell:
+
+- contrast / markers return the t-test (Welch) or t-test_overestim_var table
+  with log fold changes and the fraction of expressing cells
+- rank_genes_groups_precomputed stores that table in adata.uns exactly as
+  sc.tl.rank_genes_groups would, so the app's plots and tables are unchanged
+
+The Wilcoxon rank-sum test needs the cells and still runs live; the
+rank_genes_groups drop-in ranks the non-zero entries of a CSC matrix only
+(the zeros of a gene are one tied block) over gene blocks on a thread pool.
+"""
+
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
+
+from gene_index import DEFAULT_INDEX_DIR
+from h5ad_utils import iter_row_blocks, matrix_shape, read_elem
+from subset_index import subset_of, with_uns
+
+INDEX_VERSION = 1
+DEFAULT_SAMPLE_COL = 'Group'
+DEFAULT_GROUPS_COL = 'CellType'
+# Methods answered from the sufficient statistics; wilcoxon is computed live
+STATS_METHODS = ('t-test', 't-test_overestim_var')
+LIVE_METHODS = STATS_METHODS + ('wilcoxon',)
+DEFAULT_BLOCK_GENES = 1024
+
+_LOADED = {}
+_LOADED_LOCK = threading.Lock()
+
+
+def group_stats_path_for(h5ad_path, index_dir=None):
+    """Default location of the per-group statistics of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_group_stats.h5ad"
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def _as_set(values):
+    return {str(v) for v in ([values] if isinstance(values, str) else values)}
+
+
+def _log1p_base(f):
+    if 'uns' in f and 'log1p' in f['uns'] and 'base' in f['uns']['log1p']:
+        base = read_elem(f['uns']['log1p']['base'])
+        return None if base is None else float(base)
+    return None
+
+
+def accumulate_moments(elem, codes, n_profiles, block_rows=50000):
+    """Sums, sums of squares and non-zero counts of the rows of a matrix element by profile code"""
+    n_obs, n_vars = matrix_shape(elem)
+    sums = np.zeros((n_profiles, n_vars), dtype=np.float64)
+    sum_sq = np.zeros((n_profiles, n_vars), dtype=np.float64)
+    n_nonzero = np.zeros((n_profiles, n_vars), dtype=np.int64)
+    for start, end, block in iter_row_blocks(elem, block_rows):
+        n = end - start
+        indicator = sp.csr_matrix((np.ones(n), (codes[start:end], np.arange(n))), shape=(n_profiles, n))
+        if sp.issparse(block):
+            block = sp.csr_matrix(block, dtype=np.float64)
+            block.eliminate_zeros()
+            squares = block.multiply(block)
+            nonzero = block.copy()
+            nonzero.data = np.ones_like(nonzero.data)
+        else:
+            block = np.asarray(block, dtype=np.float64)
+            squares = block * block
+            nonzero = (block != 0).astype(np.float64)
+        for total, part in ((sums, block), (sum_sq, squares), (n_nonzero, nonzero)):
+            summed = indicator @ part
+            summed = summed.toarray() if sp.issparse(summed) else summed
+            total += np.rint(summed).astype(np.int64) if total.dtype.kind == 'i' else summed
+    return sums, sum_sq, n_nonzero
+
+
+def build_group_stats(h5ad_path, out_path=None, layer=None, sample_col=DEFAULT_SAMPLE_COL,
+                      groups_col=DEFAULT_GROUPS_COL, block_rows=50000):
+    """Write the per-gene moments of every sample x cell type profile of an .h5ad file
+
+    ``layer`` None uses raw/X when the file has a raw matrix and X otherwise,
+    which is what sc.tl.rank_genes_groups tests by default.
+    """
+    h5ad_path = Path(h5ad_path)
+    out_path = Path(out_path) if out_path else group_stats_path_for(h5ad_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+
+    with h5py.File(h5ad_path, 'r') as f:
+        obs = read_elem(f['obs'])
+        for column in (sample_col, groups_col):
+            if column not in obs.columns:
+                raise KeyError(f"obs has no '{column}' column")
+        use_raw = layer is None and 'raw' in f and 'X' in f['raw']
+        if use_raw:
+            elem, var = f['raw']['X'], read_elem(f['raw']['var'])
+        elif layer is None or layer == 'X':
+            elem, var = f['X'], read_elem(f['var'])
+        elif 'layers' in f and layer in f['layers']:
+            elem, var = f['layers'][layer], read_elem(f['var'])
+        else:
+            raise KeyError(f"Layer '{layer}' not found in {h5ad_path.name}")
+        matrix = 'raw/X' if use_raw else (layer or 'X')
+        print(f"📐 Building group statistics ({sample_col} × {groups_col}, matrix '{matrix}') "
+              f"for {h5ad_path.name}...")
+
+        keys = obs[[sample_col, groups_col]].astype(str)
+        codes, profiles = pd.MultiIndex.from_frame(keys).factorize(sort=True)
+        sums, sum_sq, n_nonzero = accumulate_moments(elem, codes, len(profiles), block_rows)
+        base = _log1p_base(f)
+
+    samples = profiles.get_level_values(0)
+    groups = profiles.get_level_values(1)
+    profile_obs = pd.DataFrame({
+        sample_col: pd.Categorical(samples),
+        groups_col: pd.Categorical(groups),
+        'n_cells': np.bincount(codes, minlength=len(profiles)),
+    }, index=[f"{s}_{g}" for s, g in zip(samples, groups)])
+    sdata = ad.AnnData(X=sums, obs=profile_obs, var=pd.DataFrame(index=var.index.astype(str)))
+    sdata.layers['sum_sq'] = sum_sq
+    sdata.layers['n_nonzero'] = n_nonzero.astype(np.int32)
+    sdata.uns['group_stats'] = {'version': INDEX_VERSION, 'source': str(h5ad_path), 'n_obs': len(obs),
+                                'matrix': matrix, 'use_raw': bool(use_raw), 'sample_col': sample_col,
+                                'groups_col': groups_col, 'log1p_base': -1.0 if base is None else base,
+                                **_source_signature(h5ad_path)}
+
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    sdata.write(tmp_path, compression='gzip')
+    os.replace(tmp_path, out_path)
+    print(f"✅ Statistics of {sdata.n_obs} profiles × {sdata.n_vars:,} genes saved in "
+          f"{time.time() - start_time:.1f} seconds: {out_path}")
+    return out_path
+
+
+def load_group_stats(h5ad_path, index_dir=None):
+    """Return the stored statistics of an .h5ad (shared, do not modify), or None if missing or stale"""
+    path = group_stats_path_for(h5ad_path, index_dir)
+    if not path.exists():
+        return None
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    with _LOADED_LOCK:
+        sdata = _LOADED.get(key)
+        if sdata is None:
+            sdata = ad.read_h5ad(path)
+            _LOADED[key] = sdata
+    meta = sdata.uns['group_stats']
+    if os.path.exists(h5ad_path):
+        source = _source_signature(h5ad_path)
+        if (meta['source_size'], meta['source_mtime_ns']) != (source['source_size'], source['source_mtime_ns']):
+            return None
+    return sdata
+
+
+def pooled_moments(sdata, keep):
+    """(n cells, mean, unbiased variance, fraction non-zero) per gene over the profiles in ``keep``"""
+    n = int(sdata.obs['n_cells'].to_numpy()[keep].sum())
+    sums = np.asarray(sdata.X[keep].sum(axis=0)).ravel()
+    sum_sq = np.asarray(sdata.layers['sum_sq'][keep].sum(axis=0)).ravel()
+    n_nonzero = np.asarray(sdata.layers['n_nonzero'][keep].sum(axis=0)).ravel()
+    mean = sums / n
+    var = np.maximum(sum_sq / n - mean ** 2, 0)
+    if n != 1:
+        var *= n / (n - 1)
+    return n, mean, var, n_nonzero / n
+
+
+def _expm1(base):
+    if base is None or base < 0:
+        return np.expm1
+    return lambda x: np.expm1(x * np.log(base))
+
+
+def log_fold_changes(mean_group, mean_reference, base=None):
+    """log2 fold changes of the de-logged means, as sc.tl.rank_genes_groups computes them"""
+    expm1 = _expm1(base)
+    return np.log2((expm1(mean_group) + 1e-9) / (expm1(mean_reference) + 1e-9))
+
+
+def t_test(group, reference, method='t-test'):
+    """Welch t scores and p-values from (n, mean, var) of both sides"""
+    n_group, mean_group, var_group = group
+    n_reference, mean_reference, var_reference = reference
+    if method == 't-test_overestim_var':
+        # scanpy's hack for overestimating the variance of small groups
+        n_reference = n_group
+    elif method != 't-test':
+        raise ValueError(f"Method '{method}' is not computed from group statistics")
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores, pvals = stats.ttest_ind_from_stats(mean1=mean_group, std1=np.sqrt(var_group), nobs1=n_group,
+                                                   mean2=mean_reference, std2=np.sqrt(var_reference),
+                                                   nobs2=n_reference, equal_var=False)
+    scores[np.isnan(scores)] = 0
+    pvals[np.isnan(pvals)] = 1
+    return scores, pvals
+
+
+def benjamini_hochberg(pvals):
+    """Benjamini-Hochberg adjusted p-values"""
+    pvals = np.where(np.isnan(pvals), 1, pvals)
+    n = len(pvals)
+    order = np.argsort(pvals)
+    ranked = pvals[order] * n / np.arange(1, n + 1)
+    adjusted = np.empty(n)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+def _ranked(scores):
+    """Gene order of sc.tl.rank_genes_groups (scores descending)"""
+    partition = np.argpartition(scores, -len(scores))
+    return partition[np.argsort(scores[partition])[::-1]]
+
+
+def _table(var_names, scores, pvals, lfc, pct_group, pct_reference):
+    order = _ranked(scores)
+    return pd.DataFrame({
+        'names': np.asarray(var_names, dtype=object)[order],
+        'scores': scores[order].astype(np.float32),
+        'logfoldchanges': lfc[order].astype(np.float32),
+        'pvals': pvals[order],
+        'pvals_adj': benjamini_hochberg(pvals)[order],
+        'pct_nz_group': pct_group[order],
+        'pct_nz_reference': pct_reference[order],
+    })
+
+
+def _profile_masks(sdata, column, selection, reference, cell_types=None):
+    """Profiles of the selection and the reference (None: every other profile)
+
+    A level in both is a reference, as when the app assigns the idents.
+    """
+    meta = sdata.uns['group_stats']
+    levels = sdata.obs[column].astype(str)
+    within = np.ones(sdata.n_obs, dtype=bool)
+    if cell_types is not None:
+        within = sdata.obs[meta['groups_col']].astype(str).isin(_as_set(cell_types)).to_numpy()
+    if reference is None:
+        in_selection = levels.isin(_as_set(selection)).to_numpy() & within
+        return in_selection, within & ~in_selection
+    in_reference = levels.isin(_as_set(reference)).to_numpy() & within
+    in_selection = levels.isin(_as_set(selection)).to_numpy() & within & ~in_reference
+    return in_selection, in_reference
+
+
+def contrast_statistics(sdata, column, selection, reference=None, method='t-test', cell_types=None):
+    """(var_names, scores, pvals, log fold changes, pct group, pct reference) of one contrast, or None
+
+    ``column`` is the sample or groups column of the statistics; None is
+    returned when either side has fewer than two cells.
+    """
+    in_selection, in_reference = _profile_masks(sdata, column, selection, reference, cell_types)
+    n_group, mean_group, var_group, pct_group = pooled_moments(sdata, in_selection) \
+        if in_selection.any() else (0, None, None, None)
+    n_reference, mean_reference, var_reference, pct_reference = pooled_moments(sdata, in_reference) \
+        if in_reference.any() else (0, None, None, None)
+    if n_group < 2 or n_reference < 2:
+        return None
+    scores, pvals = t_test((n_group, mean_group, var_group), (n_reference, mean_reference, var_reference), method)
+    base = sdata.uns['group_stats']['log1p_base']
+    lfc = log_fold_changes(mean_group, mean_reference, base)
+    return sdata.var_names, scores, pvals, lfc, pct_group, pct_reference
+
+
+def _usable(sdata, n_obs):
+    return sdata is not None and (n_obs is None or int(n_obs) == sdata.uns['group_stats']['n_obs'])
+
+
+def contrast(h5ad_path, column, selection, reference=None, method='t-test', cell_types=None, n_obs=None,
+             index_dir=None):
+    """Ranked t-test table of ``selection`` levels of ``column`` against ``reference`` levels (None: the rest)
+
+    Columns are those of sc.get.rank_genes_groups_df with pts. Returns None
+    when no statistics exist for the file, they were built from a different
+    number of cells than ``n_obs`` (a subsampled dataset) or a side is empty.
+    """
+    sdata = load_group_stats(h5ad_path, index_dir)
+    if not _usable(sdata, n_obs):
+        return None
+    result = contrast_statistics(sdata, column, selection, reference, method, cell_types)
+    return None if result is None else _table(*result)
+
+
+def markers(h5ad_path, group, column=DEFAULT_GROUPS_COL, method='t-test', n_obs=None, index_dir=None):
+    """Marker table of one level of ``column`` against all other cells, or None (see contrast)"""
+    return contrast(h5ad_path, column, [group], None, method, n_obs=n_obs, index_dir=index_dir)
+
+
+def store_rank_genes_groups(adata, table, group, reference, method, groupby='ident', key_added='rank_genes_groups',
+                            use_raw=None, layer=None, pts=False, var_names=None):
+    """Write a ranked table into adata.uns[key_added] in the layout of sc.tl.rank_genes_groups
+
+    The pts frames are indexed by ``var_names`` (default: the table's genes).
+    """
+    group = str(group)
+    result = {'params': {'groupby': groupby, 'reference': reference, 'method': method, 'use_raw': use_raw,
+                         'layer': layer, 'corr_method': 'benjamini-hochberg'}}
+    for field, dtype in (('names', 'O'), ('scores', 'float32'), ('logfoldchanges', 'float32'),
+                         ('pvals', 'float64'), ('pvals_adj', 'float64')):
+        result[field] = np.rec.fromarrays([table[field].to_numpy()], dtype=[(group, dtype)])
+    if pts:
+        pct = table.set_index('names')[['pct_nz_group', 'pct_nz_reference']]
+        if var_names is not None:
+            pct = pct.reindex(pd.Index(var_names).astype(str))
+        pct.index.name = None
+        if reference == 'rest':
+            result['pts'] = pct[['pct_nz_group']].set_axis([group], axis=1)
+            result['pts_rest'] = pct[['pct_nz_reference']].set_axis([group], axis=1)
+        else:
+            result['pts'] = pct.set_axis([group, str(reference)], axis=1)
+    return with_uns(adata, key_added, result)
+
+
+def rank_genes_groups_precomputed(adata, h5ad_path, column, selection, reference, group_name, reference_name,
+                                  method='t-test', cell_types=None, n_obs=None, key_added='rank_genes_groups',
+                                  pts=False, index_dir=None):
+    """Fill adata.uns[key_added] of a two-group contrast from the stored statistics
+
+    ``adata`` holds the cells of the contrast with their 'ident' column
+    (``group_name`` / ``reference_name``); ``n_obs`` is the cell count of the
+    whole dataset. Returns ``adata``, or None when the statistics cannot
+    answer (missing, stale, other method, other matrix than ``adata`` would
+    test) so the caller runs sc.tl.rank_genes_groups instead.
+    """
+    if method not in STATS_METHODS:
+        return None
+    sdata = load_group_stats(h5ad_path, index_dir)
+    if not _usable(sdata, n_obs):
+        return None
+    use_raw = adata.raw is not None
+    var_names = adata.raw.var_names if use_raw else adata.var_names
+    if use_raw != sdata.uns['group_stats']['use_raw'] or len(var_names) != sdata.n_vars:
+        return None
+    result = contrast_statistics(sdata, column, selection, reference, method, cell_types)
+    if result is None:
+        return None
+    return store_rank_genes_groups(adata, _table(*result), group_name, reference_name, method,
+                                   key_added=key_added, use_raw=use_raw, pts=pts, var_names=var_names)
+
+
+def _moments(X, rows):
+    """(n, mean, unbiased variance, fraction non-zero) per column over ``rows`` of a matrix"""
+    part = X[rows]
+    n = part.shape[0]
+    if sp.issparse(part):
+        part = sp.csr_matrix(part, dtype=np.float64)
+        sums = np.asarray(part.sum(axis=0)).ravel()
+        sum_sq = np.asarray(part.multiply(part).sum(axis=0)).ravel()
+        n_nonzero = part.getnnz(axis=0)
+    else:
+        part = np.asarray(part, dtype=np.float64)
+        sums, sum_sq, n_nonzero = part.sum(axis=0), (part * part).sum(axis=0), np.count_nonzero(part, axis=0)
+    mean = sums / n
+    var = np.maximum(sum_sq / n - mean ** 2, 0)
+    if n != 1:
+        var *= n / (n - 1)
+    return n, mean, var, n_nonzero / n
+
+
+def _rank_sums(block, in_group):
+    """Rank sum of the ``in_group`` rows in every column of a CSC block, ranking non-zeros only
+
+    Ties get their average rank; the zeros of a column are one tied block
+    between its negative and positive values.
+    """
+    n_rows, n_cols = block.shape
+    counts = np.diff(block.indptr)
+    cols = np.repeat(np.arange(n_cols), counts)
+    values = block.data.astype(np.float64, copy=False)
+    order = np.lexsort((values, cols))
+    values, cols, group = values[order], cols[order], in_group[block.indices[order]]
+    # Position of each entry within its column
+    position = np.arange(len(values)) - np.repeat(block.indptr[:-1], counts)
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (cols[1:] != cols[:-1])
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], len(values)) - 1
+    ranks = ((position[starts] + position[ends]) / 2 + 1)[np.cumsum(new_run) - 1]
+
+    n_zeros = n_rows - counts
+    ranks += np.where(values > 0, n_zeros[cols], 0)
+    n_negative = np.bincount(cols[values < 0], minlength=n_cols)
+    zero_rank = n_negative + (n_zeros + 1) / 2
+    n_group_zeros = in_group.sum() - np.bincount(cols[group], minlength=n_cols)
+    return np.bincount(cols[group], weights=ranks[group], minlength=n_cols) + n_group_zeros * zero_rank
+
+
+def wilcoxon(X, group_rows, reference_rows, n_jobs=None, block_genes=DEFAULT_BLOCK_GENES):
+    """Wilcoxon rank-sum z-scores and p-values of every column, group rows against reference rows
+
+    Same statistic as sc.tl.rank_genes_groups(method='wilcoxon') without tie
+    correction. Gene blocks are ranked in parallel on ``n_jobs`` threads.
+    """
+    rows = np.concatenate([group_rows, reference_rows])
+    in_group = np.zeros(len(rows), dtype=bool)
+    in_group[:len(group_rows)] = True
+    part = X[rows]
+    part = sp.csc_matrix(part) if sp.issparse(part) else sp.csc_matrix(np.asarray(part))
+    part.eliminate_zeros()
+    n_group, n_reference = len(group_rows), len(reference_rows)
+    n = n_group + n_reference
+
+    blocks = [(start, min(start + block_genes, part.shape[1])) for start in range(0, part.shape[1], block_genes)]
+    n_jobs = max(1, min(n_jobs or os.cpu_count() or 1, len(blocks) or 1))
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        rank_sums = list(pool.map(lambda block: _rank_sums(part[:, block[0]:block[1]], in_group), blocks))
+    rank_sums = np.concatenate(rank_sums) if rank_sums else np.zeros(0)
+
+    std = np.sqrt(n_group * n_reference * (n + 1) / 12.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = (rank_sums - n_group * (n + 1) / 2.0) / std
+    scores[np.isnan(scores)] = 0
+    pvals = 2 * stats.norm.sf(np.abs(scores))
+    return scores, pvals
+
+
+def rank_genes_groups(adata, groupby, groups, reference='rest', method='t-test', key_added='rank_genes_groups',
+                      pts=False, use_raw=None, layer=None, n_jobs=None, **kwargs):
+    """sc.tl.rank_genes_groups for one group against a reference group or the rest
+
+    t-tests are computed from column sums and Wilcoxon from the ranks of
+    the non-zero entries on ``n_jobs`` threads; the result in
+    adata.uns[key_added] has the layout scanpy writes. Other calls (several
+    groups, logreg, extra options) are passed to scanpy.
+    """
+    groups = [groups] if isinstance(groups, str) else list(groups)
+    if len(groups) != 1 or method not in LIVE_METHODS or kwargs:
+        import scanpy as sc
+        sc.tl.rank_genes_groups(adata, groupby, groups=groups, reference=reference, method=method,
+                                key_added=key_added, pts=pts, use_raw=use_raw, layer=layer, **kwargs)
+        return adata
+
+    if use_raw is None:
+        use_raw = adata.raw is not None and layer is None
+    # Rows of a subset view are read from the matrices it shares with its parent
+    subset = subset_of(adata)
+    source = subset.parent
+    if layer is not None:
+        X, var_names = source.layers[layer], source.var_names
+    elif use_raw:
+        X, var_names = source.raw.X, source.raw.var_names
+    else:
+        X, var_names = source.X, source.var_names
+
+    group = str(groups[0])
+    labels = adata.obs[groupby].astype(str).to_numpy()
+    group_rows = subset.rows[labels == group]
+    reference_rows = subset.rows[labels != group] if reference == 'rest' else subset.rows[labels == str(reference)]
+    for name, rows in ((group, group_rows), (reference, reference_rows)):
+        if len(rows) < 2:
+            raise ValueError(f"Could not calculate statistics for groups {name} since they only contain "
+                             f"{'one sample' if len(rows) else 'no samples'}.")
+
+    n_group, mean_group, var_group, pct_group = _moments(X, group_rows)
+    n_reference, mean_reference, var_reference, pct_reference = _moments(X, reference_rows)
+    if method == 'wilcoxon':
+        scores, pvals = wilcoxon(X, group_rows, reference_rows, n_jobs)
+    else:
+        scores, pvals = t_test((n_group, mean_group, var_group), (n_reference, mean_reference, var_reference),
+                               method)
+    base = adata.uns.get('log1p', {}).get('base')
+    lfc = log_fold_changes(mean_group, mean_reference, base)
+    return store_rank_genes_groups(adata, _table(var_names, scores, pvals, lfc, pct_group, pct_reference), group,
+                                   reference, method, groupby, key_added, use_raw, layer, pts, var_names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute per Group x CellType gene statistics for DE tables")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--output-dir", default=None,
+                        help="Directory for the statistics (default: DATASETS_OPTIMIZED_DIR)")
+    parser.add_argument("--layer", default=None, help="Matrix to summarize (default: raw/X if present, else X)")
+    args = parser.parse_args()
+    build_group_stats(args.input_file, group_stats_path_for(args.input_file, args.output_dir), layer=args.layer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+HDF5 helpers for MASLDatlas .h5ad files
+Reads AnnData elements straight from the HDF5 tree so large matrices can be
+walked in row blocks instead of being loaded with sc.read_h5ad
+"""
+
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    from anndata.io import read_elem, write_elem
+except ImportError:  # anndata < 0.11
+    from anndata.experimental import read_elem, write_elem
+
+try:
+    # Registers the Blosc/Zstd HDF5 filters, needed to write and to read them back
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+# uns key recording the .h5ad an in-memory AnnData was opened from
+SOURCE_KEY = '_source_h5ad'
+
+
+def compression_options(codec='gzip'):
+    """h5py dataset filter options for a codec name
+
+    'gzip' or 'gzip:<level>', 'lzf', 'none', and with hdf5plugin installed
+    'zstd[:<level>]' and 'blosc[:<level>]' (Blosc with zstd and byte shuffle).
+    A dict of h5py options is returned unchanged.
+    """
+    if isinstance(codec, dict):
+        return codec
+    name, _, level = str(codec or 'none').lower().partition(':')
+    level = int(level) if level else None
+    if name == 'none':
+        return {}
+    if name == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if level is None else level}
+    if name == 'lzf':
+        return {'compression': 'lzf'}
+    if name in ('zstd', 'blosc'):
+        if hdf5plugin is None:
+            raise ValueError(f"Codec '{codec}' needs hdf5plugin (pip install hdf5plugin)")
+        if name == 'zstd':
+            return dict(hdf5plugin.Zstd(clevel=3 if level is None else level))
+        return dict(hdf5plugin.Blosc(cname='zstd', clevel=5 if level is None else level,
+                                     shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError(f"Unknown codec '{codec}'")
+
+
+def available_codecs():
+    """Codec names usable in this environment"""
+    codecs = ['none', 'lzf', 'gzip:1', 'gzip:4', 'gzip:9']
+    if hdf5plugin is not None:
+        codecs += ['zstd', 'blosc']
+    return codecs
+
+
+def _attr_str(value):
+    """Decode an HDF5 attribute that may be stored as bytes"""
+    if isinstance(value, bytes):
+        return value.decode()
+    return value
+
+
+def encoding_type(elem):
+    """Return the AnnData encoding type of an HDF5 element ('csr_matrix', 'array', ...)"""
+    encoding = _attr_str(elem.attrs.get('encoding-type', ''))
+    if encoding:
+        return encoding
+    # Files written by anndata < 0.7 tag sparse groups with h5sparse_format
+    legacy = _attr_str(elem.attrs.get('h5sparse_format', ''))
+    if legacy:
+        return f"{legacy}_matrix"
+    return 'array' if isinstance(elem, h5py.Dataset) else 'dict'
+
+
+def matrix_format(elem):
+    """Return 'csr', 'csc' or 'dense' for a matrix element"""
+    encoding = encoding_type(elem)
+    if encoding == 'csr_matrix':
+        return 'csr'
+    if encoding == 'csc_matrix':
+        return 'csc'
+    if isinstance(elem, h5py.Dataset):
+        return 'dense'
+    raise ValueError(f"Unsupported matrix encoding '{encoding}' for {elem.name}")
+
+
+def matrix_shape(elem):
+    """Return (n_rows, n_cols) of a dense or sparse matrix element"""
+    if isinstance(elem, h5py.Dataset):
+        return tuple(elem.shape)
+    shape = elem.attrs.get('shape', elem.attrs.get('h5sparse_shape'))
+    return tuple(int(x) for x in shape)
+
+
+def matrix_dtype(elem):
+    """Return the value dtype of a dense or sparse matrix element"""
+    if isinstance(elem, h5py.Dataset):
+        return elem.dtype
+    return elem['data'].dtype
+
+
+def matrix_elements(f):
+    """Yield (key, element) for X, every layer and raw/X of an open h5ad file"""
+    if 'X' in f:
+        yield 'X', f['X']
+    if 'layers' in f:
+        for name in f['layers'].keys():
+            yield f'layers/{name}', f['layers'][name]
+    if 'raw' in f and 'X' in f['raw']:
+        yield 'raw/X', f['raw']['X']
+
+
+def read_rows(elem, start, end):
+    """Read rows [start, end) of a matrix element as a CSR matrix or dense array"""
+    fmt = matrix_format(elem)
+    n_rows, n_cols = matrix_shape(elem)
+    if fmt == 'dense':
+        return elem[start:end]
+    if fmt == 'csc':
+        # Row slices of CSC data need the whole matrix; fall back to anndata
+        return read_elem(elem)[start:end].tocsr()
+
+    indptr = elem['indptr'][start:end + 1]
+    lo, hi = int(indptr[0]), int(indptr[-1])
+    data = elem['data'][lo:hi]
+    indices = elem['indices'][lo:hi]
+    return sp.csr_matrix((data, indices, indptr - lo), shape=(end - start, n_cols))
+
+
+def iter_row_blocks(elem, block_rows=50000):
+    """Yield (start, end, block) over a matrix element in blocks of rows"""
+    n_rows = matrix_shape(elem)[0]
+    for start in range(0, n_rows, block_rows):
+        end = min(start + block_rows, n_rows)
+        yield start, end, read_rows(elem, start, end)
+
+
+def copy_dataset_to_npy(dataset, out_path, dtype=None, block_items=16 * 1024 * 1024):
+    """Copy an HDF5 dataset into a .npy file in blocks, without loading it whole"""
+    dtype = np.dtype(dtype or dataset.dtype)
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=dataset.shape)
+    if dataset.ndim == 0 or dataset.shape[0] == 0:
+        if dataset.ndim == 0:
+            out[...] = dataset[()]
+        del out
+        return
+    row_items = int(np.prod(dataset.shape[1:])) if dataset.ndim > 1 else 1
+    step = max(1, block_items // max(row_items, 1))
+    for start in range(0, dataset.shape[0], step):
+        end = min(start + step, dataset.shape[0])
+        out[start:end] = dataset[start:end]
+    out.flush()
+    del out
+
+
+def index_dtype_for(max_value):
+    """Smallest index dtype scipy keeps without copying (int32 when it fits)"""
+    return np.int32 if max_value < np.iinfo(np.int32).max else np.int64
+
+
+def read_row_subset(elem, rows, block_rows=50000):
+    """Read the given sorted row indices of a matrix element in bounded-memory blocks"""
+    rows = np.asarray(rows, dtype=np.int64)
+    n_rows, n_cols = matrix_shape(elem)
+    if matrix_format(elem) == 'dense':
+        return elem[rows] if len(rows) else np.empty((0, n_cols), dtype=elem.dtype)
+
+    pieces = []
+    for start, end, block in iter_row_blocks(elem, block_rows):
+        lo, hi = np.searchsorted(rows, [start, end])
+        if hi > lo:
+            pieces.append(block[rows[lo:hi] - start])
+    if not pieces:
+        return sp.csr_matrix((0, n_cols), dtype=matrix_dtype(elem))
+    return sp.vstack(pieces, format='csr')
+
+
+def read_columns(elem, cols, block_items=16 * 1024 * 1024):
+    """Read whole columns of a matrix element as a dense (n_rows, len(cols)) array
+
+    CSR data is scanned once in blocks of ``block_items`` stored values, so the
+    cost is one pass over the indices regardless of how many columns are asked for.
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    n_rows, n_cols = matrix_shape(elem)
+    fmt = matrix_format(elem)
+    out = np.zeros((n_rows, len(cols)), dtype=np.float32)
+    if len(cols) == 0:
+        return out
+
+    if fmt == 'dense':
+        order = np.argsort(cols)
+        out[:, order] = elem[:, cols[order]]
+        return out
+
+    if fmt == 'csc':
+        indptr = elem['indptr']
+        for k, col in enumerate(cols):
+            lo, hi = int(indptr[col]), int(indptr[col + 1])
+            out[elem['indices'][lo:hi], k] = elem['data'][lo:hi]
+        return out
+
+    # Map column id -> output position (-1 when not requested)
+    lookup = np.full(n_cols, -1, dtype=np.int64)
+    lookup[cols] = np.arange(len(cols))
+    indptr = elem['indptr'][:]
+    data, indices = elem['data'], elem['indices']
+    nnz = int(indptr[-1])
+    for lo in range(0, nnz, block_items):
+        hi = min(lo + block_items, nnz)
+        positions = lookup[indices[lo:hi]]
+        hits = np.nonzero(positions >= 0)[0]
+        if len(hits) == 0:
+            continue
+        row_ids = np.searchsorted(indptr, lo + hits, side='right') - 1
+        out[row_ids, positions[hits]] = data[lo:hi][hits]
+    return out
+
+
+class RowAppender:
+    """Write a CSR or dense matrix element to an open h5ad file one row block at a time
+
+    Data, indices and indptr are resizable HDF5 datasets, so a matrix with any
+    number of rows is written with memory bounded by the block being appended.
+    The element is tagged with the AnnData encoding, so anndata reads it back
+    like one written by ``adata.write``. ``compression`` is a codec name or
+    options accepted by compression_options.
+    """
+
+    def __init__(self, group, key, n_cols, dtype, sparse=True, compression='gzip'):
+        self.n_cols = int(n_cols)
+        self.sparse = sparse
+        self.n_rows = 0
+        self.nnz = 0
+        options = {'chunks': True, **compression_options(compression)}
+        if sparse:
+            self.elem = group.create_group(key)
+            self.elem.attrs['encoding-type'] = 'csr_matrix'
+            self.elem.attrs['encoding-version'] = '0.1.0'
+            self.data = self.elem.create_dataset('data', shape=(0,), maxshape=(None,), dtype=dtype, **options)
+            self.indices = self.elem.create_dataset('indices', shape=(0,), maxshape=(None,), dtype=np.int32,
+                                                    **options)
+            self.indptr = self.elem.create_dataset('indptr', shape=(1,), maxshape=(None,), dtype=np.int64,
+                                                   **options)
+            self.indptr[0] = 0
+        else:
+            self.elem = group.create_dataset(key, shape=(0, self.n_cols), maxshape=(None, self.n_cols),
+                                             dtype=dtype, **options)
+            self.elem.attrs['encoding-type'] = 'array'
+            self.elem.attrs['encoding-version'] = '0.2.0'
+        self._set_shape()
+
+    def _set_shape(self):
+        if self.sparse:
+            self.elem.attrs['shape'] = (self.n_rows, self.n_cols)
+
+    def append(self, block):
+        """Append a CSR matrix or dense array with ``n_cols`` columns"""
+        n_new = block.shape[0]
+        if n_new == 0:
+            return
+        if not self.sparse:
+            block = block.toarray() if sp.issparse(block) else np.asarray(block)
+            self.elem.resize(self.n_rows + n_new, axis=0)
+            self.elem[self.n_rows:] = block
+            self.n_rows += n_new
+            return
+
+        block = block.tocsr() if sp.issparse(block) else sp.csr_matrix(block)
+        block_nnz = int(block.indptr[-1])
+        self.data.resize((self.nnz + block_nnz,))
+        self.indices.resize((self.nnz + block_nnz,))
+        self.data[self.nnz:] = block.data[:block_nnz]
+        self.indices[self.nnz:] = block.indices[:block_nnz]
+        self.indptr.resize((self.n_rows + n_new + 1,))
+        self.indptr[self.n_rows + 1:] = block.indptr[1:].astype(np.int64) + self.nnz
+        self.nnz += block_nnz
+        self.n_rows += n_new
+        self._set_shape()
+
+
+def read_metadata(f):
+    """obs, var, obsm, varm, uns and raw/var of an open h5ad file (no matrices)"""
+    meta = {
+        'obs': read_elem(f['obs']),
+        'var': read_elem(f['var']),
+        'obsm': {},
+        'varm': {},
+        'uns': read_elem(f['uns']) if 'uns' in f else {},
+        'raw_var': read_elem(f['raw']['var']) if 'raw' in f and 'var' in f['raw'] else None,
+    }
+    for key in ('obsm', 'varm'):
+        if key in f:
+            meta[key] = {name: read_elem(f[key][name]) for name in f[key].keys()}
+    return meta
+
+
+def take_rows(value, rows):
+    """Rows of an obsm/varm entry (array or DataFrame)"""
+    return value.iloc[rows] if isinstance(value, pd.DataFrame) else value[rows]
+
+
+class H5adWriter:
+    """An .h5ad file whose metadata is written up front and matrices row block by row block
+
+    ``elements`` are the (key, element) pairs of the source file, as yielded by
+    matrix_elements; ``columns`` optionally keeps a subset of genes (raw/X
+    always keeps all of them). The file is written under a temporary name and
+    moved into place by close().
+    """
+
+    def __init__(self, path, elements, obs, var, obsm, uns, varm=None, raw_var=None, columns=None,
+                 compression='gzip'):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + '.tmp')
+        self.file = h5py.File(self.tmp_path, 'w')
+        self.columns = columns
+        f = self.file
+        f.attrs['encoding-type'] = 'anndata'
+        f.attrs['encoding-version'] = '0.1.0'
+        # The codec applies to the matrices; plugin filters cannot encode the
+        # variable-length strings of obs/var, so metadata is always gzip'd
+        dataset_kwargs = compression_options('gzip')
+        write_elem(f, 'obs', obs, dataset_kwargs=dataset_kwargs)
+        write_elem(f, 'var', var, dataset_kwargs=dataset_kwargs)
+        write_elem(f, 'obsm', obsm, dataset_kwargs=dataset_kwargs)
+        write_elem(f, 'varm', varm or {}, dataset_kwargs=dataset_kwargs)
+        write_elem(f, 'uns', uns)
+        write_elem(f, 'layers', {})
+
+        self.appenders = {}
+        for key, elem in elements:
+            if key == 'raw/X':
+                if raw_var is None:
+                    continue
+                if 'raw' not in f:
+                    raw = f.create_group('raw')
+                    raw.attrs['encoding-type'] = 'raw'
+                    raw.attrs['encoding-version'] = '0.1.0'
+                    write_elem(raw, 'var', raw_var, dataset_kwargs=dataset_kwargs)
+                group, name, n_cols = f['raw'], 'X', len(raw_var)
+            else:
+                parent, _, name = key.rpartition('/')
+                group = f[parent] if parent else f
+                n_cols = len(var)
+            self.appenders[key] = RowAppender(group, name, n_cols, matrix_dtype(elem),
+                                              sparse=matrix_format(elem) != 'dense', compression=compression)
+
+    def append(self, key, block):
+        appender = self.appenders.get(key)
+        if appender is None:
+            return
+        # raw keeps every gene, like adata[:, genes].copy()
+        if self.columns is not None and key != 'raw/X':
+            block = block[:, self.columns]
+        appender.append(block)
+
+    def close(self):
+        self.file.close()
+        self.tmp_path.replace(self.path)
+        return self.path
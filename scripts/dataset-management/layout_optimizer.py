@@ -0,0 +1,236 @@
+"""
+Storage Layout Optimizer for MASLDatlas
+Picks a compact in-memory and on-disk layout for every matrix of an AnnData
+instead of densifying X:
+
+- sparse (CSR) or dense, whichever takes fewer bytes at the measured density
+- the narrowest float type (float16 for dense matrices, float32) that
+  reproduces every value within a relative tolerance; float64 is kept otherwise
+- int32 sparse indices whenever the shape and nnz allow
+- string obs columns with repeated values as categoricals
+- float32 X_* embeddings (X_umap, X_pca, ...)
+
+report() compares the in-memory size, on-disk size and load time of the
+dataset before and after.
+"""
+
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from h5ad_utils import index_dtype_for
+
+# Relative error allowed when narrowing floats: float32 passes for almost any
+# data, float16 only for values it represents exactly (small integer counts)
+DEFAULT_RTOL = 1e-6
+FLOAT_CANDIDATES = (np.float16, np.float32)
+# String obs columns with at most this fraction of distinct values become categoricals
+MAX_CATEGORY_FRACTION = 0.5
+CHECK_BLOCK = 16 * 1024 * 1024
+
+
+def _fits(values, dtype, rtol):
+    """True when every value survives a round trip through ``dtype`` within ``rtol``"""
+    finfo = np.finfo(dtype)
+    for start in range(0, values.size, CHECK_BLOCK):
+        block = np.asarray(values[start:start + CHECK_BLOCK], dtype=np.float64)
+        finite = np.isfinite(block)
+        if np.abs(block[finite]).max(initial=0) > finfo.max:
+            return False
+        with np.errstate(over='ignore'):
+            narrowed = block.astype(dtype).astype(np.float64)
+        error = np.abs(narrowed - block)[finite]
+        if (error > rtol * np.abs(block[finite])).any():
+            return False
+    return True
+
+
+def value_dtype(values, rtol=DEFAULT_RTOL):
+    """Narrowest float dtype holding ``values`` (a 1-D array) within ``rtol``; integers are left as they are"""
+    dtype = np.dtype(values.dtype)
+    if dtype.kind != 'f':
+        return dtype
+    for candidate in FLOAT_CANDIDATES:
+        if np.dtype(candidate).itemsize >= dtype.itemsize:
+            break
+        if _fits(values, candidate, rtol):
+            return np.dtype(candidate)
+    return dtype
+
+
+def matrix_nbytes(X):
+    """In-memory bytes of a dense or sparse matrix"""
+    if sp.issparse(X):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return np.asarray(X).nbytes
+
+
+def _values(X):
+    return X.data if sp.issparse(X) else np.asarray(X).ravel()
+
+
+def plan_matrix(X, rtol=DEFAULT_RTOL, dense_density=None):
+    """Layout decision for a matrix: format, value dtype, index dtype, density and byte sizes
+
+    ``dense_density`` forces dense storage at or above that density;
+    otherwise the layout taking fewer bytes wins.
+    """
+    n_rows, n_cols = X.shape
+    n_elements = n_rows * n_cols
+    nnz = X.nnz if sp.issparse(X) else int(np.count_nonzero(X))
+    density = nnz / n_elements if n_elements else 0.0
+    dense_dtype = value_dtype(_values(X), rtol)
+    # scipy.sparse has no float16 matrices
+    sparse_dtype = np.promote_types(dense_dtype, np.float32) if dense_dtype == np.float16 else dense_dtype
+    index_dtype = np.dtype(index_dtype_for(max(n_cols, nnz)))
+    sparse_bytes = nnz * (sparse_dtype.itemsize + index_dtype.itemsize) + (n_rows + 1) * index_dtype.itemsize
+    dense_bytes = n_elements * dense_dtype.itemsize
+    if dense_density is not None:
+        sparse = density < dense_density
+    else:
+        sparse = sparse_bytes <= dense_bytes
+    return {
+        'format': 'csr' if sparse else 'dense',
+        'dtype': (sparse_dtype if sparse else dense_dtype).name,
+        'index_dtype': index_dtype.name if sparse else None,
+        'density': density,
+        'bytes_before': matrix_nbytes(X),
+        'bytes_after': sparse_bytes if sparse else dense_bytes,
+    }
+
+
+def apply_plan(X, plan):
+    """The matrix in the layout of ``plan``"""
+    dtype = np.dtype(plan['dtype'])
+    if plan['format'] == 'dense':
+        X = X.toarray() if sp.issparse(X) else np.asarray(X)
+        return X.astype(dtype, copy=False)
+    X = sp.csr_matrix(X)
+    X = X.astype(dtype, copy=False) if X.dtype != dtype else X
+    index_dtype = np.dtype(plan['index_dtype'])
+    if X.indices.dtype != index_dtype or X.indptr.dtype != index_dtype:
+        X = sp.csr_matrix((X.data, X.indices.astype(index_dtype), X.indptr.astype(index_dtype)), shape=X.shape)
+    return X
+
+
+def compact_obs(obs, max_fraction=MAX_CATEGORY_FRACTION):
+    """obs with repeated-string columns as categoricals, and the converted column names"""
+    obs = obs.copy()
+    converted = []
+    for column in obs.columns:
+        values = obs[column]
+        if values.dtype != object and not pd.api.types.is_string_dtype(values):
+            continue
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            continue
+        if values.map(lambda value: isinstance(value, str) or pd.isna(value)).all() \
+                and values.nunique(dropna=True) <= max_fraction * max(len(values), 1):
+            obs[column] = values.astype('category')
+            converted.append(column)
+    return obs, converted
+
+
+def compact_embeddings(obsm):
+    """{key: float32 array} for the float64 X_* embeddings of obsm"""
+    return {key: np.asarray(value, dtype=np.float32) for key, value in obsm.items()
+            if key.startswith('X_') and isinstance(value, np.ndarray) and value.dtype == np.float64}
+
+
+def memory_bytes(adata):
+    """In-memory bytes of the matrices, obs, var and obsm of an AnnData"""
+    total = matrix_nbytes(adata.X) if adata.X is not None else 0
+    total += sum(matrix_nbytes(layer) for layer in adata.layers.values())
+    if adata.raw is not None:
+        total += matrix_nbytes(adata.raw.X)
+    total += int(adata.obs.memory_usage(deep=True).sum()) + int(adata.var.memory_usage(deep=True).sum())
+    total += sum(np.asarray(value).nbytes for value in adata.obsm.values() if isinstance(value, np.ndarray))
+    return total
+
+
+def optimize_layout(adata, rtol=DEFAULT_RTOL, dense_density=None, verbose=True):
+    """Rewrite the matrices, obs strings and embeddings of ``adata`` in place in a compact layout
+
+    Returns {'matrices': {key: plan}, 'categoricals': [...], 'embeddings': [...],
+    'memory_before': bytes, 'memory_after': bytes}.
+    """
+    summary = {'matrices': {}, 'memory_before': memory_bytes(adata)}
+    matrices = [('X', adata.X)] + [(f"layers/{name}", layer) for name, layer in adata.layers.items()]
+    for key, X in matrices:
+        if X is None:
+            continue
+        plan = plan_matrix(X, rtol, dense_density)
+        summary['matrices'][key] = plan
+        compacted = apply_plan(X, plan)
+        if key == 'X':
+            adata.X = compacted
+        else:
+            adata.layers[key.split('/', 1)[1]] = compacted
+    if adata.raw is not None:
+        raw = adata.raw.to_adata()
+        plan = plan_matrix(raw.X, rtol, dense_density)
+        summary['matrices']['raw/X'] = plan
+        raw.X = apply_plan(raw.X, plan)
+        adata.raw = raw
+
+    adata.obs, summary['categoricals'] = compact_obs(adata.obs)
+    embeddings = compact_embeddings(adata.obsm)
+    for key, value in embeddings.items():
+        adata.obsm[key] = value
+    summary['embeddings'] = sorted(embeddings)
+    summary['memory_after'] = memory_bytes(adata)
+
+    if verbose:
+        for key, plan in summary['matrices'].items():
+            print(f"🧱 {key}: {plan['format']} {plan['dtype']}"
+                  f"{' / ' + plan['index_dtype'] + ' indices' if plan['index_dtype'] else ''} "
+                  f"(density {plan['density']:.1%}): {plan['bytes_before'] / (1024**2):.1f} → "
+                  f"{plan['bytes_after'] / (1024**2):.1f} MB")
+        if summary['categoricals']:
+            print(f"🏷️  Categorical obs columns: {', '.join(summary['categoricals'])}")
+        if summary['embeddings']:
+            print(f"🗺️  float32 embeddings: {', '.join(summary['embeddings'])}")
+    return summary
+
+
+def _load_time(path):
+    import anndata as ad
+    start_time = time.time()
+    adata = ad.read_h5ad(path)
+    elapsed = time.time() - start_time
+    return adata, elapsed
+
+
+def report(before_path, after_path):
+    """Print and return in-memory size, on-disk size and load time of two .h5ad files"""
+    rows = {}
+    for name, path in (('before', before_path), ('after', after_path)):
+        adata, seconds = _load_time(path)
+        rows[name] = {'memory_bytes': memory_bytes(adata), 'disk_bytes': Path(path).stat().st_size,
+                      'load_seconds': seconds}
+        del adata
+
+    print("📊 Layout report:          before →    after")
+    for label, field, scale, unit in (('In memory', 'memory_bytes', 1024**2, 'MB'),
+                                      ('On disk', 'disk_bytes', 1024**2, 'MB'),
+                                      ('Load time', 'load_seconds', 1, 's')):
+        before, after = rows['before'][field] / scale, rows['after'][field] / scale
+        ratio = f"({before / after:.1f}x)" if after else ""
+        print(f"   {label:<10} {before:>10.1f} {unit} → {after:>8.1f} {unit} {ratio}")
+    return rows
+
+
+def compact_file(h5ad_path, out_path, rtol=DEFAULT_RTOL, dense_density=None, compression='gzip'):
+    """Write a compact-layout copy of an .h5ad file and print the before/after report"""
+    import anndata as ad
+
+    print(f"🧱 Optimizing the storage layout of {Path(h5ad_path).name}...")
+    adata = ad.read_h5ad(h5ad_path)
+    optimize_layout(adata, rtol, dense_density)
+    adata.write_h5ad(out_path, compression=compression)
+    del adata
+    print(f"✅ Compact version saved: {out_path}")
+    report(h5ad_path, out_path)
+    return out_path
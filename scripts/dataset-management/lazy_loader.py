@@ -0,0 +1,267 @@
+"""
+Lazy AnnData Loading for MASLDatlas
+Opens an .h5ad without reading its expression matrices: only obs, var, obsm
+and uns are loaded up front. Single genes, row subsets and whole layers are
+pulled from the HDF5 file when a plot or analysis asks for them, and recently
+used gene vectors are kept in an LRU cache shared by every session of the
+process. When a gene-major index (gene_index.py) exists for the file, gene
+vectors are read from it instead of scanning the cell-major matrix.
+"""
+
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+
+from gene_index import open_gene_index
+from h5ad_utils import SOURCE_KEY, read_columns, read_elem, read_row_subset
+
+LAZY_SOURCE_KEY = '_lazy_source'
+
+# One LazyDataset per file and process, so sessions share metadata and the gene cache
+_LAZY_DATASETS = {}
+_LAZY_LOCK = threading.Lock()
+
+
+class LazyDataset:
+    def __init__(self, h5ad_path, gene_cache_size=256):
+        self.path = Path(h5ad_path)
+        self.file = h5py.File(self.path, 'r')
+        self.lock = threading.RLock()
+        self.gene_cache_size = gene_cache_size
+        self._gene_cache = OrderedDict()
+        self._layers = {}
+        self.csc_index = open_gene_index(self.path)
+
+        f = self.file
+        self.obs = read_elem(f['obs'])
+        self.var = read_elem(f['var'])
+        self.obsm = {}
+        if 'obsm' in f:
+            for key in f['obsm'].keys():
+                if isinstance(f['obsm'][key], h5py.Dataset):
+                    self.obsm[key] = f['obsm'][key][()]
+        self.uns = read_elem(f['uns']) if 'uns' in f else {}
+
+        self.layer_names = list(f['layers'].keys()) if 'layers' in f else []
+        self.has_raw = 'raw' in f and 'X' in f['raw']
+
+    @property
+    def n_obs(self):
+        return len(self.obs)
+
+    @property
+    def n_vars(self):
+        return len(self.var)
+
+    def _element(self, layer=None):
+        if layer in (None, 'X'):
+            return self.file['X']
+        if layer not in self.layer_names:
+            raise KeyError(f"Layer '{layer}' not found in {self.path.name}")
+        return self.file['layers'][layer]
+
+    def gene_index(self, genes):
+        """Return the column positions of gene names, raising on unknown genes"""
+        positions = self.var.index.get_indexer(list(genes))
+        missing = [gene for gene, pos in zip(genes, positions) if pos < 0]
+        if missing:
+            raise KeyError(f"Genes not found: {', '.join(missing)}")
+        return positions
+
+    def genes_matrix(self, genes, layer='scvi_normalized'):
+        """Return a dense (n_obs, len(genes)) float32 matrix for the given genes
+
+        Cached gene vectors are reused; the others come from the gene-major
+        index when there is one, else from the layer in a single pass (or from
+        the layer itself if it was already materialized).
+        """
+        genes = list(genes)
+        out = np.empty((self.n_obs, len(genes)), dtype=np.float32)
+        with self.lock:
+            todo = []
+            for k, gene in enumerate(genes):
+                cached = self._gene_cache.get((layer, gene))
+                if cached is not None:
+                    self._gene_cache.move_to_end((layer, gene))
+                    out[:, k] = cached
+                else:
+                    todo.append(k)
+
+            if todo:
+                positions = self.gene_index([genes[k] for k in todo])
+                if self.csc_index is not None and layer in self.csc_index.layers:
+                    values = self.csc_index.genes_matrix(positions, layer)
+                elif layer in self._layers:
+                    matrix = self._layers[layer]
+                    values = matrix[:, positions]
+                    values = values.toarray() if hasattr(values, 'toarray') else np.asarray(values)
+                else:
+                    values = read_columns(self._element(layer), positions)
+                for j, k in enumerate(todo):
+                    out[:, k] = values[:, j]
+                    self._remember((layer, genes[k]), out[:, k].copy())
+        return out
+
+    def gene_vector(self, gene, layer='scvi_normalized'):
+        """Return the expression of one gene across all cells"""
+        return self.genes_matrix([gene], layer)[:, 0]
+
+    def _remember(self, key, vector):
+        self._gene_cache[key] = vector
+        self._gene_cache.move_to_end(key)
+        while len(self._gene_cache) > self.gene_cache_size:
+            self._gene_cache.popitem(last=False)
+
+    def layer(self, name):
+        """Materialize a whole layer ('X' for the main matrix) and keep it for later calls"""
+        with self.lock:
+            if name not in self._layers:
+                print(f"📥 Materializing layer '{name}' from {self.path.name}")
+                self._layers[name] = read_elem(self._element(name))
+            return self._layers[name]
+
+    def read_rows(self, rows, layer=None):
+        """Read a subset of cells (sorted row indices) of one layer"""
+        with self.lock:
+            if layer in self._layers:
+                return self._layers[layer][rows]
+            return read_row_subset(self._element(layer), rows)
+
+    def to_anndata(self, layers=(), include_X=False):
+        """Build an AnnData with metadata and embeddings, plus only the requested matrices
+
+        The returned object is tagged in ``uns`` with its source file, so
+        ``gene_view`` and ``materialize`` can fetch expression values for it later.
+        """
+        adata = ad.AnnData(
+            X=self.layer('X') if include_X else None,
+            obs=self.obs.copy(),
+            var=self.var.copy(),
+            obsm={key: value for key, value in self.obsm.items()},
+            layers={name: self.layer(name) for name in layers},
+            uns=dict(self.uns),
+        )
+        adata.uns[LAZY_SOURCE_KEY] = str(self.path)
+        return adata
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def open_lazy(h5ad_path, gene_cache_size=256):
+    """Return the shared LazyDataset of a file, opening it on first use"""
+    key = str(Path(h5ad_path).resolve())
+    with _LAZY_LOCK:
+        dataset = _LAZY_DATASETS.get(key)
+        if dataset is None:
+            dataset = LazyDataset(h5ad_path, gene_cache_size)
+            _LAZY_DATASETS[key] = dataset
+        return dataset
+
+
+def is_lazy(adata):
+    """True for an AnnData (or view of one) created by LazyDataset.to_anndata"""
+    return adata is not None and LAZY_SOURCE_KEY in adata.uns
+
+
+def _source_rows(adata, dataset):
+    """Row positions of the cells of adata (possibly a view) in the source file"""
+    if adata.n_obs == dataset.n_obs and adata.obs_names.equals(dataset.obs.index):
+        return np.arange(dataset.n_obs)
+    return dataset.obs.index.get_indexer(adata.obs_names)
+
+
+def gene_view(adata, genes, layer='scvi_normalized'):
+    """Small AnnData holding only the given genes, for sc.pl.umap / sc.pl.violin
+
+    For lazily opened datasets the gene vectors come from the LRU cache, the
+    gene-major index or the HDF5 file; for other AnnData objects tagged with
+    their source file (dataset stores) they come from the gene-major index.
+    ``X`` and ``layers[layer]`` both hold them so plotting calls work with or
+    without ``layer=``. AnnData objects with no faster source are returned as is.
+    """
+    if adata is None:
+        return adata
+    if isinstance(genes, str):
+        genes = [genes]
+
+    if is_lazy(adata):
+        dataset = open_lazy(adata.uns[LAZY_SOURCE_KEY])
+        rows = _source_rows(adata, dataset)
+        values = dataset.genes_matrix(genes, layer)[rows]
+    else:
+        source = adata.uns.get(SOURCE_KEY)
+        index = open_gene_index(source) if source else None
+        if index is None or layer not in index.layers:
+            return adata
+        # The app only ever drops cells, so a full-size object is in source order
+        if adata.n_obs == index.n_obs:
+            rows = np.arange(index.n_obs)
+        else:
+            rows = index.obs_names.get_indexer(adata.obs_names)
+        values = index.genes_matrix(genes, layer)[rows]
+
+    positions = adata.var_names.get_indexer(genes)
+    if (positions < 0).any():
+        raise KeyError(f"Genes not found: {', '.join(g for g, p in zip(genes, positions) if p < 0)}")
+    return ad.AnnData(
+        X=values,
+        obs=adata.obs.copy(),
+        var=adata.var.iloc[positions].copy(),
+        obsm={key: np.asarray(value) for key, value in adata.obsm.items()},
+        layers={layer: values},
+        uns={key: value for key, value in adata.uns.items() if key.endswith('_colors')},
+    )
+
+
+def _sorted_rows(rows):
+    """Sort row positions for reading; returns (sorted rows, inverse permutation)"""
+    order = np.argsort(rows)
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    return rows[order], inverse
+
+
+def expression_matrix(adata, layer=None):
+    """Return X (or a layer) of an AnnData, reading it from the source file when lazy
+
+    For a lazily opened dataset covering every cell the whole layer is
+    materialized once per process; for a filtered view only its rows are read.
+    """
+    if not is_lazy(adata):
+        return adata.X if layer in (None, 'X') else adata.layers[layer]
+    dataset = open_lazy(adata.uns[LAZY_SOURCE_KEY])
+    rows = _source_rows(adata, dataset)
+    if len(rows) == dataset.n_obs and np.array_equal(rows, np.arange(dataset.n_obs)):
+        return dataset.layer(layer or 'X')
+    sorted_rows, inverse = _sorted_rows(rows)
+    return dataset.read_rows(sorted_rows, layer)[inverse]
+
+
+def materialize(adata, layers=None):
+    """Load X and layers for the cells of a lazily opened AnnData (usually a filtered view)
+
+    Only the selected rows are read, so filtering to a few clusters first keeps
+    memory proportional to the selection rather than to the whole file.
+    """
+    if not is_lazy(adata):
+        return adata
+    dataset = open_lazy(adata.uns[LAZY_SOURCE_KEY])
+    rows = _source_rows(adata, dataset)
+    sorted_rows, inverse = _sorted_rows(rows)
+
+    layer_names = dataset.layer_names if layers is None else list(layers)
+    result = ad.AnnData(
+        X=dataset.read_rows(sorted_rows)[inverse],
+        obs=adata.obs.copy(),
+        var=dataset.var.copy(),
+        obsm={key: np.asarray(value) for key, value in adata.obsm.items()},
+        layers={name: dataset.read_rows(sorted_rows, name)[inverse] for name in layer_names},
+        uns={key: value for key, value in adata.uns.items() if key != LAZY_SOURCE_KEY},
+    )
+    return result
@@ -2,39 +2,74 @@
 """
 Large Dataset Optimization Script for MASLDatlas
 Optimizes large datasets for better Shiny performance by:
-1. Creating subsampled versions
+1. Creating stratified, nested subsample indices
 2. Pre-computing essential embeddings
 3. Creating metadata-only versions
 4. Implementing lazy loading strategies
+5. Writing a gene-major (CSC) index for single-gene lookups
+6. Precomputing top-k co-expression neighbors per gene and cell type
+7. Streaming all file outputs in row blocks for datasets larger than RAM
+8. Precomputing Group x CellType pseudobulk count sums for DESeq2
+9. Precomputing per-cell TF/pathway activities of the bundled enrichment resources
+10. Storing matrices sparse or dense by density, with the narrowest lossless dtypes
+11. Precomputing per Group x CellType gene moments for instant marker and DE tables
+12. Partitioning cross-species datasets into per-species/Group shards
 """
 
+import anndata as ad
 import scanpy as sc
 import pandas as pd
-import numpy as np
 import argparse
 from pathlib import Path
 import time
 import warnings
 warnings.filterwarnings('ignore')
 
+from activity_index import activity_path_for, build_activities
+from chunking import DEFAULT_CODEC, benchmark_codecs, chunk_dir_for, write_chunks
+from coexpression_index import build_coexpression_index, coexpression_index_path_for
+from gene_index import build_gene_index, gene_index_path_for
+from group_stats import build_group_stats, group_stats_path_for
+from h5ad_utils import available_codecs
+from layout_optimizer import DEFAULT_RTOL, compact_file, optimize_layout
+from partitioning import build_partitions, find_species_column, obs_columns, partition_dir_for
+from pseudobulk import build_pseudobulk, pseudobulk_path_for
+from subsampling import save_subsamples, size_key, stratified_nested_samples, subsample_path_for
+from lazy_loader import LAZY_SOURCE_KEY, open_lazy
+from streaming_optimizer import DEFAULT_BLOCK_ROWS, peak_rss_bytes, stream_optimize
+
 class DatasetOptimizer:
     def __init__(self, input_file, output_dir="datasets_optimized"):
         self.input_file = Path(input_file)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
         
-    def load_dataset(self):
-        """Load the dataset with memory optimization"""
+    def load_dataset(self, lazy=False):
+        """Load the dataset with memory optimization
+
+        With lazy=True the file is opened in backed mode through
+        lazy_loader.LazyDataset: only obs/var/obsm/uns are read and expression
+        values are pulled from HDF5 on demand.
+        """
         print(f"📥 Loading dataset: {self.input_file}")
         print(f"📊 File size: {self.input_file.stat().st_size / (1024**3):.2f} GB")
         
         start_time = time.time()
+        if lazy:
+            dataset = open_lazy(self.input_file)
+            print(f"✅ Dataset opened lazily in {time.time() - start_time:.1f} seconds")
+            print(f"📈 Shape: {dataset.n_obs:,} cells × {dataset.n_vars:,} genes")
+            print(f"🧬 Layers available on demand: {', '.join(dataset.layer_names) or 'none'}")
+            return dataset
+
         adata = sc.read_h5ad(self.input_file)
         load_time = time.time() - start_time
         
         print(f"✅ Dataset loaded in {load_time:.1f} seconds")
         print(f"📈 Shape: {adata.n_obs:,} cells × {adata.n_vars:,} genes")
-        print(f"🔢 Memory usage: ~{adata.X.nbytes / (1024**3):.2f} GB")
+        X = adata.X
+        x_bytes = X.data.nbytes + X.indices.nbytes + X.indptr.nbytes if hasattr(X, 'indptr') else X.nbytes
+        print(f"🔢 Memory usage: ~{x_bytes / (1024**3):.2f} GB")
         
         return adata
     
@@ -42,12 +77,15 @@ class DatasetOptimizer:
         """Create a metadata-only version (no expression data)"""
         print("🗂️  Creating metadata-only version...")
         
-        # Create a copy with only obs and var metadata
-        adata_meta = adata.copy()
-        
-        # Remove expression data but keep minimal X matrix for compatibility
-        adata_meta.X = None
-        adata_meta.raw = None
+        # Create an AnnData with only the metadata; the matrices are never copied
+        adata_meta = ad.AnnData(
+            obs=adata.obs.copy(),
+            var=adata.var.copy(),
+            obsm=dict(adata.obsm),
+            varm=dict(adata.varm),
+            obsp=dict(adata.obsp),
+            uns={key: value for key, value in adata.uns.items() if key != LAZY_SOURCE_KEY},
+        )
         
         # Keep embeddings and metadata
         # adata_meta.obs is already preserved
@@ -62,53 +100,44 @@ class DatasetOptimizer:
         
         return output_file
     
-    def create_subsampled_versions(self, adata):
-        """Create subsampled versions of different sizes"""
+    def create_subsampled_versions(self, adata, sample_sizes=(5000, 10000, 20000, 50000)):
+        """Create nested, CellType x Group stratified subsamples as row-index arrays
+
+        All sizes are saved in one .npz; the app slices the base dataset (store
+        or lazy) with them instead of loading separate .h5ad copies.
+        """
         print("🎲 Creating subsampled versions...")
         
-        sample_sizes = [5000, 10000, 20000, 50000]
-        output_files = []
-        
         for sample_size in sample_sizes:
             if sample_size >= adata.n_obs:
                 print(f"⏭️  Skipping {sample_size} cells (dataset has only {adata.n_obs} cells)")
-                continue
-                
-            print(f"🔄 Creating {sample_size} cell subsample...")
-            
-            # Random sampling with stratification by cell type if available
-            if 'CellType' in adata.obs.columns:
-                # Stratified sampling
-                sc.pp.subsample(adata, n_obs=sample_size, copy=False)
-            else:
-                # Random sampling
-                np.random.seed(42)
-                sample_indices = np.random.choice(adata.n_obs, sample_size, replace=False)
-                adata_sub = adata[sample_indices].copy()
-            
-            output_file = self.output_dir / f"{self.input_file.stem}_sub{sample_size//1000}k.h5ad"
-            adata_sub.write(output_file, compression='gzip')
-            output_files.append(output_file)
-            
-            print(f"✅ Subsample saved: {output_file}")
-            print(f"📊 Shape: {adata_sub.n_obs:,} cells × {adata_sub.n_vars:,} genes")
-        
-        return output_files
+        
+        samples = stratified_nested_samples(adata.obs, sample_sizes)
+        for sample_size, rows in samples.items():
+            print(f"✅ {size_key(sample_size)}: {len(rows):,} cells")
+        
+        output_file = save_subsamples(samples, subsample_path_for(self.input_file, self.output_dir),
+                                      adata.n_obs, source_path=self.input_file)
+        print(f"✅ Subsample indices saved: {output_file}")
+        
+        return output_file
     
     def optimize_for_shiny(self, adata):
         """Create an optimized version specifically for Shiny performance"""
         print("⚡ Creating Shiny-optimized version...")
         
-        adata_opt = adata.copy()
-        
-        # 1. Keep only highly variable genes for faster processing
-        if 'highly_variable' in adata_opt.var.columns:
+        # 1. Keep only highly variable genes for faster processing; only that slice
+        #    is copied and ``adata`` is left unchanged
+        if 'highly_variable' in adata.var.columns:
             print("🧬 Filtering to highly variable genes...")
-            adata_opt = adata_opt[:, adata_opt.var.highly_variable].copy()
+            adata_opt = adata[:, adata.var.highly_variable].copy()
         else:
             print("🧬 Computing highly variable genes...")
-            sc.pp.highly_variable_genes(adata_opt, min_mean=0.0125, max_mean=3, min_disp=0.5)
-            adata_opt = adata_opt[:, adata_opt.var.highly_variable].copy()
+            hvg = sc.pp.highly_variable_genes(adata, min_mean=0.0125, max_mean=3, min_disp=0.5, inplace=False)
+            # The columns inplace=True would add; mean_bin holds intervals h5ad cannot store
+            hvg = hvg.drop(columns='mean_bin', errors='ignore').set_index(adata.var_names)
+            adata_opt = adata[:, hvg['highly_variable'].to_numpy()].copy()
+            adata_opt.var = adata_opt.var.join(hvg.loc[adata_opt.var_names])
         
         # 2. Ensure embeddings are computed
         if 'X_umap' not in adata_opt.obsm.keys():
@@ -125,58 +154,91 @@ class DatasetOptimizer:
             print("🔗 Computing Leiden clustering...")
             sc.tl.leiden(adata_opt, resolution=0.5)
         
-        # 4. Convert sparse matrices to dense for faster access (only for smaller datasets)
-        if adata_opt.n_obs * adata_opt.n_vars < 50_000_000:  # ~50M elements
-            print("💾 Converting to dense matrix for faster access...")
-            adata_opt.X = adata_opt.X.toarray()
+        # 4. Compact storage layout: sparse or dense by measured density, narrowest lossless
+        #    dtypes, categorical obs strings and float32 embeddings
+        print("💾 Optimizing the storage layout...")
+        layout = optimize_layout(adata_opt)
         
         output_file = self.output_dir / f"{self.input_file.stem}_shiny_optimized.h5ad"
         adata_opt.write(output_file, compression='gzip')
         
         print(f"✅ Shiny-optimized version saved: {output_file}")
         print(f"📊 Shape: {adata_opt.n_obs:,} cells × {adata_opt.n_vars:,} genes")
+        # Measured on the filtered object, so HVG filtering is not credited to the layout
+        before, after = layout['memory_before'], layout['memory_after']
+        print(f"📊 Layout: {before / (1024**2):.1f} → {after / (1024**2):.1f} MB in memory "
+              f"({before / after:.1f}x), {output_file.stat().st_size / (1024**2):.1f} MB on disk")
         
         return output_file
     
-    def create_progressive_loading_chunks(self, adata, chunk_size=10000):
-        """Create chunks for progressive loading"""
+    def create_compact_layout(self, rtol=DEFAULT_RTOL):
+        """Write a copy of the full dataset in the compact storage layout"""
+        output_file = self.output_dir / f"{self.input_file.stem}_compact.h5ad"
+        return compact_file(self.input_file, output_file, rtol=rtol)
+    
+    def create_progressive_loading_chunks(self, chunk_size=10000, codec=DEFAULT_CODEC, workers=None):
+        """Create chunks for progressive loading
+
+        Chunks are written on a process pool straight from the .h5ad file; the
+        manifest records the codec, byte ranges and CellType/Group counts per chunk.
+        """
         print(f"📦 Creating chunks for progressive loading (chunk size: {chunk_size})...")
         
-        chunk_dir = self.output_dir / f"{self.input_file.stem}_chunks"
-        chunk_dir.mkdir(exist_ok=True)
-        
-        n_chunks = (adata.n_obs + chunk_size - 1) // chunk_size
-        chunk_files = []
-        
-        for i in range(n_chunks):
-            start_idx = i * chunk_size
-            end_idx = min((i + 1) * chunk_size, adata.n_obs)
-            
-            chunk_data = adata[start_idx:end_idx].copy()
-            chunk_file = chunk_dir / f"chunk_{i:03d}.h5ad"
-            chunk_data.write(chunk_file, compression='gzip')
-            chunk_files.append(chunk_file)
-            
-            print(f"📦 Chunk {i+1}/{n_chunks}: {chunk_data.n_obs} cells saved to {chunk_file}")
-        
-        # Create manifest file
-        manifest = {
-            'original_file': str(self.input_file),
-            'total_cells': adata.n_obs,
-            'total_genes': adata.n_vars,
-            'chunk_size': chunk_size,
-            'n_chunks': n_chunks,
-            'chunk_files': [str(f) for f in chunk_files]
-        }
-        
-        manifest_file = chunk_dir / "manifest.json"
-        import json
-        with open(manifest_file, 'w') as f:
-            json.dump(manifest, f, indent=2)
+        chunk_dir = write_chunks(self.input_file, chunk_dir_for(self.input_file, self.output_dir),
+                                 chunk_size=chunk_size, codec=codec, workers=workers)
         
         print(f"✅ Progressive loading chunks created in {chunk_dir}")
         return chunk_dir
     
+    def benchmark_chunk_codecs(self, chunk_size=10000):
+        """Compare write time, read time and size of one chunk for each available codec"""
+        print("⏱️  Benchmarking chunk compression codecs...")
+        return benchmark_codecs(self.input_file, self.output_dir, chunk_size=chunk_size)
+    
+    def create_gene_index(self, layers=("X", "counts", "scvi_normalized")):
+        """Write a gene-major copy of the expression layers for O(nnz) gene lookups"""
+        print("🧬 Creating gene-major expression index...")
+        # Built straight from the HDF5 file in row blocks, never loading the matrices
+        index_dir = gene_index_path_for(self.input_file, self.output_dir)
+        return build_gene_index(self.input_file, index_dir, layers=layers)
+    
+    def create_coexpression_index(self, adata, k=100):
+        """Precompute the top-k correlated genes of every gene, overall and per CellType"""
+        print("🔗 Creating co-expression neighbor index...")
+        index_dir = coexpression_index_path_for(self.input_file, self.output_dir)
+        return build_coexpression_index(adata, index_dir, source_path=self.input_file, k=k)
+    
+    def create_pseudobulk(self, layer="counts"):
+        """Precompute Group x CellType sums of the counts layer for the DESeq2 tab"""
+        print("🧮 Creating pseudobulk profiles...")
+        # Aggregated in row blocks straight from the HDF5 file
+        return build_pseudobulk(self.input_file, pseudobulk_path_for(self.input_file, self.output_dir), layer=layer)
+    
+    def create_group_stats(self):
+        """Precompute per Group x CellType sums, sums of squares and non-zero counts for the DE tables"""
+        print("📐 Creating per-group statistics...")
+        # Accumulated in row blocks straight from the HDF5 file
+        return build_group_stats(self.input_file, group_stats_path_for(self.input_file, self.output_dir))
+    
+    def create_partitions(self, columns=None, codec=DEFAULT_CODEC, species_only=False):
+        """Split the dataset into species x Group shards sharing one var index and embedding space
+
+        With species_only=True datasets without a species column are skipped.
+        """
+        if species_only and find_species_column(obs_columns(self.input_file)) is None:
+            print("⏭️  No species column, skipping partitions")
+            return None
+        print("🗂️  Creating species/Group partitions...")
+        # Split in one row-block pass straight from the HDF5 file
+        return build_partitions(self.input_file, partition_dir_for(self.input_file, self.output_dir),
+                                columns=columns, codec=codec)
+    
+    def create_activities(self, dtype="float16"):
+        """Precompute CollecTRI/PROGENy/MSigDB activities of every cell with summaries per CellType and Group"""
+        print("🧪 Creating gene-set activity matrices...")
+        # Scored in row blocks straight from the HDF5 file
+        return build_activities(self.input_file, activity_path_for(self.input_file, self.output_dir), dtype=dtype)
+    
     def optimize_all(self):
         """Run all optimization strategies"""
         print("🚀 Starting dataset optimization...")
@@ -195,26 +257,110 @@ class DatasetOptimizer:
         
         # 2. Subsampled versions
         try:
-            results['subsamples'] = self.create_subsampled_versions(adata.copy())
+            results['subsamples'] = self.create_subsampled_versions(adata)
         except Exception as e:
             print(f"❌ Subsampling failed: {e}")
         
         # 3. Shiny-optimized version
         try:
-            results['shiny_optimized'] = self.optimize_for_shiny(adata.copy())
+            results['shiny_optimized'] = self.optimize_for_shiny(adata)
         except Exception as e:
             print(f"❌ Shiny optimization failed: {e}")
         
         # 4. Progressive loading chunks (only for very large datasets)
         if adata.n_obs > 100000:
             try:
-                results['chunks'] = self.create_progressive_loading_chunks(adata.copy())
+                results['chunks'] = self.create_progressive_loading_chunks()
             except Exception as e:
                 print(f"❌ Chunking failed: {e}")
         
+        # 5. Gene-major index for expression plots
+        try:
+            results['gene_index'] = self.create_gene_index()
+        except Exception as e:
+            print(f"❌ Gene index creation failed: {e}")
+        
+        # 6. Co-expression neighbors for "Find Correlated Genes"
+        try:
+            results['coexpression'] = self.create_coexpression_index(adata)
+        except Exception as e:
+            print(f"❌ Co-expression index creation failed: {e}")
+        
+        # 7. Pseudobulk profiles for DESeq2
+        try:
+            results['pseudobulk'] = self.create_pseudobulk()
+        except Exception as e:
+            print(f"❌ Pseudobulk creation failed: {e}")
+        
+        # 8. TF/pathway activities for the enrichment views
+        try:
+            results['activities'] = self.create_activities()
+        except Exception as e:
+            print(f"❌ Activity matrix creation failed: {e}")
+        
+        # 9. Per-group statistics for marker and DE tables
+        try:
+            results['group_stats'] = self.create_group_stats()
+        except Exception as e:
+            print(f"❌ Group statistics creation failed: {e}")
+        
+        # 10. Species/Group partitions (cross-species datasets)
+        try:
+            results['partitions'] = self.create_partitions(species_only=True)
+        except Exception as e:
+            print(f"❌ Partitioning failed: {e}")
+        
         print("=" * 60)
         print("✅ Dataset optimization complete!")
         print(f"📁 Output directory: {self.output_dir}")
+        print(f"🧠 Peak RSS: {peak_rss_bytes() / (1024**3):.2f} GB")
+        
+        return results
+    
+    def optimize_all_streaming(self, block_rows=DEFAULT_BLOCK_ROWS, chunk_size=10000, codec=DEFAULT_CODEC):
+        """Run all file-producing strategies in one out-of-core pass over the HDF5 file
+
+        Peak memory is bounded by ``block_rows`` rows of one matrix instead of
+        several in-memory copies of the dataset. The co-expression index needs
+        X in memory and is left to --strategy coexpression.
+        """
+        print("🚀 Starting streaming dataset optimization...")
+        print("=" * 60)
+        
+        results = stream_optimize(self.input_file, self.output_dir, block_rows=block_rows,
+                                  chunk_size=chunk_size, codec=codec)
+        
+        # The gene-major index, pseudobulk profiles, activities, group statistics and partitions are built in
+        # row blocks as well
+        try:
+            results['gene_index'] = self.create_gene_index()
+        except Exception as e:
+            print(f"❌ Gene index creation failed: {e}")
+        
+        try:
+            results['pseudobulk'] = self.create_pseudobulk()
+        except Exception as e:
+            print(f"❌ Pseudobulk creation failed: {e}")
+        
+        try:
+            results['activities'] = self.create_activities()
+        except Exception as e:
+            print(f"❌ Activity matrix creation failed: {e}")
+        
+        try:
+            results['group_stats'] = self.create_group_stats()
+        except Exception as e:
+            print(f"❌ Group statistics creation failed: {e}")
+        
+        try:
+            results['partitions'] = self.create_partitions(codec=codec, species_only=True)
+        except Exception as e:
+            print(f"❌ Partitioning failed: {e}")
+        
+        print("=" * 60)
+        print("✅ Streaming optimization complete!")
+        print(f"📁 Output directory: {self.output_dir}")
+        print(f"🧠 Peak RSS: {peak_rss_bytes() / (1024**3):.2f} GB")
         
         return results
 
@@ -223,27 +369,61 @@ def main():
     parser.add_argument("input_file", help="Path to input .h5ad file")
     parser.add_argument("--output-dir", default="datasets_optimized", 
                        help="Output directory for optimized files")
-    parser.add_argument("--strategy", choices=["all", "metadata", "subsample", "optimize", "chunk"],
+    parser.add_argument("--strategy", choices=["all", "metadata", "subsample", "optimize", "chunk",
+                                               "gene-index", "coexpression", "benchmark-codecs", "pseudobulk",
+                                               "activities", "layout", "group-stats", "partition"],
                        default="all", help="Optimization strategy to use")
+    parser.add_argument("--streaming", action="store_true",
+                       help="Out-of-core mode for --strategy all: one row-block pass, bounded memory")
+    parser.add_argument("--block-rows", type=int, default=DEFAULT_BLOCK_ROWS,
+                       help="Rows read per block in streaming mode (bounds peak memory)")
+    parser.add_argument("--codec", default=DEFAULT_CODEC,
+                       help=f"Chunk compression codec ({', '.join(available_codecs())})")
+    parser.add_argument("--rtol", type=float, default=DEFAULT_RTOL,
+                       help="Relative error allowed when narrowing float matrices (--strategy layout)")
+    parser.add_argument("--partition-columns", nargs="+", default=None,
+                       help="obs columns to partition by (--strategy partition; default: species column and Group)")
+    parser.add_argument("--workers", type=int, default=None,
+                       help="Processes writing chunks in parallel (default: CPU count, at most 8)")
     
     args = parser.parse_args()
     
     optimizer = DatasetOptimizer(args.input_file, args.output_dir)
     
-    if args.strategy == "all":
+    if args.strategy == "all" and args.streaming:
+        optimizer.optimize_all_streaming(block_rows=args.block_rows, codec=args.codec)
+    elif args.strategy == "all":
         optimizer.optimize_all()
     elif args.strategy == "metadata":
-        adata = optimizer.load_dataset()
+        # Metadata-only output never needs the expression matrices
+        adata = optimizer.load_dataset(lazy=True).to_anndata()
         optimizer.create_metadata_only(adata)
     elif args.strategy == "subsample":
-        adata = optimizer.load_dataset()
-        optimizer.create_subsampled_versions(adata)
+        # Sampling only needs obs
+        optimizer.create_subsampled_versions(optimizer.load_dataset(lazy=True).to_anndata())
     elif args.strategy == "optimize":
         adata = optimizer.load_dataset()
         optimizer.optimize_for_shiny(adata)
     elif args.strategy == "chunk":
+        # Workers read their rows straight from the file
+        optimizer.create_progressive_loading_chunks(codec=args.codec, workers=args.workers)
+    elif args.strategy == "benchmark-codecs":
+        optimizer.benchmark_chunk_codecs()
+    elif args.strategy == "pseudobulk":
+        optimizer.create_pseudobulk()
+    elif args.strategy == "activities":
+        optimizer.create_activities()
+    elif args.strategy == "group-stats":
+        optimizer.create_group_stats()
+    elif args.strategy == "partition":
+        optimizer.create_partitions(columns=args.partition_columns, codec=args.codec)
+    elif args.strategy == "layout":
+        optimizer.create_compact_layout(rtol=args.rtol)
+    elif args.strategy == "gene-index":
+        optimizer.create_gene_index()
+    elif args.strategy == "coexpression":
         adata = optimizer.load_dataset()
-        optimizer.create_progressive_loading_chunks(adata)
+        optimizer.create_coexpression_index(adata)
 
 if __name__ == "__main__":
     main()
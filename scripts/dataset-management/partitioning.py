@@ -0,0 +1,436 @@
+"""
+Species/Group Partitions for MASLDatlas
+Splits a cross-species .h5ad (the 9.2 GB 'Fibrotic Integrated Cross
+Species-002') into one shard per species x Group, written in a single
+row-block pass over the HDF5 file. Users nearly always look at one species or
+condition at a time, and a shard holds only those cells.
+
+Every shard keeps the genes in the same order and the embeddings in the
+coordinates of the whole atlas. var, varm, uns and raw/var are stored once in
+shared.h5, and the manifest (<stem>_partitions/manifest.json) records per
+shard its partition keys, cells, stored values and CellType counts, along with
+the bounds of every embedding so a plot of one partition can keep the atlas axes.
+
+load_partitions() reads only the shards matching a {column: levels} filter:
+their matrices are read straight into buffers sized from the manifest, so
+the cells are concatenated without a per-shard copy, and the load cost scales
+with the selected shards instead of the whole file.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from gene_index import DEFAULT_INDEX_DIR
+from h5ad_utils import (H5adWriter, available_codecs, index_dtype_for, iter_row_blocks, matrix_dtype,
+                        matrix_elements, matrix_format, matrix_shape, read_elem, read_metadata, take_rows,
+                        write_elem)
+
+DEFAULT_CODEC = 'gzip:4'
+SPECIES_COLUMNS = ('Species', 'species', 'Organism', 'organism')
+GROUP_COLUMN = 'Group'
+COUNT_COLUMNS = ('CellType',)
+MANIFEST_VERSION = 1
+# uns key listing the partitions an AnnData was loaded from
+PARTITIONS_KEY = '_partitions'
+# Loaded selections kept in memory; each new AnnData shares their arrays
+LOADED_CACHE_SIZE = 2
+
+_LOADED = OrderedDict()
+_LOADED_LOCK = threading.Lock()
+
+
+def partition_dir_for(h5ad_path, index_dir=None):
+    """Default location of the partitions of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_partitions"
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def find_species_column(columns):
+    """The obs column naming the species of each cell, or None"""
+    return next((column for column in SPECIES_COLUMNS if column in columns), None)
+
+
+def obs_columns(h5ad_path):
+    """Column names of the obs table of an .h5ad file, read without loading it"""
+    with h5py.File(h5ad_path, 'r') as f:
+        return [name for name in f['obs'].keys() if name != f['obs'].attrs.get('_index', '_index')]
+
+
+def partition_columns(obs):
+    """Default partition columns of an obs table: the species column and Group, when present"""
+    columns = [column for column in (find_species_column(obs.columns), GROUP_COLUMN)
+               if column is not None and column in obs.columns]
+    if not columns:
+        raise ValueError(f"No species ({', '.join(SPECIES_COLUMNS)}) or {GROUP_COLUMN} column to partition by")
+    return columns
+
+
+def _embedding_bounds(obsm):
+    """{key: {'min': [...], 'max': [...]}} of the numeric embeddings"""
+    bounds = {}
+    for key, value in obsm.items():
+        if isinstance(value, np.ndarray) and value.ndim == 2 and value.dtype.kind in 'fi' and len(value):
+            bounds[key] = {'min': np.nanmin(value, axis=0).astype(float).tolist(),
+                           'max': np.nanmax(value, axis=0).astype(float).tolist()}
+    return bounds
+
+
+def _value_counts(obs):
+    counts = {}
+    for column in COUNT_COLUMNS:
+        if column in obs.columns:
+            values = obs[column].astype(str).value_counts()
+            counts[column] = {str(k): int(v) for k, v in values.items() if v}
+    return counts
+
+
+def _write_shared(path, meta):
+    """Write the var, varm, uns and raw/var shared by every shard"""
+    tmp_path = Path(path).with_name(Path(path).name + '.tmp')
+    with h5py.File(tmp_path, 'w') as f:
+        write_elem(f, 'var', meta['var'], dataset_kwargs={'compression': 'gzip'})
+        write_elem(f, 'varm', meta['varm'], dataset_kwargs={'compression': 'gzip'})
+        write_elem(f, 'uns', meta['uns'])
+        if meta['raw_var'] is not None:
+            write_elem(f, 'raw_var', meta['raw_var'], dataset_kwargs={'compression': 'gzip'})
+    os.replace(tmp_path, path)
+
+
+def build_partitions(h5ad_path, partition_dir, columns=None, codec=DEFAULT_CODEC, block_rows=50000):
+    """Write one shard per combination of the partition columns and the manifest
+
+    ``columns`` defaults to the species column and Group. The source is read
+    once, in blocks of ``block_rows`` rows, and each block is split among
+    the shards, so memory is bounded by one block whatever the file size.
+    """
+    h5ad_path = Path(h5ad_path)
+    partition_dir = Path(partition_dir)
+    partition_dir.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+
+    with h5py.File(h5ad_path, 'r') as f:
+        meta = read_metadata(f)
+        obs = meta['obs']
+        columns = list(columns or partition_columns(obs))
+        missing = [column for column in columns if column not in obs.columns]
+        if missing:
+            raise ValueError(f"Partition columns not found in obs: {', '.join(missing)}")
+
+        keys = obs[columns].astype(str)
+        codes, levels = pd.MultiIndex.from_frame(keys).factorize(sort=True)
+        print(f"🗂️  Partitioning {h5ad_path.name} by {' × '.join(columns)} into {len(levels)} shards...")
+
+        elements = list(matrix_elements(f))
+        # Shards only carry the gene names; annotations live in shared.h5
+        var_index = meta['var'][[]]
+        raw_index = meta['raw_var'][[]] if meta['raw_var'] is not None else None
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(levels) + 1))
+        partitions = []
+        for i, level in enumerate(levels):
+            rows = order[bounds[i]:bounds[i + 1]]
+            path = partition_dir / f"part_{i:03d}.h5ad"
+            writer = H5adWriter(path, elements, obs.iloc[rows], var_index,
+                                {key: take_rows(value, rows) for key, value in meta['obsm'].items()},
+                                {}, raw_var=raw_index, compression=codec)
+            rows_file = partition_dir / f"part_{i:03d}_rows.npy"
+            np.save(rows_file, rows.astype(index_dtype_for(len(obs))))
+            partitions.append({'name': path.stem, 'file': path.name, 'rows_file': rows_file.name,
+                               'keys': dict(zip(columns, (str(value) for value in level))),
+                               'n_cells': int(len(rows)), 'counts': _value_counts(obs.iloc[rows]),
+                               'writer': writer})
+
+        matrices = {}
+        for key, elem in elements:
+            if key == 'raw/X' and raw_index is None:
+                continue
+            fmt = 'dense' if matrix_format(elem) == 'dense' else 'csr'
+            matrices[key] = {'format': fmt, 'dtype': np.dtype(matrix_dtype(elem)).str,
+                             'n_cols': int(matrix_shape(elem)[1])}
+            for start, end, block in iter_row_blocks(elem, block_rows):
+                block_codes = codes[start:end]
+                block_order = np.argsort(block_codes, kind='stable')
+                block_bounds = np.searchsorted(block_codes[block_order], np.arange(len(levels) + 1))
+                for i in np.unique(block_codes):
+                    local = block_order[block_bounds[i]:block_bounds[i + 1]]
+                    partitions[i]['writer'].append(key, block[local])
+            print(f"🗂️  {key} split into {len(levels)} shards")
+
+    for entry in partitions:
+        writer = entry.pop('writer')
+        entry['nnz'] = {key: int(writer.appenders[key].nnz) for key, info in matrices.items()
+                        if info['format'] == 'csr'}
+        writer.close()
+        entry['bytes'] = os.path.getsize(partition_dir / entry['file'])
+    _write_shared(partition_dir / 'shared.h5', meta)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'original_file': str(h5ad_path),
+        **_source_signature(h5ad_path),
+        'total_cells': int(len(obs)),
+        'total_genes': int(len(meta['var'])),
+        'partition_columns': columns,
+        'codec': str(codec),
+        'matrices': matrices,
+        'embeddings': _embedding_bounds(meta['obsm']),
+        'partitions': partitions,
+    }
+    tmp_file = partition_dir / 'manifest.json.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, partition_dir / 'manifest.json')
+
+    for entry in partitions:
+        print(f"🗂️  {entry['name']}: {', '.join(f'{k}={v}' for k, v in entry['keys'].items())} - "
+              f"{entry['n_cells']:,} cells, {entry['bytes'] / (1024**2):.1f} MB")
+    print(f"✅ {len(partitions)} partitions written in {time.time() - start_time:.1f} seconds: {partition_dir}")
+    return partition_dir
+
+
+def read_manifest(partition_dir):
+    """The manifest of a partition directory, or None if it is missing"""
+    manifest_file = Path(partition_dir) / 'manifest.json'
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def is_current(partition_dir, h5ad_path=None):
+    """Check that partitions exist and were written from the current version of their source"""
+    manifest = read_manifest(partition_dir)
+    if manifest is None or manifest.get('version') != MANIFEST_VERSION:
+        return False
+    if h5ad_path is None or not os.path.exists(h5ad_path):
+        return True
+    signature = _source_signature(h5ad_path)
+    return all(manifest.get(key) == value for key, value in signature.items())
+
+
+def _normalize_where(where):
+    """{column: set of str levels} from {column: level or list of levels}; empty filters are dropped"""
+    normalized = {}
+    for column, levels in dict(where or {}).items():
+        if levels is None:
+            continue
+        levels = {str(level) for level in ([levels] if isinstance(levels, str) else levels)}
+        if levels:
+            normalized[column] = levels
+    return normalized
+
+
+def select_partitions(manifest, where=None):
+    """Manifest entries of the partitions whose keys match every {column: levels} criterion"""
+    where = _normalize_where(where)
+    unknown = [column for column in where if column not in manifest['partition_columns']]
+    if unknown:
+        raise ValueError(f"Not a partition column: {', '.join(unknown)} "
+                         f"(partitioned by {', '.join(manifest['partition_columns'])})")
+    return [entry for entry in manifest['partitions']
+            if all(entry['keys'][column] in levels for column, levels in where.items())]
+
+
+def partition_levels(partition_dir):
+    """{partition column: sorted levels} of a partition directory"""
+    manifest = read_manifest(partition_dir)
+    return {column: sorted({entry['keys'][column] for entry in manifest['partitions']})
+            for column in manifest['partition_columns']}
+
+
+def _read_shared(partition_dir):
+    with h5py.File(Path(partition_dir) / 'shared.h5', 'r') as f:
+        return {
+            'var': read_elem(f['var']),
+            'varm': read_elem(f['varm']) if 'varm' in f else {},
+            'uns': read_elem(f['uns']) if 'uns' in f else {},
+            'raw_var': read_elem(f['raw_var']) if 'raw_var' in f else None,
+        }
+
+
+def _read_into(dataset, out, start):
+    """Read a whole HDF5 dataset into out[start:start + len(dataset)]"""
+    if dataset.shape[0]:
+        dataset.read_direct(out, dest_sel=np.s_[start:start + dataset.shape[0]])
+
+
+def _read_matrix(files, entries, key, info, n_obs):
+    """One matrix element of the selected shards, read into a single preallocated buffer"""
+    n_cols = info['n_cols']
+    dtype = np.dtype(info['dtype'])
+    if info['format'] == 'dense':
+        out = np.empty((n_obs, n_cols), dtype=dtype)
+        row = 0
+        for f, entry in zip(files, entries):
+            _read_into(f[key], out, row)
+            row += entry['n_cells']
+        return out
+
+    nnz = sum(entry['nnz'][key] for entry in entries)
+    # One index dtype for indices and indptr, so scipy keeps the buffers as they are
+    index_dtype = index_dtype_for(max(nnz, n_cols))
+    data = np.empty(nnz, dtype=dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    indptr = np.empty(n_obs + 1, dtype=index_dtype)
+    indptr[0] = 0
+    row = offset = 0
+    for f, entry in zip(files, entries):
+        elem = f[key]
+        _read_into(elem['data'], data, offset)
+        _read_into(elem['indices'], indices, offset)
+        n_cells = entry['n_cells']
+        indptr[row + 1:row + n_cells + 1] = elem['indptr'][1:] + offset
+        row += n_cells
+        offset += entry['nnz'][key]
+    return sp.csr_matrix((data, indices, indptr), shape=(n_obs, n_cols))
+
+
+def _read_obsm(files, entries, n_obs):
+    obsm = {}
+    for name in files[0]['obsm'].keys() if files and 'obsm' in files[0] else []:
+        first = files[0]['obsm'][name]
+        if isinstance(first, h5py.Dataset):
+            out = np.empty((n_obs,) + first.shape[1:], dtype=first.dtype)
+            row = 0
+            for f, entry in zip(files, entries):
+                _read_into(f['obsm'][name], out, row)
+                row += entry['n_cells']
+            obsm[name] = out
+        else:
+            obsm[name] = pd.concat([read_elem(f['obsm'][name]) for f in files])
+    return obsm
+
+
+def _load_arrays(partition_dir, names, include_raw):
+    """obs, matrices and obsm of the named partitions, concatenated in manifest order"""
+    partition_dir = Path(partition_dir)
+    manifest = read_manifest(partition_dir)
+    entries = [entry for entry in manifest['partitions'] if entry['name'] in set(names)]
+    n_obs = sum(entry['n_cells'] for entry in entries)
+    matrices = {key: info for key, info in manifest['matrices'].items() if include_raw or key != 'raw/X'}
+
+    files = [h5py.File(partition_dir / entry['file'], 'r') for entry in entries]
+    try:
+        # Shards share the categories of the source, so concatenated columns stay categorical
+        obs = pd.concat([read_elem(f['obs']) for f in files]) if files else pd.DataFrame()
+        arrays = {
+            'obs': obs,
+            'matrices': {key: _read_matrix(files, entries, key, info, n_obs) for key, info in matrices.items()},
+            'obsm': _read_obsm(files, entries, n_obs),
+        }
+    finally:
+        for f in files:
+            f.close()
+    arrays['shared'] = _read_shared(partition_dir)
+    arrays['names'] = [entry['name'] for entry in entries]
+    return arrays
+
+
+def load_partitions(partition_dir, where=None, include_raw=True):
+    """AnnData of the cells of the partitions matching a {column: levels} filter
+
+    ``where`` holds partition columns only, e.g. {'Species': ['Human']} or
+    {'Species': 'Mouse', 'Group': ['NAFLD', 'NASH']}; no filter loads every
+    partition. Cells come in partition order. Loaded selections are cached
+    and every call returns a new AnnData (own obs/var/uns) sharing their
+    matrices, as dataset_store does for whole datasets.
+    """
+    partition_dir = Path(partition_dir)
+    manifest = read_manifest(partition_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No partition manifest in {partition_dir}")
+    names = tuple(entry['name'] for entry in select_partitions(manifest, where))
+    key = (str(partition_dir.resolve()), (partition_dir / 'manifest.json').stat().st_mtime_ns, names, include_raw)
+
+    with _LOADED_LOCK:
+        arrays = _LOADED.get(key)
+        if arrays is not None:
+            _LOADED.move_to_end(key)
+    if arrays is None:
+        arrays = _load_arrays(partition_dir, names, include_raw)
+        with _LOADED_LOCK:
+            _LOADED[key] = arrays
+            while len(_LOADED) > LOADED_CACHE_SIZE:
+                _LOADED.popitem(last=False)
+
+    matrices = arrays['matrices']
+    shared = arrays['shared']
+    n_vars = len(shared['var'])
+    adata = ad.AnnData(
+        X=matrices.get('X', sp.csr_matrix((len(arrays['obs']), n_vars), dtype=np.float32)),
+        obs=arrays['obs'].copy(),
+        var=shared['var'].copy(),
+        obsm=dict(arrays['obsm']),
+        varm=dict(shared['varm']),
+        layers={name.split('/', 1)[1]: matrix for name, matrix in matrices.items() if name.startswith('layers/')},
+        uns=dict(shared['uns']),
+    )
+    if 'raw/X' in matrices and shared['raw_var'] is not None:
+        adata.raw = ad.AnnData(X=matrices['raw/X'], var=shared['raw_var'].copy())
+    adata.uns[PARTITIONS_KEY] = list(arrays['names'])
+    return adata
+
+
+def loaded_partitions(adata):
+    """Sorted names of the partitions an AnnData was loaded from, or None for a whole dataset"""
+    names = adata.uns.get(PARTITIONS_KEY)
+    return None if names is None else sorted(str(name) for name in names)
+
+
+def source_rows(partition_dir, names):
+    """Rows of the source file of the cells of the named partitions, in load order"""
+    partition_dir = Path(partition_dir)
+    manifest = read_manifest(partition_dir)
+    rows = [np.load(partition_dir / entry['rows_file']) for entry in manifest['partitions']
+            if entry['name'] in set(names)]
+    return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+
+def open_partitions(h5ad_path, where=None, index_dir=None, include_raw=True):
+    """Partitions of an .h5ad matching ``where`` if current ones were written, else None"""
+    partition_dir = partition_dir_for(h5ad_path, index_dir)
+    if not is_current(partition_dir, h5ad_path):
+        return None
+    return load_partitions(partition_dir, where, include_raw)
+
+
+def available_levels(h5ad_path, index_dir=None):
+    """{partition column: levels} of the current partitions of an .h5ad, or None"""
+    partition_dir = partition_dir_for(h5ad_path, index_dir)
+    if not is_current(partition_dir, h5ad_path):
+        return None
+    return partition_levels(partition_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partition an .h5ad into species/Group shards")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--output-dir", default=DEFAULT_INDEX_DIR, help="Directory for the partition folder")
+    parser.add_argument("--columns", nargs="+", default=None,
+                        help=f"obs columns to partition by (default: species column and {GROUP_COLUMN})")
+    parser.add_argument("--codec", default=DEFAULT_CODEC,
+                        help=f"Compression codec ({', '.join(available_codecs())})")
+    parser.add_argument("--block-rows", type=int, default=50000, help="Rows read per block")
+    args = parser.parse_args()
+
+    build_partitions(args.input_file, partition_dir_for(args.input_file, args.output_dir), args.columns,
+                     args.codec, args.block_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Plot Image Cache for MASLDatlas
+Renders UMAP and violin PNGs once per (dataset, cell subset, plot kind,
+color key, layer, palette, dpi and plotting options) and serves repeats from
+a content-addressed image cache shared by every session and worker. Each
+request gets its own copy of the image under a unique path, so concurrent
+sessions no longer overwrite each other's figures/umap.png, and the app can
+delete its copy once displayed. Images are evicted least-recently-used above
+a disk budget. UMAPs of more than RASTER_UMAP_MIN_CELLS cells are drawn by the
+rasterized renderer of umap_raster instead of one marker per cell.
+
+``warm_up`` pre-renders the CellType/Group UMAPs and the UMAPs of the top
+marker genes of a dataset at deploy time, with the same arguments the app
+uses, so the first session finds them in the cache.
+
+Cache layout (<cache dir>/plots/):
+    <key[:2]>/<key>.png        rendered image; mtime is the last use
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+from result_cache import ResultCache
+from umap_raster import OPTIONS as RASTER_OPTIONS
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('MASLDATLAS_CACHE_DIR', 'cache'), 'plots')
+DEFAULT_MAX_MB = int(os.environ.get('PLOT_CACHE_MAX_MB', 1024))
+OUTPUT_DIR = os.path.join(tempfile.gettempdir(), 'masldatlas-plots')
+PLOT_LIBRARIES = ('scanpy', 'matplotlib', 'anndata', 'numpy')
+DEFAULT_WARM_UP_GENES = 3
+RASTER_MIN_CELLS = int(os.environ.get('RASTER_UMAP_MIN_CELLS', 200000))
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+# pyplot keeps global state: one render at a time per process
+_RENDER_LOCK = threading.Lock()
+
+
+class PlotCache(ResultCache):
+    suffix = '.png'
+
+    def lookup(self, key):
+        """Path of a cached image, or None; a hit marks the entry as recently used"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key, image_path):
+        """Move a rendered image into the cache and evict beyond the size limit"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(image_path, path)
+        self.evict()
+        return path
+
+
+def default_plot_cache(cache_dir=None, max_mb=None):
+    """The process-wide PlotCache of a directory"""
+    cache_dir = str(cache_dir or DEFAULT_CACHE_DIR)
+    with _CACHES_LOCK:
+        cache = _CACHES.get(cache_dir)
+        if cache is None:
+            cache = PlotCache(cache_dir, max_mb or DEFAULT_MAX_MB)
+            _CACHES[cache_dir] = cache
+        return cache
+
+
+def subset_signature(adata):
+    """Digest of the cells of an AnnData (names and order)"""
+    hashes = pd.util.hash_pandas_object(pd.Index(adata.obs_names), index=False).to_numpy()
+    return f"{adata.n_obs}:{hashlib.sha256(hashes.tobytes()).hexdigest()}"
+
+
+def request_path(output_dir=OUTPUT_DIR):
+    """Unique path of one request's image under ``output_dir``"""
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    return str(Path(output_dir) / f"{uuid.uuid4().hex}.png")
+
+
+def _request_copy(path, output_dir=OUTPUT_DIR):
+    """Unique per-request copy of a cached image (a hard link when possible)"""
+    out_path = request_path(output_dir)
+    try:
+        os.link(path, out_path)
+    except OSError:
+        shutil.copyfile(path, out_path)
+    return str(out_path)
+
+
+def _savefig_dpi(dpi):
+    if dpi is not None:
+        return dpi
+    import matplotlib
+    # sc.set_figure_params(dpi_save=...) sets this
+    return matplotlib.rcParams['savefig.dpi']
+
+
+def _draw(kind, adata, color, layer, palette, groupby, kwargs):
+    import scanpy as sc
+
+    if kind == 'umap':
+        sc.pl.umap(adata, color=color, layer=layer, palette=palette, show=False, **kwargs)
+    elif kind == 'raster_umap':
+        from umap_raster import umap
+        umap(adata, color, layer=layer, palette=palette, **kwargs)
+    elif kind == 'violin':
+        sc.pl.violin(adata, keys=color, groupby=groupby, layer=layer, show=False, **kwargs)
+    else:
+        raise ValueError(f"Unknown plot kind '{kind}'")
+
+
+def render(kind, adata, color, dataset_path, layer=None, palette=None, dpi=None, groupby=None, subset=None,
+           cache=None, output_dir=OUTPUT_DIR, **kwargs):
+    """Path of a fresh copy of a UMAP or violin PNG, rendered only on a cache miss
+
+    ``kind`` is 'umap' (sc.pl.umap colored by ``color``), 'raster_umap'
+    (umap_raster.umap, also used for 'umap' from RASTER_MIN_CELLS cells on
+    when it supports the options) or 'violin' (sc.pl.violin of ``color`` by
+    ``groupby``); other keyword arguments are passed to the plotting function
+    and are part of the cache key, together with the dataset checksum, the
+    cells of ``adata`` (plus an optional ``subset`` description) and the
+    stored colors of the color key. The returned file belongs to the caller,
+    who may delete it.
+    """
+    import matplotlib.pyplot as plt
+
+    cache = cache or default_plot_cache()
+    dpi = _savefig_dpi(dpi)
+    if kind == 'umap' and adata.n_obs >= RASTER_MIN_CELLS and set(kwargs) <= RASTER_OPTIONS:
+        kind = 'raster_umap'
+    colors = [color] if isinstance(color, str) else list(color)
+    key = cache.make_key(f"plot:{kind}", dataset_path, {
+        'cells': subset_signature(adata),
+        'subset': subset,
+        'color': colors,
+        'layer': layer,
+        'palette': palette,
+        'stored_colors': {c: adata.uns.get(f"{c}_colors") for c in colors + ([groupby] if groupby else [])},
+        'groupby': groupby,
+        'dpi': dpi,
+        'kwargs': kwargs,
+    }, libraries=PLOT_LIBRARIES)
+
+    path = cache.lookup(key)
+    if path is None:
+        cache.cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.png', dir=cache.cache_dir)
+        os.close(fd)
+        try:
+            with _RENDER_LOCK:
+                try:
+                    _draw(kind, adata, color, layer, palette, groupby, kwargs)
+                    plt.gcf().savefig(tmp_path, dpi=dpi, bbox_inches='tight')
+                finally:
+                    plt.close('all')
+            path = cache.store(key, tmp_path)
+        except Exception:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+    return _request_copy(path, output_dir)
+
+
+def save_figure(dpi=None, output_dir=OUTPUT_DIR):
+    """Save and close the figure of a plotting call made with show=False; returns its per-request path
+
+    For plots of session state the cache key cannot describe (gene-set
+    scores, DE results, pseudobulk PCA): they are not cached, but each
+    request still gets its own file instead of a shared one in figures/.
+    """
+    import matplotlib.pyplot as plt
+
+    out_path = request_path(output_dir)
+    try:
+        plt.gcf().savefig(out_path, dpi=_savefig_dpi(dpi), bbox_inches='tight')
+    finally:
+        plt.close('all')
+    return out_path
+
+
+def marker_genes(adata, n_genes=DEFAULT_WARM_UP_GENES, key='rank_genes_groups'):
+    """Top ``n_genes`` marker genes of every group in uns[key], without duplicates"""
+    if key not in adata.uns or 'names' not in adata.uns[key]:
+        return []
+    names = adata.uns[key]['names']
+    genes = []
+    for group in names.dtype.names:
+        genes.extend(str(gene) for gene in names[group][:n_genes])
+    genes = list(dict.fromkeys(genes))
+    return [gene for gene in genes if gene in adata.var_names]
+
+
+def warm_up(h5ad_path, n_genes=DEFAULT_WARM_UP_GENES, layer='scvi_normalized'):
+    """Pre-render the plots the app draws first for a dataset
+
+    Renders exactly the calls the app makes: the overview CellType UMAP, the
+    CellType/Group UMAPs and the expression UMAPs of the top marker genes.
+    Returns the number of images rendered or found in the cache.
+    """
+    import scanpy as sc
+
+    from lazy_loader import gene_view, open_lazy
+
+    # Same figure settings as app.R, so the cache keys match
+    sc.set_figure_params(dpi=100, dpi_save=600, format='png')
+    start_time = time.time()
+    adata = open_lazy(h5ad_path).to_anndata()
+    if 'X_umap' not in adata.obsm:
+        print(f"⚠️  {Path(h5ad_path).name} has no X_umap, nothing to warm up")
+        return 0
+
+    requests = [('CellType', {'legend_loc': 'on data'})]
+    requests += [(column, {}) for column in ('CellType', 'Group') if column in adata.obs.columns]
+    n_images = 0
+    for color, kwargs in requests:
+        Path(render('umap', adata, color, h5ad_path, **kwargs)).unlink()
+        n_images += 1
+
+    genes = marker_genes(adata, n_genes)
+    for gene in genes:
+        try:
+            view = gene_view(adata, [gene], layer)
+            # R passes vmax = 5 as a float
+            Path(render('umap', view, gene, h5ad_path, layer=layer, vmax=5.0)).unlink()
+            n_images += 1
+        except (KeyError, ValueError) as e:
+            print(f"⚠️  Skipped {gene}: {e}")
+    print(f"✅ {n_images} plots of {Path(h5ad_path).name} warmed up in {time.time() - start_time:.1f} seconds "
+          f"({len(genes)} marker genes)")
+    return n_images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render the first plots of datasets into the plot cache")
+    parser.add_argument("input_files", nargs="+", help="Paths to .h5ad files")
+    parser.add_argument("--genes", type=int, default=DEFAULT_WARM_UP_GENES,
+                        help="Top marker genes per group to render")
+    args = parser.parse_args()
+    for path in args.input_files:
+        warm_up(path, args.genes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Precomputed Pseudobulk Profiles for MASLDatlas
+The DESeq2 tab sums the counts layer by Group x CellType, which depends only
+on the dataset. build_pseudobulk does that aggregation once, in row blocks
+straight from the .h5ad, and stores one profile per Group x CellType with
+its cell count and total counts as <stem>_pseudobulk.h5ad. At runtime
+select_pseudobulk slices these profiles by the Selection/Reference groups and
+cell types and applies the min_cells/min_counts filters of dc.get_pseudobulk,
+so a click is a lookup over a few hundred rows instead of an aggregation over
+every cell.
+"""
+
+import argparse
+import os
+import threading
+import time
+from pathlib import Path
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from gene_index import DEFAULT_INDEX_DIR
+from h5ad_utils import iter_row_blocks, matrix_shape, read_elem
+
+INDEX_VERSION = 1
+DEFAULT_SAMPLE_COL = 'Group'
+DEFAULT_GROUPS_COL = 'CellType'
+DEFAULT_LAYER = 'counts'
+
+_LOADED = {}
+_LOADED_LOCK = threading.Lock()
+
+
+def pseudobulk_path_for(h5ad_path, index_dir=None):
+    """Default location of the pseudobulk profiles of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_pseudobulk.h5ad"
+
+
+def _source_signature(h5ad_path):
+    stat = os.stat(h5ad_path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def _as_set(values):
+    return {str(v) for v in ([values] if isinstance(values, str) else values)}
+
+
+def aggregate_rows(elem, codes, n_profiles, block_rows=50000):
+    """Sum the rows of a matrix element by profile code, one row block at a time"""
+    n_obs, n_vars = matrix_shape(elem)
+    sums = np.zeros((n_profiles, n_vars), dtype=np.float64)
+    for start, end, block in iter_row_blocks(elem, block_rows):
+        n = end - start
+        indicator = sp.csr_matrix((np.ones(n), (codes[start:end], np.arange(n))), shape=(n_profiles, n))
+        summed = indicator @ block
+        sums += summed.toarray() if sp.issparse(summed) else summed
+    return sums
+
+
+def build_pseudobulk(h5ad_path, out_path=None, layer=DEFAULT_LAYER, sample_col=DEFAULT_SAMPLE_COL,
+                     groups_col=DEFAULT_GROUPS_COL, block_rows=50000):
+    """Write the unfiltered sample x cell type count sums of an .h5ad file"""
+    h5ad_path = Path(h5ad_path)
+    out_path = Path(out_path) if out_path else pseudobulk_path_for(h5ad_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    print(f"🧮 Building pseudobulk profiles ({sample_col} × {groups_col}, layer '{layer}') for {h5ad_path.name}...")
+    start_time = time.time()
+
+    with h5py.File(h5ad_path, 'r') as f:
+        obs = read_elem(f['obs'])
+        var = read_elem(f['var'])
+        for column in (sample_col, groups_col):
+            if column not in obs.columns:
+                raise KeyError(f"obs has no '{column}' column")
+        if layer == 'X':
+            elem = f['X']
+        elif 'layers' in f and layer in f['layers']:
+            elem = f['layers'][layer]
+        else:
+            raise KeyError(f"Layer '{layer}' not found in {h5ad_path.name}")
+
+        keys = obs[[sample_col, groups_col]].astype(str)
+        codes, profiles = pd.MultiIndex.from_frame(keys).factorize(sort=True)
+        sums = aggregate_rows(elem, codes, len(profiles), block_rows)
+
+    samples = profiles.get_level_values(0)
+    groups = profiles.get_level_values(1)
+    profile_obs = pd.DataFrame({
+        sample_col: pd.Categorical(samples),
+        groups_col: pd.Categorical(groups),
+        'psbulk_n_cells': np.bincount(codes, minlength=len(profiles)),
+        'psbulk_counts': sums.sum(axis=1),
+    }, index=[f"{s}_{g}" for s, g in zip(samples, groups)])
+    pdata = ad.AnnData(X=sums.astype(np.float32), obs=profile_obs, var=pd.DataFrame(index=var.index.astype(str)))
+    pdata.uns['pseudobulk'] = {'version': INDEX_VERSION, 'source': str(h5ad_path), 'n_obs': len(obs),
+                               'layer': layer, 'sample_col': sample_col, 'groups_col': groups_col,
+                               **_source_signature(h5ad_path)}
+
+    tmp_path = out_path.with_name(out_path.name + '.tmp')
+    pdata.write(tmp_path, compression='gzip')
+    os.replace(tmp_path, out_path)
+    print(f"✅ {pdata.n_obs} pseudobulk profiles saved in {time.time() - start_time:.1f} seconds: {out_path}")
+    return out_path
+
+
+def load_pseudobulk(h5ad_path, index_dir=None):
+    """Return the stored profiles of an .h5ad (shared, do not modify), or None if missing or stale"""
+    path = pseudobulk_path_for(h5ad_path, index_dir)
+    if not path.exists():
+        return None
+    key = (str(path.resolve()), path.stat().st_mtime_ns)
+    with _LOADED_LOCK:
+        pdata = _LOADED.get(key)
+        if pdata is None:
+            pdata = ad.read_h5ad(path)
+            _LOADED[key] = pdata
+    meta = pdata.uns['pseudobulk']
+    if os.path.exists(h5ad_path):
+        source = _source_signature(h5ad_path)
+        if (meta['source_size'], meta['source_mtime_ns']) != (source['source_size'], source['source_mtime_ns']):
+            return None
+    return pdata
+
+
+def select_pseudobulk(h5ad_path, selection, reference, cell_types=None, n_obs=None, min_cells=10,
+                      min_counts=1000, index_dir=None):
+    """Profiles of the Selection and Reference groups, as dc.get_pseudobulk would return them
+
+    Adds an 'ident' column ('Selection' or 'Reference'; a group in both is a
+    Reference, as in the app), keeps only ``cell_types`` when given and drops
+    profiles below min_cells or min_counts. Returns None when no profiles
+    exist for the file or they were built from a different number of cells
+    than ``n_obs`` (a subsampled dataset).
+    """
+    pdata = load_pseudobulk(h5ad_path, index_dir)
+    if pdata is None:
+        return None
+    meta = pdata.uns['pseudobulk']
+    if n_obs is not None and int(n_obs) != meta['n_obs']:
+        return None
+
+    groups = pdata.obs[meta['sample_col']].astype(str)
+    ident = np.where(groups.isin(_as_set(reference)), 'Reference',
+                     np.where(groups.isin(_as_set(selection)), 'Selection', ''))
+    keep = ident != ''
+    if cell_types is not None:
+        keep &= pdata.obs[meta['groups_col']].astype(str).isin(_as_set(cell_types)).to_numpy()
+    keep &= (pdata.obs['psbulk_n_cells'].to_numpy() >= min_cells)
+    keep &= (pdata.obs['psbulk_counts'].to_numpy() >= min_counts)
+
+    result = pdata[keep].copy()
+    result.obs['ident'] = ident[keep]
+    del result.uns['pseudobulk']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute Group x CellType pseudobulk profiles")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--output-dir", default=None,
+                        help="Directory for the profiles (default: DATASETS_OPTIMIZED_DIR)")
+    parser.add_argument("--layer", default=DEFAULT_LAYER, help="Counts layer to sum")
+    args = parser.parse_args()
+    build_pseudobulk(args.input_file, pseudobulk_path_for(args.input_file, args.output_dir), layer=args.layer)
+
+
+if __name__ == "__main__":
+    main()
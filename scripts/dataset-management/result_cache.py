@@ -0,0 +1,209 @@
+"""
+Analysis Result Cache for MASLDatlas
+Content-addressed on-disk cache of DESeq2 tables and rank_genes_groups
+results. A key hashes the dataset checksum, the analysis parameters (contrast
+groups, cluster filter, method ...) and the versions of the libraries that
+compute the result, so a contrast run once is answered immediately in every
+session and worker sharing the cache directory. Entries are written
+atomically and evicted least-recently-used when the cache outgrows its size
+limit.
+
+Cache layout (<cache dir>/results/):
+    <key[:2]>/<key>.pkl        pickled result; mtime is the last use
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+from importlib import metadata
+from pathlib import Path
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('MASLDATLAS_CACHE_DIR', 'cache'), 'results')
+DEFAULT_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', 2048))
+DEFAULT_LIBRARIES = ('scanpy', 'anndata', 'numpy', 'pandas', 'scipy', 'pydeseq2', 'decoupler')
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+# Dataset checksums by (path, size, mtime), so each file is hashed once per process
+_CHECKSUMS = {}
+# Installed library versions do not change while a process runs
+_VERSIONS = {}
+
+
+def library_versions(libraries=DEFAULT_LIBRARIES):
+    """{package: version} of the installed analysis libraries"""
+    libraries = tuple(libraries)
+    versions = _VERSIONS.get(libraries)
+    if versions is None:
+        versions = {}
+        for name in libraries:
+            try:
+                versions[name] = metadata.version(name)
+            except metadata.PackageNotFoundError:
+                versions[name] = None
+        _VERSIONS[libraries] = versions
+    return dict(versions)
+
+
+def dataset_checksum(h5ad_path):
+    """Checksum identifying the content of a dataset file
+
+    Uses the digest recorded by the downloader's checksum cache when the file
+    is unchanged since it was verified; otherwise falls back to its path, size
+    and modification time, which also change whenever the file is replaced.
+    """
+    path = Path(h5ad_path)
+    stat = path.stat()
+    signature = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    checksum = _CHECKSUMS.get(signature)
+    if checksum is not None:
+        return checksum
+    try:
+        from download_datasets import ChecksumCache
+        cache = ChecksumCache(path.parent.parent / '.checksum_cache.json')
+        digest = cache.lookup(path, 'sha256') or cache.lookup(path, 'md5')
+    except ImportError:
+        digest = None
+    checksum = digest or 'stat:' + hashlib.sha256(json.dumps(signature).encode()).hexdigest()
+    _CHECKSUMS[signature] = checksum
+    return checksum
+
+
+def _canonical(value):
+    """JSON-able, order-stable form of parameters (dict keys and sets are sorted)"""
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in sorted(value.items(), key=lambda kv: str(kv[0]))}
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonical(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, 'tolist'):
+        return _canonical(value.tolist())
+    return str(value)
+
+
+class ResultCache:
+    suffix = '.pkl'
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_mb=DEFAULT_MAX_MB):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.lock = threading.Lock()
+
+    def make_key(self, kind, dataset_path, params, libraries=DEFAULT_LIBRARIES):
+        """Hex key of an analysis of a dataset with the given parameters"""
+        payload = {
+            'version': CACHE_VERSION,
+            'kind': kind,
+            'dataset': dataset_checksum(dataset_path),
+            'params': _canonical(params),
+            'libraries': library_versions(libraries),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}{self.suffix}"
+
+    def contains(self, key):
+        return self._path(key).exists()
+
+    def get(self, key):
+        """Cached result of a key, or None; a hit marks the entry as recently used"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # Truncated, or written by incompatible library versions
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Store a result and evict least-recently-used entries beyond the size limit"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its size limit"""
+        with self.lock:
+            entries = []
+            for path in self.cache_dir.glob(f'*/*{self.suffix}'):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
+    def size_bytes(self):
+        return sum(path.stat().st_size for path in self.cache_dir.glob(f'*/*{self.suffix}'))
+
+
+def default_cache(cache_dir=None, max_mb=None):
+    """The process-wide ResultCache of a directory"""
+    cache_dir = str(cache_dir or DEFAULT_CACHE_DIR)
+    with _CACHES_LOCK:
+        cache = _CACHES.get(cache_dir)
+        if cache is None:
+            cache = ResultCache(cache_dir, max_mb or DEFAULT_MAX_MB)
+            _CACHES[cache_dir] = cache
+        return cache
+
+
+def rank_genes_groups_key(adata, dataset_path, groupby, groups, reference, method, params=None, **kwargs):
+    """Cache key of a rank_genes_groups run (see cached_rank_genes_groups)"""
+    return default_cache().make_key('rank_genes_groups', dataset_path, {
+        'selection': params or {},
+        'n_obs': adata.n_obs,
+        'groupby': groupby,
+        'groups': groups,
+        'reference': reference,
+        'method': method,
+        'kwargs': kwargs,
+    })
+
+
+def cached_rank_genes_groups(adata, dataset_path, groupby, groups, reference, method, params=None,
+                             key_added='rank_genes_groups', **kwargs):
+    """sc.tl.rank_genes_groups, answered from the result cache when it was run before
+
+    ``params`` describes how ``adata`` was selected from the dataset (data
+    scope, cluster filter, contrast definition); together with the test
+    arguments it forms the cache key. Returns ``adata`` with
+    ``uns[key_added]`` filled in (a new view for subset views).
+    """
+    from group_stats import rank_genes_groups
+    from subset_index import with_uns
+
+    cache = default_cache()
+    key = rank_genes_groups_key(adata, dataset_path, groupby, groups, reference, method, params, **kwargs)
+    result = cache.get(key)
+    if result is None:
+        adata = rank_genes_groups(adata, groupby, groups=groups, reference=reference, method=method,
+                                  key_added=key_added, **kwargs)
+        cache.put(key, adata.uns[key_added])
+    else:
+        adata = with_uns(adata, key_added, result)
+    return adata
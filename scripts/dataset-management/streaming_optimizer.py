@@ -0,0 +1,207 @@
+"""
+Out-of-core Streaming Optimizer for MASLDatlas
+Produces the outputs of DatasetOptimizer.optimize_all (metadata-only file,
+subsample indices, progressive-loading chunks and the HVG-filtered Shiny file)
+from one walk over the HDF5 file in row blocks, without ever loading a whole
+expression matrix. Peak memory is bounded by one row block of one matrix plus
+obs/var/obsm, whatever the size of the file.
+
+The only extra pass is a statistics pass over X when var has no
+'highly_variable' column. Embeddings and clusters missing from the file are
+not computed here: that needs the full matrix in memory (--strategy optimize).
+"""
+
+import resource
+import sys
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from chunking import DEFAULT_CODEC, chunk_dir_for, chunk_entry, write_manifest
+from h5ad_utils import H5adWriter, matrix_elements, matrix_shape, read_metadata, read_rows, take_rows
+from subsampling import DEFAULT_SIZES, save_subsamples, size_key, stratified_nested_samples, subsample_path_for
+
+DEFAULT_BLOCK_ROWS = 20000
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process so far, in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def write_metadata_only(meta, out_path, codec=DEFAULT_CODEC):
+    """Write obs, var, obsm, varm and uns without any expression matrix"""
+    writer = H5adWriter(out_path, [], meta['obs'], meta['var'], meta['obsm'], meta['uns'], meta['varm'],
+                        compression=codec)
+    return writer.close()
+
+
+def dispersion_hvg(X, n_obs, block_rows=DEFAULT_BLOCK_ROWS, min_mean=0.0125, max_mean=3, min_disp=0.5,
+                   n_bins=20):
+    """Highly variable genes of log-normalized X, computed in one pass over row blocks
+
+    Same selection as sc.pp.highly_variable_genes(flavor='seurat') with the
+    cutoffs used by DatasetOptimizer.optimize_for_shiny, from streamed sums of
+    expm1(X) and its square.
+    """
+    n_vars = matrix_shape(X)[1]
+    sums = np.zeros(n_vars, dtype=np.float64)
+    sumsq = np.zeros(n_vars, dtype=np.float64)
+    for start in range(0, n_obs, block_rows):
+        block = read_rows(X, start, min(start + block_rows, n_obs))
+        if sp.issparse(block):
+            values = np.expm1(block.data.astype(np.float64))
+            sums += np.bincount(block.indices, weights=values, minlength=n_vars)
+            sumsq += np.bincount(block.indices, weights=values ** 2, minlength=n_vars)
+        else:
+            values = np.expm1(np.asarray(block, dtype=np.float64))
+            sums += values.sum(axis=0)
+            sumsq += (values ** 2).sum(axis=0)
+        del block
+
+    mean = sums / n_obs
+    var = (sumsq / n_obs - mean ** 2) * (n_obs / max(n_obs - 1, 1))
+    mean[mean == 0] = 1e-12
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dispersion = var / mean
+        dispersion[dispersion == 0] = np.nan
+        dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+
+    df = pd.DataFrame({'mean': mean, 'dispersion': dispersion})
+    df['bin'] = pd.cut(df['mean'], bins=n_bins)
+    grouped = df.groupby('bin', observed=False)['dispersion']
+    bin_mean = grouped.mean()
+    bin_std = grouped.std(ddof=1)
+    # Bins holding a single gene: that gene is left unnormalized
+    single = bin_std.isnull()
+    bin_std[single] = bin_mean[single]
+    bin_mean[single] = 0
+    normalized = ((df['dispersion'].to_numpy() - bin_mean.loc[df['bin']].to_numpy())
+                  / bin_std.loc[df['bin']].to_numpy())
+    with np.errstate(invalid='ignore'):
+        return (mean > min_mean) & (mean < max_mean) & (normalized > min_disp)
+
+
+def _hvg_mask(f, meta, n_obs, block_rows):
+    var = meta['var']
+    if 'highly_variable' in var.columns:
+        print("🧬 Using highly variable genes from var")
+        return var['highly_variable'].to_numpy().astype(bool)
+    print("🧬 Computing highly variable genes (statistics pass over X)...")
+    return dispersion_hvg(f['X'], n_obs, block_rows)
+
+
+def _segments(n_obs, block_rows, chunk_size):
+    """Row ranges of at most block_rows that never straddle a chunk boundary"""
+    start = 0
+    while start < n_obs:
+        end = min(start + block_rows, n_obs)
+        if chunk_size:
+            end = min(end, (start // chunk_size + 1) * chunk_size)
+        yield start, end
+        start = end
+
+
+def stream_optimize(h5ad_path, output_dir, block_rows=DEFAULT_BLOCK_ROWS, chunk_size=DEFAULT_CHUNK_SIZE,
+                    sample_sizes=DEFAULT_SIZES, metadata=True, subsamples=True, chunks=True, hvg=True,
+                    codec=DEFAULT_CODEC):
+    """Write every optimized output of an .h5ad file in one row-block pass
+
+    Output names match DatasetOptimizer: <stem>_metadata.h5ad,
+    <stem>_subsamples.npz, <stem>_chunks/ and <stem>_shiny_optimized.h5ad.
+    Returns a dict of output paths plus 'peak_rss_bytes'.
+    """
+    h5ad_path = Path(h5ad_path)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stem = h5ad_path.stem
+    start_time = time.time()
+    results = {}
+
+    print(f"🌊 Streaming optimization of {h5ad_path.name} in blocks of {block_rows:,} rows")
+    with h5py.File(h5ad_path, 'r') as f:
+        meta = read_metadata(f)
+        obs, var = meta['obs'], meta['var']
+        n_obs = len(obs)
+        elements = list(matrix_elements(f))
+        print(f"📈 Shape: {n_obs:,} cells × {len(var):,} genes; matrices: {', '.join(k for k, _ in elements)}")
+
+        if metadata:
+            results['metadata'] = write_metadata_only(meta, output_dir / f"{stem}_metadata.h5ad", codec)
+            print(f"✅ Metadata-only version saved: {results['metadata']}")
+
+        if subsamples:
+            samples = stratified_nested_samples(obs, sample_sizes)
+            results['subsamples'] = save_subsamples(samples, subsample_path_for(h5ad_path, output_dir),
+                                                    n_obs, source_path=h5ad_path)
+            print(f"✅ Subsample indices saved: {', '.join(size_key(s) for s in samples) or 'none'}")
+
+        hvg_writer = None
+        if hvg:
+            mask = _hvg_mask(f, meta, n_obs, block_rows)
+            columns = np.flatnonzero(mask)
+            print(f"🧬 Keeping {len(columns):,} highly variable genes")
+            if 'X_umap' not in meta['obsm']:
+                print("⚠️  No X_umap in the file; run --strategy optimize in memory to compute embeddings")
+            hvg_path = output_dir / f"{stem}_shiny_optimized.h5ad"
+            hvg_var = var.iloc[columns].copy()
+            hvg_var['highly_variable'] = True
+            hvg_writer = H5adWriter(hvg_path, elements, obs, hvg_var, meta['obsm'], meta['uns'],
+                                     {key: take_rows(value, columns) for key, value in meta['varm'].items()},
+                                     meta['raw_var'], columns=columns, compression=codec)
+            if 'obsp' in f:
+                f.copy(f['obsp'], hvg_writer.file, name='obsp')
+
+        chunk_dir = chunk_writer = None
+        chunk_entries = []
+        if chunks:
+            chunk_dir = chunk_dir_for(h5ad_path, output_dir)
+            chunk_dir.mkdir(exist_ok=True)
+        n_chunks = (n_obs + chunk_size - 1) // chunk_size if chunks else 0
+
+        # The single pass: every matrix is read one row block at a time and fed to each output
+        segments = _segments(n_obs, block_rows, chunk_size if chunks else 0) if chunks or hvg else []
+        for start, end in segments:
+            if chunks and start % chunk_size == 0:
+                chunk_start, chunk_end = start, min(start + chunk_size, n_obs)
+                chunk_obsm = {key: take_rows(value, slice(chunk_start, chunk_end))
+                              for key, value in meta['obsm'].items()}
+                chunk_writer = H5adWriter(chunk_dir / f"chunk_{start // chunk_size:03d}.h5ad", elements,
+                                           obs.iloc[chunk_start:chunk_end], var, chunk_obsm, meta['uns'],
+                                           meta['varm'], meta['raw_var'], compression=codec)
+
+            for key, elem in elements:
+                block = read_rows(elem, start, end)
+                if chunk_writer is not None:
+                    chunk_writer.append(key, block)
+                if hvg_writer is not None:
+                    hvg_writer.append(key, block)
+                del block
+
+            if chunk_writer is not None and end == chunk_end:
+                chunk_entries.append(chunk_entry(chunk_writer.close(), chunk_start, chunk_end, obs))
+                chunk_writer = None
+                print(f"📦 Chunk {len(chunk_entries)}/{n_chunks}: {chunk_end - chunk_start} cells saved to "
+                      f"{chunk_entries[-1]['file']}")
+
+        if hvg_writer is not None:
+            results['shiny_optimized'] = hvg_writer.close()
+            print(f"✅ Shiny-optimized version saved: {results['shiny_optimized']}")
+
+        if chunks:
+            write_manifest(chunk_dir, h5ad_path, n_obs, len(var), chunk_size, codec, chunk_entries)
+            results['chunks'] = chunk_dir
+            print(f"✅ Progressive loading chunks created in {chunk_dir}")
+
+    results['peak_rss_bytes'] = peak_rss_bytes()
+    print(f"⏱️  Streaming optimization finished in {time.time() - start_time:.1f} seconds")
+    print(f"🧠 Peak RSS: {results['peak_rss_bytes'] / (1024**3):.2f} GB")
+    return results
@@ -0,0 +1,159 @@
+"""
+Stratified Subsampling for MASLDatlas
+Draws CellType x Group stratified subsamples with a guaranteed minimum number
+of cells per stratum. All sample sizes come from one random order per
+stratum, so they are nested (5k is a subset of 10k, which is a subset of 20k ...),
+and they are saved as row-index arrays in a single .npz next to the dataset
+instead of as separate .h5ad copies. The app slices the base dataset (store
+or lazy) with these indices.
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from gene_index import DEFAULT_INDEX_DIR
+
+DEFAULT_SIZES = (5000, 10000, 20000, 50000)
+DEFAULT_STRATA = ('CellType', 'Group')
+DEFAULT_MIN_PER_STRATUM = 20
+
+_LOADED = {}
+_LOADED_LOCK = threading.Lock()
+
+
+def size_key(size):
+    """Name of a sample size, matching the app's dataset_size_option ('sub10k')"""
+    return f"sub{size // 1000}k" if size % 1000 == 0 else f"sub{size}"
+
+
+def subsample_path_for(h5ad_path, index_dir=None):
+    """Default location of the subsample indices of an .h5ad file"""
+    return Path(index_dir or DEFAULT_INDEX_DIR) / f"{Path(h5ad_path).stem}_subsamples.npz"
+
+
+def _stratum_codes(obs, strata):
+    """Integer stratum of every cell (0 for all cells when no strata column exists)"""
+    columns = [column for column in strata if column in obs.columns]
+    if not columns:
+        return np.zeros(len(obs), dtype=np.int64), []
+    codes = obs[columns].astype(str).groupby(columns, sort=True).ngroup()
+    return codes.to_numpy().astype(np.int64), columns
+
+
+def _allocate(counts, previous, size, min_per_stratum):
+    """Cells to take from each stratum for one sample size, never fewer than before
+
+    Every stratum first gets its minimum (or all its cells when it is
+    smaller), if the size allows it. Cells still to place are given to strata
+    in proportion to how far they are below their proportional target, then to
+    remaining capacity, using largest remainders so the total is exact.
+    """
+    size = min(int(size), int(counts.sum()))
+    minimum = np.minimum(counts, min_per_stratum)
+    quota = np.maximum(previous, minimum)
+    if quota.sum() > size:
+        quota = previous.copy()
+    target = np.minimum(np.maximum(size * counts / counts.sum(), minimum), counts)
+
+    while quota.sum() < size:
+        need = size - quota.sum()
+        capacity = counts - quota
+        weights = np.maximum(target - quota, 0) * (capacity > 0)
+        if weights.sum() <= 0:
+            weights = capacity.astype(np.float64)
+        share = need * weights / weights.sum()
+        extra = np.minimum(np.floor(share).astype(np.int64), capacity)
+        if extra.sum() == 0:
+            # Largest remainders take the last few cells one at a time
+            order = np.argsort(-(share - np.floor(share)), kind='stable')
+            order = [s for s in order if capacity[s] > 0][:need]
+            extra[order] = 1
+        quota += extra
+    return quota
+
+
+def stratified_nested_samples(obs, sizes=DEFAULT_SIZES, strata=DEFAULT_STRATA,
+                              min_per_stratum=DEFAULT_MIN_PER_STRATUM, seed=42):
+    """Return {size: sorted row indices} of nested stratified samples of obs
+
+    Sizes at or above the number of cells are skipped.
+    """
+    codes, _ = _stratum_codes(obs, strata)
+    n_obs = len(codes)
+    rng = np.random.default_rng(seed)
+
+    # One random order per stratum; every sample takes a prefix of it
+    permutation = rng.permutation(n_obs)
+    by_stratum = permutation[np.argsort(codes[permutation], kind='stable')]
+    counts = np.bincount(codes)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    samples = {}
+    quota = np.zeros_like(counts)
+    for size in sorted(sizes):
+        if size >= n_obs:
+            continue
+        quota = _allocate(counts, quota, size, min_per_stratum)
+        rows = np.concatenate([by_stratum[start:start + q] for start, q in zip(starts, quota)])
+        samples[size] = np.sort(rows).astype(np.int32 if n_obs < 2 ** 31 else np.int64)
+    return samples
+
+
+def save_subsamples(samples, out_path, n_obs, source_path=None, strata=DEFAULT_STRATA,
+                    min_per_stratum=DEFAULT_MIN_PER_STRATUM, seed=42):
+    """Write the sample index arrays and their description to one .npz file"""
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    meta = {'n_obs': int(n_obs), 'sizes': sorted(int(size) for size in samples),
+            'strata': list(strata), 'min_per_stratum': min_per_stratum, 'seed': seed}
+    if source_path is not None:
+        stat = os.stat(source_path)
+        meta.update({'source': str(source_path), 'source_size': stat.st_size,
+                     'source_mtime_ns': stat.st_mtime_ns})
+    arrays = {size_key(size): rows for size, rows in samples.items()}
+    tmp_path = out_path.with_name(out_path.name + '.tmp.npz')
+    np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def load_subsamples(h5ad_path, index_dir=None):
+    """Return (meta, {key: rows}) for an .h5ad, or None if missing or stale"""
+    path = subsample_path_for(h5ad_path, index_dir)
+    if not path.exists():
+        return None
+    stat = path.stat()
+    key = (str(path.resolve()), stat.st_mtime_ns)
+    with _LOADED_LOCK:
+        loaded = _LOADED.get(key)
+        if loaded is None:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+                loaded = (meta, {name: data[name] for name in data.files if name != 'meta'})
+            _LOADED[key] = loaded
+    meta = loaded[0]
+    if os.path.exists(h5ad_path) and 'source_size' in meta:
+        source = os.stat(h5ad_path)
+        if (meta['source_size'], meta['source_mtime_ns']) != (source.st_size, source.st_mtime_ns):
+            return None
+    return loaded
+
+
+def subsample(adata, h5ad_path, size, index_dir=None):
+    """Cells of one saved sample size ('sub10k' or 10000) of a full dataset, or None
+
+    ``adata`` is the base dataset (a store or lazily opened AnnData); only the
+    selected rows are copied.
+    """
+    loaded = load_subsamples(h5ad_path, index_dir)
+    if loaded is None:
+        return None
+    meta, samples = loaded
+    key = size if isinstance(size, str) else size_key(int(size))
+    if key not in samples or adata.n_obs != meta['n_obs']:
+        return None
+    return adata[samples[key]].copy()
@@ -0,0 +1,248 @@
+"""
+Categorical Subset Index for MASLDatlas
+Cluster filters and DE contrasts select cells by CellType and Group levels.
+SubsetIndex keeps the sorted row ids of every level of these obs columns,
+built once per loaded dataset; a union of levels is a merge of sorted runs
+and an intersection with another selection is a sorted search, so a selection
+never scans every cell.
+
+A Subset is a set of rows of a parent AnnData. Its AnnData view shares the
+parent's matrices, layers and embeddings, and per-cell columns or uns entries
+derived for the subset (the DE 'ident' column, rank_genes_groups results) are
+kept in a side store and attached to a fresh view instead of being written
+into the view, which would turn it into a full copy of the selected cells.
+"""
+
+import threading
+import weakref
+
+import anndata as ad
+import numpy as np
+import pandas as pd
+
+from h5ad_utils import index_dtype_for
+
+DEFAULT_COLUMNS = ('CellType', 'Group')
+
+_INDEXES = {}
+_SUBSETS = {}
+_LOCK = threading.Lock()
+
+
+def _contains(sorted_values, values):
+    """Mask of ``values`` found in the sorted array ``sorted_values``"""
+    if not len(sorted_values):
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+
+def union(arrays):
+    """Sorted union of sorted row-id arrays"""
+    arrays = [np.asarray(rows) for rows in arrays if len(rows)]
+    if not arrays:
+        return np.empty(0, dtype=np.int64)
+    if len(arrays) == 1:
+        return arrays[0]
+    # The inputs are sorted runs: a stable sort of their concatenation merges them
+    merged = np.sort(np.concatenate(arrays), kind='stable')
+    keep = np.ones(len(merged), dtype=bool)
+    keep[1:] = merged[1:] != merged[:-1]
+    return merged[keep]
+
+
+def intersect(a, b):
+    """Sorted intersection of two sorted row-id arrays"""
+    if len(a) > len(b):
+        a, b = b, a
+    return a[_contains(b, a)]
+
+
+def difference(a, b):
+    """Rows of sorted ``a`` that are not in sorted ``b``"""
+    return a[~_contains(b, a)]
+
+
+def _as_list(levels):
+    return [levels] if isinstance(levels, str) else list(levels)
+
+
+class SubsetIndex:
+    def __init__(self, obs, columns=DEFAULT_COLUMNS):
+        self.n_obs = len(obs)
+        dtype = index_dtype_for(self.n_obs)
+        self._rows = {}
+        for column in columns:
+            if column not in obs.columns:
+                continue
+            values = obs[column]
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            codes = values.cat.codes.to_numpy()
+            # A stable sort by level keeps the rows of each level in order
+            order = np.argsort(codes, kind='stable').astype(dtype)
+            bounds = np.searchsorted(codes[order], np.arange(len(values.cat.categories) + 1))
+            self._rows[column] = {str(level): order[bounds[i]:bounds[i + 1]]
+                                  for i, level in enumerate(values.cat.categories)}
+
+    @property
+    def columns(self):
+        return list(self._rows)
+
+    def levels(self, column):
+        return list(self._rows[column])
+
+    def counts(self, column):
+        """{level: number of cells}"""
+        return {level: len(rows) for level, rows in self._rows[column].items()}
+
+    def rows(self, column, levels):
+        """Sorted rows of the cells whose ``column`` is one of ``levels``"""
+        by_level = self._rows[column]
+        return union([by_level[str(level)] for level in _as_list(levels) if str(level) in by_level])
+
+    def select(self, criteria=None, **kwargs):
+        """Sorted rows matching every {column: levels} criterion (all rows when there is none)"""
+        criteria = {**(criteria or {}), **kwargs}
+        rows = None
+        for column, levels in criteria.items():
+            selected = self.rows(column, levels)
+            rows = selected if rows is None else intersect(rows, selected)
+        return np.arange(self.n_obs, dtype=index_dtype_for(self.n_obs)) if rows is None else rows
+
+
+def _remember(registry, adata, value):
+    key = id(adata)
+    with _LOCK:
+        registry[key] = (weakref.ref(adata), value)
+    weakref.finalize(adata, _forget, registry, key)
+
+
+def _forget(registry, key):
+    with _LOCK:
+        registry.pop(key, None)
+
+
+def _recall(registry, adata):
+    with _LOCK:
+        ref, value = registry.get(id(adata), (None, None))
+    return value if ref is not None and ref() is adata else None
+
+
+def index_for(adata, columns=DEFAULT_COLUMNS):
+    """The SubsetIndex of an AnnData, built on first use and shared while the object lives"""
+    index = _recall(_INDEXES, adata)
+    if index is not None:
+        missing = [column for column in columns if column in adata.obs.columns and column not in index.columns]
+        if not missing:
+            return index
+        columns = index.columns + missing
+    index = SubsetIndex(adata.obs, columns)
+    _remember(_INDEXES, adata, index)
+    return index
+
+
+def _expand(values, rows, n_obs):
+    """Full-length obs column holding ``values`` at ``rows`` and missing values elsewhere"""
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values) and not isinstance(values.dtype, pd.CategoricalDtype):
+        full = np.full(n_obs, np.nan)
+        full[rows] = values.to_numpy()
+        return full
+    categorical = pd.Categorical(values)
+    codes = np.full(n_obs, -1, dtype=categorical.codes.dtype)
+    codes[rows] = categorical.codes
+    return pd.Categorical.from_codes(codes, categories=categorical.categories)
+
+
+class Subset:
+    """Rows of a parent AnnData; per-cell results derived for them live in ``obs`` and ``uns``"""
+
+    def __init__(self, parent, rows):
+        self.parent = parent
+        self.rows = np.asarray(rows)
+        self.obs = {}
+        self.uns = {}
+
+    @property
+    def n_obs(self):
+        return len(self.rows)
+
+    def _base(self):
+        """The parent, or a sibling AnnData sharing its buffers with the side store attached"""
+        if not self.obs and not self.uns:
+            return self.parent
+        parent = self.parent
+        obs = parent.obs.copy(deep=False)
+        for name, values in self.obs.items():
+            obs[name] = _expand(values, self.rows, parent.n_obs)
+        raw = None
+        if parent.raw is not None:
+            raw = {'X': parent.raw.X, 'var': parent.raw.var, 'varm': dict(parent.raw.varm)}
+        return ad.AnnData(X=parent.X, obs=obs, var=parent.var, uns={**parent.uns, **self.uns},
+                          obsm=dict(parent.obsm), varm=dict(parent.varm), obsp=dict(parent.obsp),
+                          layers=dict(parent.layers), raw=raw)
+
+    def view(self):
+        """AnnData view of the rows, sharing the parent's buffers, with the side store attached"""
+        view = self._base()[self.rows]
+        _remember(_SUBSETS, view, self)
+        return view
+
+
+def subset_of(adata):
+    """The Subset a view was made from, or a Subset of every row of ``adata``"""
+    subset = _recall(_SUBSETS, adata)
+    if subset is None:
+        subset = Subset(adata, np.arange(adata.n_obs, dtype=index_dtype_for(adata.n_obs)))
+    return subset
+
+
+def select(adata, criteria=None, **kwargs):
+    """Subset of the cells of ``adata`` (possibly a subset view) matching {column: levels} criteria"""
+    source = subset_of(adata)
+    rows = index_for(source.parent).select(criteria, **kwargs)
+    if len(source.rows) != source.parent.n_obs:
+        rows = intersect(source.rows, rows)
+    return Subset(source.parent, rows)
+
+
+def filter_view(adata, column, levels):
+    """View of the cells whose ``column`` is one of ``levels``, sharing the buffers of ``adata``"""
+    return select(adata, {column: _as_list(levels)}).view()
+
+
+def contrast_view(adata, column, ident_1, ident_2, name_1, name_2, groupby='ident'):
+    """View of the cells of two level sets of ``column`` with a ``groupby`` column naming their side
+
+    Cells in both sets belong to ``name_2``, as when the app assigns the
+    idents. The view shares the buffers of ``adata`` and leaves it untouched.
+    """
+    source = subset_of(adata)
+    index = index_for(source.parent)
+    reference = index.rows(column, _as_list(ident_2))
+    selection = index.rows(column, _as_list(ident_1))
+    if len(source.rows) != source.parent.n_obs:
+        reference, selection = intersect(source.rows, reference), intersect(source.rows, selection)
+    selection = difference(selection, reference)
+    rows = union([selection, reference])
+
+    subset = Subset(source.parent, rows)
+    names = np.where(_contains(selection, rows), str(name_1), str(name_2))
+    subset.obs[groupby] = pd.Categorical(names, categories=sorted({str(name_1), str(name_2)}))
+    return subset.view()
+
+
+def with_uns(adata, key, value):
+    """``adata`` with uns[key] = value
+
+    A subset view gets the entry through its side store and is returned as a
+    new view, so the selected cells are not copied; other objects are
+    updated in place.
+    """
+    subset = _recall(_SUBSETS, adata)
+    if subset is None or not adata.is_view:
+        adata.uns[key] = value
+        return adata
+    subset.uns[key] = value
+    return subset.view()
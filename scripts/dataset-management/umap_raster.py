@@ -0,0 +1,287 @@
+"""
+Rasterized UMAP Renderer for MASLDatlas
+Draws an embedding as an image instead of one matplotlib marker per cell:
+the cells of obsm['X_umap'] are binned into a pixel grid and every pixel is
+colored by an aggregate of its cells (mean value of a gene or numeric obs
+column, or the majority or blended color of a categorical column). Drawing a
+million cells costs a few bincounts and one imshow.
+
+The cell -> pixel mapping depends only on the embedding and the grid size,
+so it is computed once per embedding and kept in memory: recoloring the same
+dataset by another gene is a single bincount.
+"""
+
+import argparse
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+DEFAULT_SIZE = 800
+DEFAULT_BASIS = 'X_umap'
+DEFAULT_NA_COLOR = 'lightgray'
+MAX_CACHED_INDICES = 8
+# sc.pl.umap options the raster renderer understands (see plot_cache.render)
+OPTIONS = frozenset({'legend_loc', 'title', 'vmin', 'vmax', 'cmap', 'mode', 'size', 'basis', 'na_color',
+                     'legend_fontsize'})
+
+_INDICES = OrderedDict()
+_INDICES_LOCK = threading.Lock()
+
+
+class PixelIndex:
+    """Pixel of every cell of an embedding on a size x size grid
+
+    Only occupied pixels are kept: ``slots[i]`` is the occupied pixel of
+    cell i and ``pixels[slot]`` its flat position (row-major, row 0 at the
+    bottom of the embedding).
+    """
+
+    def __init__(self, embedding, size=DEFAULT_SIZE):
+        embedding = np.asarray(embedding, dtype=np.float64)[:, :2]
+        self.size = size
+        finite = np.isfinite(embedding).all(axis=1)
+        low = embedding[finite].min(axis=0) if finite.any() else np.zeros(2)
+        high = embedding[finite].max(axis=0) if finite.any() else np.ones(2)
+        span = np.where(high > low, high - low, 1.0)
+        # Half a pixel of margin so the outermost cells are not cut
+        self.extent = (low[0] - span[0] / (2 * size), high[0] + span[0] / (2 * size),
+                       low[1] - span[1] / (2 * size), high[1] + span[1] / (2 * size))
+        cells = np.clip(((embedding - low) / span * (size - 1) + 0.5).astype(np.int64), 0, size - 1)
+        flat = np.where(finite, cells[:, 1] * size + cells[:, 0], -1)
+        counts = np.bincount(flat[finite], minlength=size * size)
+        self.pixels = np.flatnonzero(counts)
+        lookup = np.full(size * size, -1, dtype=np.int32)
+        lookup[self.pixels] = np.arange(len(self.pixels), dtype=np.int32)
+        self.slots = np.where(finite, lookup[np.maximum(flat, 0)], -1).astype(np.int32)
+        self.n_cells = len(embedding)
+
+    @property
+    def n_slots(self):
+        return len(self.pixels)
+
+    def image(self, slot_colors):
+        """size x size RGBA image from the RGBA colors of the occupied pixels (empty pixels transparent)"""
+        image = np.zeros((self.size * self.size, 4), dtype=np.float32)
+        image[self.pixels] = slot_colors
+        return image.reshape(self.size, self.size, 4)
+
+
+def embedding_digest(embedding):
+    embedding = np.ascontiguousarray(embedding)
+    return hashlib.sha1(embedding.tobytes()).hexdigest() + f":{embedding.shape}:{embedding.dtype}"
+
+
+def pixel_index(embedding, size=DEFAULT_SIZE):
+    """The shared PixelIndex of an embedding and grid size"""
+    key = (embedding_digest(embedding), size)
+    with _INDICES_LOCK:
+        index = _INDICES.get(key)
+        if index is not None:
+            _INDICES.move_to_end(key)
+            return index
+    index = PixelIndex(embedding, size)
+    with _INDICES_LOCK:
+        _INDICES[key] = index
+        while len(_INDICES) > MAX_CACHED_INDICES:
+            _INDICES.popitem(last=False)
+    return index
+
+
+def _to_rgba(colors):
+    from matplotlib.colors import to_rgba_array
+    return to_rgba_array(list(colors)).astype(np.float32)
+
+
+def category_colors(adata, key, categories, palette=None):
+    """Colors of the categories of an obs column: palette, then uns['<key>_colors'], then scanpy's defaults"""
+    n = len(categories)
+    if palette is not None:
+        if isinstance(palette, dict):
+            return [palette.get(c, DEFAULT_NA_COLOR) for c in categories]
+        if isinstance(palette, str):
+            from matplotlib import colormaps
+            cmap = colormaps[palette]
+            return [cmap(i % cmap.N) for i in range(n)]
+        palette = list(palette)
+        return [palette[i % len(palette)] for i in range(n)]
+    stored = adata.uns.get(f"{key}_colors")
+    if stored is not None and len(stored) >= n:
+        return list(stored)[:n]
+    try:
+        from scanpy.plotting.palettes import default_20, default_28, default_102
+    except ImportError:
+        from matplotlib import colormaps
+        return [colormaps['tab20'](i % 20) for i in range(n)]
+    defaults = default_20 if n <= 20 else default_28 if n <= 28 else default_102
+    return [defaults[i % len(defaults)] for i in range(n)]
+
+
+def values_of(adata, key, layer=None):
+    """Values of an obs column, or of a gene in X or a layer, with one entry per cell"""
+    if key in adata.obs.columns:
+        return adata.obs[key]
+    if key not in adata.var_names:
+        raise KeyError(f"'{key}' is neither an obs column nor a gene")
+    column = adata.var_names.get_loc(key)
+    matrix = adata.layers[layer] if layer is not None else adata.X
+    values = matrix[:, column]
+    values = values.toarray() if sp.issparse(values) else np.asarray(values)
+    return values.ravel().astype(np.float64)
+
+
+def _limit(values, limit, default):
+    """A vmin/vmax: a number, a 'p<percentile>' string or None for the data extreme"""
+    if limit is None:
+        return default
+    if isinstance(limit, str) and limit.startswith('p'):
+        return float(np.nanpercentile(values, float(limit[1:])))
+    return float(limit)
+
+
+def mean_colors(index, values, cmap='viridis', vmin=None, vmax=None, na_color=DEFAULT_NA_COLOR):
+    """RGBA of every occupied pixel from the mean of the cells' values, and the color scale limits"""
+    from matplotlib import colormaps
+    values = np.asarray(values, dtype=np.float64)
+    valid = (index.slots >= 0) & np.isfinite(values)
+    totals = np.bincount(index.slots[valid], weights=values[valid], minlength=index.n_slots)
+    counts = np.bincount(index.slots[valid], minlength=index.n_slots)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = totals / counts
+    finite = values[valid]
+    low = _limit(finite, vmin, finite.min() if len(finite) else 0.0)
+    high = _limit(finite, vmax, finite.max() if len(finite) else 1.0)
+    scaled = np.clip((means - low) / (high - low if high > low else 1.0), 0, 1)
+    colors = colormaps[cmap or 'viridis'](np.nan_to_num(scaled)).astype(np.float32)
+    colors[counts == 0] = _to_rgba([na_color])[0]
+    return colors, (low, high)
+
+
+def category_slot_colors(index, codes, colors, mode='majority', na_color=DEFAULT_NA_COLOR):
+    """RGBA of every occupied pixel from the categories of its cells
+
+    ``mode`` 'majority' takes the color of the most frequent category of the
+    pixel, 'blend' averages the colors weighted by the category counts.
+    Cells without a category (code -1) count as ``na_color``.
+    """
+    rgba = np.vstack([_to_rgba(colors), _to_rgba([na_color])])
+    n_categories = len(rgba)
+    codes = np.where(np.asarray(codes) < 0, n_categories - 1, codes)
+    placed = index.slots >= 0
+    counts = np.bincount(index.slots[placed].astype(np.int64) * n_categories + codes[placed],
+                         minlength=index.n_slots * n_categories).reshape(index.n_slots, n_categories)
+    if mode == 'majority':
+        return rgba[counts.argmax(axis=1)]
+    if mode == 'blend':
+        return (counts @ rgba / counts.sum(axis=1, keepdims=True)).astype(np.float32)
+    raise ValueError(f"Unknown mode '{mode}', expected 'majority' or 'blend'")
+
+
+def umap(adata, color, layer=None, palette=None, size=DEFAULT_SIZE, basis=DEFAULT_BASIS, mode='majority',
+         cmap=None, vmin=None, vmax=None, legend_loc='right margin', legend_fontsize=None, title=None,
+         na_color=DEFAULT_NA_COLOR, ax=None):
+    """Rasterized scatter plot of an embedding colored by an obs column or a gene, like sc.pl.umap
+
+    Draws into ``ax`` (a new figure by default) and returns the axes.
+    Categorical columns are colored by majority or blended category per
+    pixel (``mode``), numeric columns and genes by the mean value of the
+    pixel's cells.
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+
+    if not isinstance(color, str):
+        color = list(color)
+        if len(color) != 1:
+            raise ValueError("The raster renderer draws one color key at a time")
+        color = color[0]
+    embedding = adata.obsm[basis]
+    index = pixel_index(embedding, size)
+    values = values_of(adata, color, layer)
+
+    if ax is None:
+        _, ax = plt.subplots()
+    categorical = isinstance(values, pd.Series) and (
+        isinstance(values.dtype, pd.CategoricalDtype) or not pd.api.types.is_numeric_dtype(values))
+    if categorical:
+        values = values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype('category')
+        categories = list(values.cat.categories)
+        colors = category_colors(adata, color, categories, palette)
+        slot_colors = category_slot_colors(index, values.cat.codes.to_numpy(), colors, mode, na_color)
+    else:
+        slot_colors, limits = mean_colors(index, values, cmap, vmin, vmax, na_color)
+
+    ax.imshow(index.image(slot_colors), origin='lower', extent=index.extent, aspect='auto',
+              interpolation='nearest')
+    ax.set_xticks([])
+    ax.set_yticks([])
+    basis_name = basis[2:].upper() if basis.startswith('X_') else basis.upper()
+    ax.set_xlabel(f"{basis_name}1")
+    ax.set_ylabel(f"{basis_name}2")
+    ax.set_title(color if title is None else title)
+
+    if categorical:
+        codes = values.cat.codes.to_numpy()
+        present = np.bincount(codes[codes >= 0], minlength=len(categories)) > 0
+        if legend_loc == 'on data':
+            coordinates = np.asarray(embedding)[:, :2]
+            for code, category in enumerate(categories):
+                if present[code]:
+                    x, y = np.nanmedian(coordinates[codes == code], axis=0)
+                    ax.text(x, y, category, weight='bold', fontsize=legend_fontsize, ha='center', va='center')
+        elif legend_loc == 'right margin':
+            handles = [Line2D([], [], marker='o', linestyle='', color=colors[code], label=category)
+                       for code, category in enumerate(categories) if present[code]]
+            ax.legend(handles=handles, loc='center left', bbox_to_anchor=(1, 0.5), frameon=False,
+                      fontsize=legend_fontsize, ncol=1 if len(handles) <= 14 else 2 if len(handles) <= 30 else 3)
+    else:
+        from matplotlib import colormaps
+        from matplotlib.cm import ScalarMappable
+        from matplotlib.colors import Normalize
+        mappable = ScalarMappable(Normalize(*limits), colormaps[cmap or 'viridis'])
+        ax.figure.colorbar(mappable, ax=ax, pad=0.01, fraction=0.08, aspect=30)
+    return ax
+
+
+def write_png(adata, color, path, dpi=None, **kwargs):
+    """Draw a rasterized UMAP (see umap) into a PNG file"""
+    import matplotlib.pyplot as plt
+
+    ax = umap(adata, color, **kwargs)
+    try:
+        ax.figure.savefig(path, dpi=dpi, bbox_inches='tight')
+    finally:
+        plt.close(ax.figure)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Draw a rasterized UMAP of a dataset")
+    parser.add_argument("input_file", help="Path to input .h5ad file")
+    parser.add_argument("--color", default="CellType", help="obs column or gene")
+    parser.add_argument("--layer", default=None, help="Layer of the gene values (default: X)")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="Pixels of the grid side")
+    parser.add_argument("--dpi", type=int, default=150, help="Resolution of the PNG")
+    parser.add_argument("--mode", choices=["majority", "blend"], default="majority",
+                        help="Color of pixels holding several categories")
+    parser.add_argument("--output", default="umap_raster.png", help="PNG file to write")
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use('Agg')
+    from lazy_loader import gene_view, open_lazy
+
+    adata = open_lazy(args.input_file).to_anndata()
+    if args.color not in adata.obs.columns:
+        adata = gene_view(adata, [args.color], args.layer)
+    start_time = time.time()
+    write_png(adata, args.color, args.output, dpi=args.dpi, layer=args.layer, size=args.size, mode=args.mode)
+    print(f"✅ {adata.n_obs:,} cells drawn in {time.time() - start_time:.2f} seconds: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -88,6 +88,77 @@ download_datasets() {
     fi
 }
 
+# Function to build the shared memory-mapped dataset stores
+build_dataset_stores() {
+    log_info "Building memory-mapped dataset stores..."
+    
+    if [ -f "scripts/dataset-management/dataset_store.py" ]; then
+        # Stores that are already up to date are skipped
+        if python3 scripts/dataset-management/dataset_store.py build; then
+            log_success "Dataset stores are up to date"
+            return 0
+        else
+            log_warning "Some dataset stores could not be built, sessions will read the .h5ad files"
+            return 1
+        fi
+    else
+        log_warning "dataset_store.py not found, skipping store build"
+        return 1
+    fi
+}
+
+# Function to refresh the catalog of dataset metadata read by the app's selectors
+build_dataset_catalog() {
+    log_info "Updating dataset catalog..."
+    
+    if [ -f "scripts/dataset-management/dataset_catalog.py" ]; then
+        # Only new or changed datasets are read
+        if python3 scripts/dataset-management/dataset_catalog.py build; then
+            log_success "Dataset catalog is up to date"
+            return 0
+        else
+            log_warning "Dataset catalog could not be built, selectors will wait for datasets to load"
+            return 1
+        fi
+    else
+        log_warning "dataset_catalog.py not found, skipping catalog build"
+        return 1
+    fi
+}
+
+# Function to start the local compute service for DESeq2 and DGE jobs
+start_compute_service() {
+    log_info "🧵 Starting local compute service..."
+    
+    if [ -f "scripts/dataset-management/compute_service.py" ]; then
+        # Shared by the service and the app started from this shell; never a fixed default
+        if [ -z "$COMPUTE_SERVICE_AUTHKEY" ]; then
+            export COMPUTE_SERVICE_AUTHKEY="$(python3 -c 'import secrets; print(secrets.token_hex(32))')"
+        fi
+        python3 scripts/dataset-management/compute_service.py serve &
+        log_success "Compute service started (PID $!), analyses run outside the R process"
+        return 0
+    else
+        log_warning "compute_service.py not found, analyses will run in the R process"
+        return 1
+    fi
+}
+
+# Function to pre-render the first UMAPs of every dataset into the plot cache
+warm_up_plot_cache() {
+    log_info "🖼️ Warming up the plot cache..."
+    
+    if [ -f "scripts/dataset-management/plot_cache.py" ]; then
+        # Runs alongside the app: sessions render what is not cached yet themselves
+        find datasets -name "*.h5ad" -print0 | xargs -0 -r python3 scripts/dataset-management/plot_cache.py &
+        log_success "Plot cache warm-up started (PID $!)"
+        return 0
+    else
+        log_warning "plot_cache.py not found, skipping plot warm-up"
+        return 1
+    fi
+}
+
 # Function to start the Shiny app with optimizations
 start_shiny() {
     log_info "🚀 Starting MASLDatlas Shiny application with performance optimizations..."
@@ -103,6 +174,14 @@ start_shiny() {
     
     log_success "Environment setup completed"
     
+    if [ "${START_COMPUTE_SERVICE:-true}" = "true" ]; then
+        start_compute_service || true
+    fi
+    
+    if [ "${WARM_UP_PLOT_CACHE:-false}" = "true" ]; then
+        warm_up_plot_cache || true
+    fi
+    
     # 🧹 OPTIMIZATION: Clean memory before startup
     log_info "🧹 Optimizing memory before startup..."
     R --slave -e "gc(); cat('Memory cleaned\n')" 2>/dev/null || true
@@ -164,6 +243,14 @@ main() {
         log_info "Dataset check skipped"
     fi
     
+    if [ "${BUILD_DATASET_STORE:-true}" = "true" ]; then
+        build_dataset_stores || true
+    fi
+    
+    if [ "${BUILD_DATASET_CATALOG:-true}" = "true" ]; then
+        build_dataset_catalog || true
+    fi
+    
     # Start the Shiny application
     start_shiny
 }
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Compute Service Tests for MASLDatlas
+Cancels jobs of a ComputeService whose process pool is swapped for a thread
+pool, so the jobs can block on an event the test controls.
+
+Usage:
+    python3 scripts/testing/test_compute_service.py
+"""
+
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'dataset-management'))
+
+import compute_service  # noqa: E402
+
+
+def _blocking_job(release, n_cpus=None):
+    release.wait(10)
+    return 'done'
+
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        compute_service.JOBS['blocking'] = _blocking_job
+        self.service = compute_service.ComputeService(workers=1)
+        self.service.pool.shutdown()
+        self.service.pool = ThreadPoolExecutor(max_workers=1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.service.pool.shutdown(wait=True)
+        del compute_service.JOBS['blocking']
+
+    def _cancel(self, job_id):
+        """cancel() on another thread; fails instead of hanging on a deadlock"""
+        outcome = {}
+        thread = threading.Thread(target=lambda: outcome.update(value=self.service.cancel(job_id)), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), "cancel() deadlocked")
+        return outcome['value']
+
+    def test_cancel_queued_job(self):
+        running = self.service.submit('blocking', {'release': self.release})
+        queued = self.service.submit('blocking', {'release': self.release})
+
+        self.assertTrue(self._cancel(queued))
+        self.assertEqual(self.service.status(queued)['status'], 'cancelled')
+        self.assertEqual(self.service.status(running)['status'], 'running')
+
+    def test_cancel_running_job_drops_its_result(self):
+        running = self.service.submit('blocking', {'release': self.release})
+        while self.service.status(running)['status'] != 'running':
+            pass
+
+        self.assertFalse(self._cancel(running))
+        self.release.set()
+        self.service.pool.shutdown(wait=True)
+        self.assertEqual(self.service.status(running)['status'], 'cancelled')
+        with self.assertRaises(compute_service.JobNotFound):
+            self.service.result(running)
+
+
+if __name__ == "__main__":
+    unittest.main()
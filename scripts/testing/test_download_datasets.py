@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Resumable Download Tests for MASLDatlas
+Downloads a file from a local http.server that honours byte ranges and checks
+that an interrupted download continues with a Range request (206), that a
+server answering a Range request with the whole file (200) restarts it from
+the first byte, and that a .part already holding every byte is finished
+without asking for a range past the end of the file (416).
+
+Usage:
+    python3 scripts/testing/test_download_datasets.py
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'dataset-management'))
+
+from download_datasets import DatasetDownloader  # noqa: E402
+
+PAYLOAD = os.urandom(300 * 1024 + 17)
+PAYLOAD_MD5 = hashlib.md5(PAYLOAD).hexdigest()
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD, honouring single byte ranges unless the server says otherwise"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        header = self.headers.get('Range')
+        server.requests.append(header)
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', header or '')
+        if match and server.honour_ranges:
+            start = int(match.group(1))
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(PAYLOAD)}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            end = min(int(match.group(2) or len(PAYLOAD) - 1), len(PAYLOAD) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            start, end = 0, len(PAYLOAD) - 1
+            self.send_response(200)
+        body = PAYLOAD[start:end + 1]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.drop_after is not None:
+            # Simulate a dropped connection part way through the body
+            body, server.drop_after = body[:server.drop_after], None
+            self.wfile.write(body)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class ResumableDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        config_file = self.tmp_dir / 'datasets_sources.json'
+        # One attempt per download_file call, so each call stands for one run of the script
+        config_file.write_text(json.dumps({'datasets': {}, 'config': {'retry_attempts': 1}}))
+        self.downloader = DatasetDownloader(str(config_file), self.tmp_dir / 'datasets')
+        self.downloader.CHUNK_SIZE = 4096
+        self.downloader.CHECKPOINT_BYTES = 16 * 1024
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.requests = []
+        self.server.honour_ranges = True
+        self.server.drop_after = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/dataset.h5ad"
+        self.file_path = self.tmp_dir / 'datasets' / 'Human' / 'dataset.h5ad'
+        self.part_path, self.state_path = self.downloader._part_paths(self.file_path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.downloader.session.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _download(self):
+        return self.downloader.download_file(self.url, self.file_path, PAYLOAD_MD5, 'md5')
+
+    def _interrupt(self, n_bytes):
+        """Run a download that loses its connection after n_bytes; returns the bytes it kept"""
+        self.server.drop_after = n_bytes
+        self.assertFalse(self._download())
+        self.assertTrue(self.part_path.exists())
+        state = json.loads(self.state_path.read_text())
+        return sum(segment['done'] for segment in state['segments'])
+
+    def _assert_complete(self):
+        self.assertFalse(self.part_path.exists())
+        self.assertFalse(self.state_path.exists())
+        data = self.file_path.read_bytes()
+        self.assertEqual(data, PAYLOAD)
+        self.assertEqual(hashlib.md5(data).hexdigest(), PAYLOAD_MD5)
+
+    def test_resume_appends_the_missing_range(self):
+        kept = self._interrupt(100 * 1024)
+        self.assertGreater(kept, 0)
+        self.server.requests.clear()
+
+        self.assertTrue(self._download())
+        self.assertEqual(self.server.requests[0], f"bytes={kept}-{len(PAYLOAD) - 1}")
+        self._assert_complete()
+
+    def test_full_reply_to_a_range_restarts_from_scratch(self):
+        self.assertGreater(self._interrupt(100 * 1024), 0)
+        self.server.honour_ranges = False
+        self.server.requests.clear()
+
+        self.assertTrue(self._download())
+        # The range was answered with the whole file, then fetched again with a plain GET
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertTrue(self.server.requests[0].startswith('bytes='))
+        self.assertIsNone(self.server.requests[1])
+        self._assert_complete()
+
+    def test_complete_part_file_is_finished_without_requests(self):
+        self._interrupt(100 * 1024)
+        state = json.loads(self.state_path.read_text())
+        with open(self.part_path, 'r+b') as f:
+            f.write(PAYLOAD)
+        for segment in state['segments']:
+            segment['done'] = segment['end'] - segment['start'] + 1
+        self.state_path.write_text(json.dumps(state))
+        self.server.requests.clear()
+
+        self.assertTrue(self._download())
+        # A range starting past the end would be answered with 416
+        self.assertEqual(self.server.requests, [])
+        self._assert_complete()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,90 +1,337 @@
 #!/usr/bin/env python3
 
 # 🔍 MASLDatlas Dataset Validation Script
-# Validates that all downloaded datasets are readable and properly formatted
+# Validates that all downloaded datasets are readable and properly formatted:
+# opens the HDF5 tree of every .h5ad (no matrix is loaded), checks the obs
+# columns, embeddings and layers app.R depends on and that their shapes agree,
+# and optionally verifies checksums against datasets_sources.json.
+# Files are validated in parallel; the result is a JSON report. --catalog also
+# refreshes the dataset catalog (dataset_catalog.py) from the same workers.
 # Author: MASLDatlas Team
 
 import os
 import json
 import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-def validate_h5ad_file(filepath):
-    """Validate that an h5ad file exists and is readable"""
-    try:
-        if not os.path.exists(filepath):
-            return False, "File does not exist"
-        
-        # Check file size
-        file_size = os.path.getsize(filepath)
-        if file_size == 0:
-            return False, "File is empty"
-        
-        # Try to read file header (basic validation)
-        try:
-            with open(filepath, 'rb') as f:
-                header = f.read(100)
-                if len(header) > 0:
-                    return True, f"OK ({file_size / (1024*1024):.1f} MB)"
-                else:
-                    return False, "Cannot read file content"
-        except Exception as e:
-            return False, f"Read error: {str(e)}"
-            
-    except Exception as e:
-        return False, f"Validation error: {str(e)}"
+import h5py
+
+# Shared HDF5 and checksum helpers
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'dataset-management'))
+from h5ad_utils import encoding_type, matrix_shape  # noqa: E402
+
+# What app.R reads from every dataset
+REQUIRED_OBS_COLUMNS = ('CellType', 'Group')
+REQUIRED_OBSM = {'X_umap': 2}
+REQUIRED_LAYERS = ('counts', 'scvi_normalized')
+REPORT_VERSION = 1
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _frame_length(elem):
+    """Number of rows of an obs/var element, from its index only"""
+    if isinstance(elem, h5py.Dataset):
+        # anndata < 0.7 stores dataframes as one compound dataset
+        return elem.shape[0]
+    index = _decode(elem.attrs.get('_index', '_index'))
+    return elem[index].shape[0]
+
+
+def _frame_columns(elem):
+    """{column: number of values} of an obs/var element"""
+    if isinstance(elem, h5py.Dataset):
+        index = _decode(elem.attrs.get('_index', 'index'))
+        return {name: elem.shape[0] for name in (elem.dtype.names or ()) if name != index}
+    index = _decode(elem.attrs.get('_index', '_index'))
+    names = [_decode(c) for c in elem.attrs.get('column-order', [])]
+    columns = {}
+    for name in names or [k for k in elem.keys() if k not in (index, '__categories')]:
+        if name not in elem:
+            columns[name] = None
+            continue
+        column = elem[name]
+        encoding = encoding_type(column)
+        if encoding == 'categorical':
+            columns[name] = column['codes'].shape[0]
+        elif isinstance(column, h5py.Group):
+            columns[name] = column['values'].shape[0] if 'values' in column else None
+        else:
+            columns[name] = column.shape[0]
+    return columns
+
+
+def inspect_h5ad(filepath):
+    """Shapes of obs, var, X, layers, obsm and raw of an .h5ad file, read from its HDF5 tree"""
+    with h5py.File(filepath, 'r') as f:
+        structure = {
+            'n_obs': _frame_length(f['obs']) if 'obs' in f else None,
+            'n_vars': _frame_length(f['var']) if 'var' in f else None,
+            'obs_columns': _frame_columns(f['obs']) if 'obs' in f else {},
+            'X': list(matrix_shape(f['X'])) if 'X' in f else None,
+            'layers': {name: list(matrix_shape(f['layers'][name])) for name in f['layers'].keys()}
+            if 'layers' in f else {},
+            'obsm': {name: list(f['obsm'][name].shape) for name in f['obsm'].keys()
+                     if isinstance(f['obsm'][name], h5py.Dataset)} if 'obsm' in f else {},
+            'raw': None,
+        }
+        if 'raw' in f and 'X' in f['raw']:
+            structure['raw'] = {'X': list(matrix_shape(f['raw']['X'])),
+                                'n_vars': _frame_length(f['raw']['var']) if 'var' in f['raw'] else None}
+    return structure
+
+
+def check_structure(structure):
+    """Errors and warnings about the structure of a dataset"""
+    errors, warnings = [], []
+    n_obs, n_vars = structure['n_obs'], structure['n_vars']
+    if n_obs is None or n_vars is None:
+        errors.append("Missing obs or var")
+        return errors, warnings
+    if structure['X'] is None:
+        errors.append("Missing X")
+    elif structure['X'] != [n_obs, n_vars]:
+        errors.append(f"X has shape {structure['X']}, expected [{n_obs}, {n_vars}]")
+
+    for column in REQUIRED_OBS_COLUMNS:
+        if column not in structure['obs_columns']:
+            errors.append(f"Missing obs['{column}']")
+    for column, length in structure['obs_columns'].items():
+        if length is not None and length != n_obs:
+            errors.append(f"obs['{column}'] has {length} values, expected {n_obs}")
+
+    for key in REQUIRED_OBSM:
+        if key not in structure['obsm']:
+            errors.append(f"Missing obsm['{key}']")
+    for key, shape in structure['obsm'].items():
+        if shape[0] != n_obs:
+            errors.append(f"obsm['{key}'] has {shape[0]} rows, expected {n_obs}")
+        elif key in REQUIRED_OBSM and (len(shape) < 2 or shape[1] < REQUIRED_OBSM[key]):
+            errors.append(f"obsm['{key}'] has shape {shape}, expected at least {REQUIRED_OBSM[key]} columns")
+
+    for layer in REQUIRED_LAYERS:
+        if layer not in structure['layers']:
+            errors.append(f"Missing layers['{layer}']")
+    for layer, shape in structure['layers'].items():
+        if shape != [n_obs, n_vars]:
+            errors.append(f"layers['{layer}'] has shape {shape}, expected [{n_obs}, {n_vars}]")
+
+    raw = structure['raw']
+    if raw is not None:
+        if raw['X'][0] != n_obs:
+            errors.append(f"raw.X has {raw['X'][0]} rows, expected {n_obs}")
+        if raw['n_vars'] is not None and raw['X'][1] != raw['n_vars']:
+            errors.append(f"raw.X has {raw['X'][1]} columns, raw.var has {raw['n_vars']}")
+    else:
+        warnings.append("No raw matrix: gene-set scoring uses X")
+    return errors, warnings
+
+
+def validate_h5ad_file(filepath, expected=None, checksum_cache_file=None):
+    """Validate the structure (and, with ``expected`` md5/size_bytes, the checksum) of an .h5ad file
+
+    Returns a JSON-able report entry; ``valid`` is False when any error was found.
+    """
+    start_time = time.time()
+    entry = {'path': str(filepath), 'valid': False, 'errors': [], 'warnings': []}
+    if not os.path.exists(filepath):
+        entry['errors'].append("File does not exist")
+        return entry
+    entry['size_bytes'] = os.path.getsize(filepath)
+    if entry['size_bytes'] == 0:
+        entry['errors'].append("File is empty")
+        return entry
 
-def main():
-    print("🔍 MASLDatlas Dataset Validation")
-    print("=" * 50)
-    
-    # Load configuration
     try:
-        with open('config/datasets_config.json', 'r') as f:
-            config = json.load(f)
-    except Exception as e:
-        print(f"❌ Error loading configuration: {e}")
-        return 1
-    
-    validation_passed = True
-    total_size = 0
-    
+        structure = inspect_h5ad(filepath)
+    except (OSError, KeyError, ValueError, TypeError) as e:
+        entry['errors'].append(f"Unreadable HDF5 structure: {e}")
+    else:
+        entry.update({'n_obs': structure['n_obs'], 'n_vars': structure['n_vars'], 'structure': structure})
+        errors, warnings = check_structure(structure)
+        entry['errors'] += errors
+        entry['warnings'] += warnings
+
+    if expected:
+        expected_size = expected.get('size_bytes')
+        if expected_size and expected_size != entry['size_bytes']:
+            entry['warnings'].append(f"Size {entry['size_bytes']} differs from datasets_sources.json ({expected_size})")
+        if expected.get('md5'):
+            entry['checksum'] = verify_checksum(filepath, expected['md5'], checksum_cache_file)
+            if not entry['checksum']['match']:
+                entry['errors'].append(f"MD5 mismatch: expected {expected['md5']}, got {entry['checksum']['md5']}")
+
+    entry['valid'] = not entry['errors']
+    entry['seconds'] = round(time.time() - start_time, 3)
+    return entry
+
+
+def verify_checksum(filepath, expected_md5, checksum_cache_file=None):
+    """MD5 of a file, from the downloader's checksum cache when the file is unchanged, else streamed from disk"""
+    from download_datasets import ChecksumCache, hash_file_range, new_hash
+
+    cached = ChecksumCache(checksum_cache_file).lookup(filepath, 'md5') if checksum_cache_file else None
+    digest = cached or hash_file_range(new_hash('md5'), filepath).hexdigest()
+    return {'md5': digest, 'match': digest == expected_md5, 'cached': cached is not None}
+
+
+def load_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def configured_datasets(config, sources, datasets_dir):
+    """(species, dataset, path, expected checksum entry) of the available datasets of datasets_config.json"""
+    entries = []
     for species, info in config.items():
         if info.get('Status') == 'Available' and 'Datasets' in info:
-            print(f"\n🧬 {species}:")
-            
             for dataset in info['Datasets']:
-                filepath = f"datasets/{species}/{dataset}.h5ad"
-                is_valid, message = validate_h5ad_file(filepath)
-                
-                if is_valid:
-                    print(f"  ✅ {dataset}: {message}")
-                    if "MB" in message:
-                        try:
-                            size_mb = float(message.split("(")[1].split(" MB")[0])
-                            total_size += size_mb
-                        except:
-                            pass
-                else:
-                    print(f"  ❌ {dataset}: {message}")
-                    validation_passed = False
+                expected = sources.get('datasets', {}).get(species, {}).get(dataset)
+                entries.append((species, dataset, str(Path(datasets_dir) / species / f"{dataset}.h5ad"), expected))
         else:
-            print(f"\n⏭️ {species}: {info.get('Status', 'Unknown')}")
-    
-    print("\n" + "=" * 50)
-    print("📊 Validation Summary:")
-    print(f"  Total validated size: {total_size:.1f} MB ({total_size/1024:.2f} GB)")
-    
-    if validation_passed:
-        print("  ✅ All datasets are valid and ready to use!")
-        print("\n🚀 You can now start the MASLDatlas application:")
-        print("   docker-compose up -d")
-        print("   # OR for local R: Rscript -e 'shiny::runApp()'")
-        return 0
+            print(f"⏭️ {species}: {info.get('Status', 'Unknown')}", file=sys.stderr)
+    return entries
+
+
+def _validate_task(task):
+    species, dataset, filepath, expected, checksum_cache_file, describe = task
+    entry = validate_h5ad_file(filepath, expected, checksum_cache_file)
+    result = {'species': species, 'dataset': dataset, **entry}
+    if describe and entry['valid']:
+        # Catalog metadata while the file is in the page cache
+        from dataset_catalog import describe_h5ad
+        result['catalog_entry'] = describe_h5ad(filepath)
+    return result
+
+
+def validate_all(entries, checksums=False, checksum_cache_file=None, workers=None, catalog_path=None):
+    """Report entries of every dataset, validated in a process pool
+
+    With ``catalog_path`` the catalog entries of the valid datasets are
+    refreshed too (see dataset_catalog.py).
+    """
+    tasks = [(species, dataset, filepath, expected if checksums else None, checksum_cache_file,
+              catalog_path is not None)
+             for species, dataset, filepath, expected in entries]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    if workers == 1:
+        results = [_validate_task(task) for task in tasks]
     else:
-        print("  ❌ Some datasets failed validation")
-        print("\n💡 Try re-downloading failed datasets:")
-        print("   python3 scripts/dataset-management/download_datasets.py --species [SPECIES]")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_validate_task, tasks))
+
+    if checksums and checksum_cache_file:
+        # Record new digests from this process only, so concurrent workers do not overwrite the cache file
+        from download_datasets import ChecksumCache
+        cache = ChecksumCache(checksum_cache_file)
+        for result in results:
+            checksum = result.get('checksum')
+            if checksum and checksum['match'] and not checksum['cached']:
+                cache.store(result['path'], 'md5', checksum['md5'])
+
+    if catalog_path is not None:
+        from dataset_catalog import read_catalog, write_catalog
+        catalog = read_catalog(catalog_path)
+        expected = {(species, dataset): sources for species, dataset, _, sources in entries}
+        for result in results:
+            entry = result.pop('catalog_entry', None)
+            if entry is not None:
+                checksum = result.get('checksum') or {}
+                entry.update({'path': result['path'], 'checksums': {
+                    'expected_md5': (expected[(result['species'], result['dataset'])] or {}).get('md5'),
+                    'md5': checksum['md5'] if checksum.get('match') else None}})
+                catalog['datasets'].setdefault(result['species'], {})[result['dataset']] = entry
+        write_catalog(catalog, catalog_path)
+    return results
+
+
+def print_summary(results, stream=sys.stderr):
+    species = None
+    for result in results:
+        if result['species'] != species:
+            species = result['species']
+            print(f"\n🧬 {species}:", file=stream)
+        if result['valid']:
+            cells = f", {result['n_obs']:,} cells x {result['n_vars']:,} genes" if result.get('n_obs') else ""
+            print(f"  ✅ {result['dataset']}: OK ({result['size_bytes'] / (1024*1024):.1f} MB{cells})", file=stream)
+        else:
+            print(f"  ❌ {result['dataset']}: {'; '.join(result['errors'])}", file=stream)
+        for warning in result['warnings']:
+            print(f"     ⚠️  {warning}", file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the structure of the configured datasets")
+    parser.add_argument("--config", default="config/datasets_config.json", help="Datasets configuration")
+    parser.add_argument("--sources", default="config/datasets_sources.json", help="Dataset sources with checksums")
+    parser.add_argument("--datasets-dir", default=os.environ.get('DATASETS_DIR', 'datasets'),
+                        help="Directory holding <species>/<dataset>.h5ad")
+    parser.add_argument("--checksums", action="store_true",
+                        help="Also verify MD5 checksums against the dataset sources")
+    parser.add_argument("--workers", type=int, default=None, help="Files validated in parallel (default: CPUs)")
+    parser.add_argument("--report", default=None, help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument("--catalog", nargs="?", const="", default=None,
+                        help="Also update the dataset catalog (default file: <datasets dir>/catalog.json)")
+    args = parser.parse_args()
+
+    print("🔍 MASLDatlas Dataset Validation", file=sys.stderr)
+    print("=" * 50, file=sys.stderr)
+    try:
+        config = load_json(args.config)
+    except Exception as e:
+        print(f"❌ Error loading configuration: {e}", file=sys.stderr)
         return 1
+    try:
+        sources = load_json(args.sources)
+    except (OSError, json.JSONDecodeError) as e:
+        if args.checksums:
+            print(f"❌ Error loading dataset sources: {e}", file=sys.stderr)
+            return 1
+        sources = {}
+
+    start_time = time.time()
+    checksum_cache_file = str(Path(args.datasets_dir) / '.checksum_cache.json')
+    catalog_path = None if args.catalog is None else args.catalog or str(Path(args.datasets_dir) / 'catalog.json')
+    results = validate_all(configured_datasets(config, sources, args.datasets_dir), args.checksums,
+                           checksum_cache_file, args.workers, catalog_path)
+    print_summary(results)
+
+    valid = [result for result in results if result['valid']]
+    total_size = sum(result.get('size_bytes', 0) for result in valid)
+    report = {
+        'version': REPORT_VERSION,
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'checksums_verified': args.checksums,
+        'summary': {'datasets': len(results), 'valid': len(valid), 'invalid': len(results) - len(valid),
+                    'total_size_bytes': total_size, 'seconds': round(time.time() - start_time, 3)},
+        'datasets': results,
+    }
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+    print("\n" + "=" * 50, file=sys.stderr)
+    print("📊 Validation Summary:", file=sys.stderr)
+    print(f"  Total validated size: {total_size / (1024**2):.1f} MB ({total_size / (1024**3):.2f} GB)", file=sys.stderr)
+    if len(valid) == len(results):
+        print("  ✅ All datasets are valid and ready to use!", file=sys.stderr)
+        print("\n🚀 You can now start the MASLDatlas application:", file=sys.stderr)
+        print("   docker-compose up -d", file=sys.stderr)
+        print("   # OR for local R: Rscript -e 'shiny::runApp()'", file=sys.stderr)
+        return 0
+    print("  ❌ Some datasets failed validation", file=sys.stderr)
+    print("\n💡 Try re-downloading failed datasets:", file=sys.stderr)
+    print("   python3 scripts/dataset-management/download_datasets.py --species [SPECIES]", file=sys.stderr)
+    return 1
+
 
 if __name__ == "__main__":
     sys.exit(main())